@@ -19,7 +19,7 @@ from desicos.constants import FLOAT
 from desicos.conecylDB.measured_imp_ms import calc_nodal_translations
 from desicos.conecylDB.measured_imp_t import calc_elems_t
 from desicos.conecylDB.read_write import read_theta_z_imp
-from desicos.conecylDB.interpolate import inv_weighted
+from desicos.conecylDB.interpolate import inv_weighted, get_interp_plan
 from desicos.abaqus.utils import vec_calc_elem_cg, index_within_linspace
 
 
@@ -42,7 +42,8 @@ def calc_translations_ABAQUS(imperfection_file_name,
                              ignore_bot_h=None,
                              ignore_top_h=None,
                              sample_size=None,
-                             T=None):
+                             T=None,
+                             plan_dir=None):
     r"""Reads an imperfection file and calculates the nodal translations
 
     Parameters
@@ -101,6 +102,10 @@ def calc_translations_ABAQUS(imperfection_file_name,
     T : None or np.ndarray, optional
         A transformation matrix (cf. :func:`.transf_matrix`) required when the
         mesh is not in the :ref:`default coordinate system <figure_conecyl>`.
+    plan_dir : str or None, optional
+        Directory used to cache the interpolation weights (see
+        :func:`.get_interp_plan`), valid only when
+        ``use_theta_z_format=True``.
 
     """
     import abaqus
@@ -166,9 +171,16 @@ def calc_translations_ABAQUS(imperfection_file_name,
         data3D[:, 2] = z
         data3D[:, 3] = data[:, 2]
 
-        dist, w0 = inv_weighted(data3D, coords,
-                          ncp = num_closest_points,
-                          power_parameter = power_parameter)
+        if plan_dir is None:
+            dist, w0 = inv_weighted(data3D, coords,
+                              ncp = num_closest_points,
+                              power_parameter = power_parameter)
+        else:
+            plan = get_interp_plan(data3D[:, :3], coords,
+                                   ncp = num_closest_points,
+                                   power_parameter = power_parameter,
+                                   cache_dir = plan_dir)
+            w0 = plan.apply(data3D[:, 3])
 
         thetas = arctan2(coords[:, 1], coords[:, 0])
 
@@ -226,7 +238,8 @@ def translate_nodes_ABAQUS(imperfection_file_name,
                            ignore_bot_h=None,
                            ignore_top_h=None,
                            sample_size=None,
-                           T=None):
+                           T=None,
+                           plan_dir=None):
     r"""Translates the nodes in Abaqus based on imperfection data
 
     The imperfection amplitude for each node is calculated using an inversed
@@ -304,6 +317,10 @@ def translate_nodes_ABAQUS(imperfection_file_name,
     T : None or np.ndarray, optional
         A transformation matrix (cf. :func:`.transf_matrix`) required when the
         mesh is not in the :ref:`default coordinate system <figure_conecyl>`.
+    plan_dir : str or None, optional
+        Directory used to cache the interpolation weights (see
+        :func:`.get_interp_plan`), valid only when
+        ``use_theta_z_format=True``.
 
     Returns
     -------
@@ -371,7 +388,8 @@ def translate_nodes_ABAQUS(imperfection_file_name,
                         ignore_bot_h = ignore_bot_h,
                         ignore_top_h = ignore_top_h,
                         sample_size = sample_size,
-                        T = T)
+                        T = T,
+                        plan_dir = plan_dir)
 
         else:
             trans = nodal_translations
@@ -583,7 +601,7 @@ def translate_nodes_ABAQUS_c0(m0, n0, c0, funcnum,
     thetas = arctan2(coords[:, 1], coords[:, 0])
 
     alpharad = deg2rad(semi_angle)
-    w0 = fit_data.fw0(m0, n0, c0, xs_norm, thetas, funcnum)
+    w0 = fit_data.fw0_many(m0, n0, c0, xs_norm, thetas, funcnum)
     nodal_translations = np.zeros_like(coords)
     nodal_translations[:, 0] = w0*cos(alpharad)*cos(thetas)
     nodal_translations[:, 1] = w0*cos(alpharad)*sin(thetas)
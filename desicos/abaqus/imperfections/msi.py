@@ -91,6 +91,10 @@ class MSI(object):
     ``rotatedeg``           ``float``, rotation angle in degrees telling
                             how much the imperfection pattern should be
                             rotated about the `X_3` (or `Z`) axis.
+    ``plan_dir``            ``str``, directory where the interpolation
+                            weights are cached and reused by other models
+                            sharing the same mesh (see
+                            :func:`.get_interp_plan`)
     ======================  ==================================================
 
     The following attributes of the :class:`.MSI` object control the
@@ -158,6 +162,7 @@ class MSI(object):
         self.ignore_bot_h = True
         self.ignore_top_h = True
         self.sample_size = 2000000
+        self.plan_dir = None
         #TODO: include z_offset_bottom to calculate ignore_bot_h and
         #      ignore_top_h
         # plotting options
@@ -174,6 +179,7 @@ class MSI(object):
         if attrs['xaxis'] == 'amplitude':
             attrs['xaxis'] = 'scaling_factor'
             attrs['xaxis_label'] = 'Scaling factor'
+        attrs.setdefault('plan_dir', None)
         self.__dict__.update(attrs)
 
     def rebuild(self):
@@ -264,7 +270,8 @@ class MSI(object):
                               use_theta_z_format = self.use_theta_z_format,
                               ignore_bot_h = self.ignore_bot_h,
                               ignore_top_h = self.ignore_top_h,
-                              sample_size = self.sample_size)
+                              sample_size = self.sample_size,
+                              plan_dir = self.plan_dir)
         else:
             if self.rotatedeg:
                 warn('"rotatedeg != 0", be sure you included this effect ' +
@@ -35,6 +35,9 @@ an imperfection file had been made available.
 .. automodule:: desicos.conecylDB.read_write
     :members:
 
+.. automodule:: desicos.conecylDB.batch
+    :members:
+
 """
 from __future__ import absolute_import
 from .conecylDB import *
@@ -13,26 +13,24 @@ ctypedef np.double_t cDOUBLE
 DOUBLE = np.float64
 
 ctypedef void *cftype(int size, int m0, int n0, int num,
-                      double *zs, double *thetas, double *a) nogil
+                      double *zs, double *thetas, double *a,
+                      int num_threads) nogil
 
 cdef extern from "math.h":
     double cos(double t) nogil
     double sin(double t) nogil
+    double pow(double x, double y) nogil
 
 cdef double pi = 3.141592653589793
 
 def fa(m0, n0, np.ndarray[cDOUBLE, ndim=1] zs,
-              np.ndarray[cDOUBLE, ndim=1] thetas, funcnum):
+              np.ndarray[cDOUBLE, ndim=1] thetas, funcnum, num_threads=4):
 
     cdef np.ndarray[cDOUBLE, ndim=2] a
     cdef cftype *cf
 
     num = zs.shape[0]
 
-    TOL = 1.e-3
-    if abs(zs.min()) > TOL or abs(1 - zs.max()) > TOL:
-        raise ValueError('The zs array must be normalized!')
-
     if funcnum==1:
         size = 2
         cf = &cf1
@@ -44,16 +42,18 @@ def fa(m0, n0, np.ndarray[cDOUBLE, ndim=1] zs,
         cf = &cf3
 
     a = np.zeros((num, size*n0*m0), DOUBLE)
-    cf(size, m0, n0, num, &zs[0], &thetas[0], &a[0, 0])
+    if num > 0:
+        cf(size, m0, n0, num, &zs[0], &thetas[0], &a[0, 0], num_threads)
 
     return a
 
 cdef void *cf1(int size, int m0, int n0, int num,
-               double *zs, double *thetas, double *a) nogil:
+               double *zs, double *thetas, double *a,
+               int num_threads) nogil:
     cdef double z, theta
     cdef int l, i, j, col
 
-    for l in prange(num, chunksize=num/20, num_threads=4, schedule='static'):
+    for l in prange(num, num_threads=num_threads, schedule='static'):
         theta = thetas[l]
         z = zs[l]
         for i in range(1, m0+1):
@@ -63,11 +63,12 @@ cdef void *cf1(int size, int m0, int n0, int num,
                 a[l*(size*m0*n0) + (col+1)] = sin(i*pi*z)*cos(j*theta)
 
 cdef void *cf2(int size, int m0, int n0, int num,
-               double *zs, double *thetas, double *a) nogil:
+               double *zs, double *thetas, double *a,
+               int num_threads) nogil:
     cdef double z, theta
     cdef int l, i, j, col
 
-    for l in prange(num, chunksize=num/20, num_threads=4, schedule='static'):
+    for l in prange(num, num_threads=num_threads, schedule='static'):
         theta = thetas[l]
         z = zs[l]
         for i in range(m0):
@@ -77,11 +78,12 @@ cdef void *cf2(int size, int m0, int n0, int num,
                 a[l*(size*m0*n0) + (col+1)] = cos(i*pi*z)*cos(j*theta)
 
 cdef void *cf3(int size, int m0, int n0, int num,
-               double *zs, double *thetas, double *a) nogil:
+               double *zs, double *thetas, double *a,
+               int num_threads) nogil:
     cdef double z, theta
     cdef int l, i, j, col
 
-    for l in prange(num, chunksize=num/20, num_threads=4, schedule='static'):
+    for l in prange(num, num_threads=num_threads, schedule='static'):
         theta = thetas[l]
         z = zs[l]
         for i in range(m0):
@@ -95,61 +97,99 @@ cdef void *cf3(int size, int m0, int n0, int num,
 def fw0(int m0, int n0,
         np.ndarray[cDOUBLE, ndim=1] c0,
         np.ndarray[cDOUBLE, ndim=1] xs,
-        np.ndarray[cDOUBLE, ndim=1] ts, funcnum):
-    cdef int ix, i, j, col, size
-    cdef double x, t, sinix, cosix, sinjt, cosjt, w0
+        np.ndarray[cDOUBLE, ndim=1] ts, int funcnum, int num_threads=4):
+    cdef int ix, num
     cdef np.ndarray[cDOUBLE, ndim=1] w0s
+    cdef double *pc0
+    cdef double *pxs
+    cdef double *pts
+    cdef double *pw0s
     w0s = np.zeros_like(xs)
-    size = np.shape(xs)[0]
+    num = np.shape(xs)[0]
+    if num == 0:
+        return w0s
+    pc0 = &c0[0]
+    pxs = &xs[0]
+    pts = &ts[0]
+    pw0s = &w0s[0]
+
+    for ix in prange(num, nogil=True, num_threads=num_threads,
+                     schedule='static'):
+        pw0s[ix] = fw0_point(m0, n0, pc0, pxs[ix], pts[ix], funcnum)
 
-    TOL = 1.e-3
-    if abs(xs.min()) > TOL or abs(1 - xs.max()) > TOL:
-        raise ValueError('The xs array must be normalized!')
+    return w0s
 
+cdef double fw0_point(int m0, int n0, double *c0, double x, double t,
+                      int funcnum) nogil:
+    cdef int i, j, col
+    cdef double sinix, cosix, sinjt, cosjt, w0
+    w0 = 0
     if funcnum==1:
-        for ix in range(size):
-            x = xs[ix]
-            t = ts[ix]
-            w0 = 0
-            for j in range(n0):
-                sinjt = sin(j*t)
-                cosjt = cos(j*t)
-                for i in range(1, m0+1):
-                    sinix = sin(i*pi*x)
-                    col = (i-1)*2 + j*m0*2
-                    w0 += c0[col+0]*sinix*sinjt
-                    w0 += c0[col+1]*sinix*cosjt
-            w0s[ix] = w0
+        for j in range(n0):
+            sinjt = sin(j*t)
+            cosjt = cos(j*t)
+            for i in range(1, m0+1):
+                sinix = sin(i*pi*x)
+                col = (i-1)*2 + j*m0*2
+                w0 += c0[col+0]*sinix*sinjt
+                w0 += c0[col+1]*sinix*cosjt
     elif funcnum==2:
-        for ix in range(size):
-            x = xs[ix]
-            t = ts[ix]
-            w0 = 0
-            for j in range(n0):
-                sinjt = sin(j*t)
-                cosjt = cos(j*t)
-                for i in range(m0):
-                    cosix = cos(i*pi*x)
-                    col = i*2 + j*m0*2
-                    w0 += c0[col+0]*cosix*sinjt
-                    w0 += c0[col+1]*cosix*cosjt
-            w0s[ix] = w0
+        for j in range(n0):
+            sinjt = sin(j*t)
+            cosjt = cos(j*t)
+            for i in range(m0):
+                cosix = cos(i*pi*x)
+                col = i*2 + j*m0*2
+                w0 += c0[col+0]*cosix*sinjt
+                w0 += c0[col+1]*cosix*cosjt
     elif funcnum==3:
-        for ix in range(size):
-            x = xs[ix]
-            t = ts[ix]
-            w0 = 0
-            for j in range(n0):
-                sinjt = sin(j*t)
-                cosjt = cos(j*t)
-                for i in range(m0):
-                    sinix = sin(i*pi*x)
-                    cosix = cos(i*pi*x)
-                    col = i*4 + j*m0*4
-                    w0 += c0[col+0]*sinix*sinjt
-                    w0 += c0[col+1]*sinix*cosjt
-                    w0 += c0[col+2]*cosix*sinjt
-                    w0 += c0[col+3]*cosix*cosjt
-            w0s[ix] = w0
-
-    return w0s
+        for j in range(n0):
+            sinjt = sin(j*t)
+            cosjt = cos(j*t)
+            for i in range(m0):
+                sinix = sin(i*pi*x)
+                cosix = cos(i*pi*x)
+                col = i*4 + j*m0*4
+                w0 += c0[col+0]*sinix*sinjt
+                w0 += c0[col+1]*sinix*cosjt
+                w0 += c0[col+2]*cosix*sinjt
+                w0 += c0[col+3]*cosix*cosjt
+    return w0
+
+def idw(np.ndarray[cDOUBLE, ndim=2] dist,
+        np.ndarray[cDOUBLE, ndim=2] imp, double power_parameter,
+        int num_threads=4):
+    cdef int l, num, ncp
+    cdef np.ndarray[cDOUBLE, ndim=1] imp_new
+    cdef double *pdist
+    cdef double *pimp
+    cdef double *pnew
+    dist = np.ascontiguousarray(dist)
+    imp = np.ascontiguousarray(imp)
+    num = dist.shape[0]
+    ncp = dist.shape[1]
+    imp_new = np.zeros(num, DOUBLE)
+    if num == 0:
+        return imp_new
+    pdist = &dist[0, 0]
+    pimp = &imp[0, 0]
+    pnew = &imp_new[0]
+
+    for l in prange(num, nogil=True, num_threads=num_threads,
+                    schedule='static'):
+        pnew[l] = idw_point(ncp, &pdist[l*ncp], &pimp[l*ncp],
+                            power_parameter)
+
+    return imp_new
+
+cdef double idw_point(int ncp, double *dist, double *imp,
+                      double power_parameter) nogil:
+    cdef int k
+    cdef double weight, total_weight, total
+    total_weight = 0
+    total = 0
+    for k in range(ncp):
+        weight = 1./pow(dist[k], power_parameter)
+        total_weight += weight
+        total += imp[k]*weight
+    return total/total_weight
@@ -0,0 +1,356 @@
+r"""
+Batch (:mod:`desicos.conecylDB.batch`)
+======================================
+
+.. currentmodule:: desicos.conecylDB.batch
+
+Batch conversion of measured imperfection files from the format
+"`x` `y` `z`" (or "`x` `y` `z` `thick`") to the format "`\theta` `z`
+`imp`" (or "`\theta` `z` `thick`"), including the best-fit of each
+measured specimen (see :func:`.xyz2thetazimp` and
+:func:`.xyzthick2thetazthick`).
+
+The files are converted in a pool of processes and a JSON manifest is
+updated after each file, with the timing, the best-fit results and the
+SHA-1 hashes of the input and output files. A file is skipped when its
+output is up to date, i.e. when the hash of the input, the conversion
+parameters and the hash of the output match the manifest, such that an
+interrupted run can simply be started again.
+
+Usage from the command line::
+
+    python -m desicos.conecylDB.batch DIRECTORY --H 510 --R 250 -j 4
+    python -m desicos.conecylDB.batch --ccs rtu_2014_r15 rtu_2014_r16 -j 2
+
+"""
+from __future__ import absolute_import
+import glob
+import json
+import os
+import time
+import traceback
+
+import numpy as np
+
+from desicos.logger import *
+from desicos.conecylDB.sidecar import file_hash, write_atomic
+
+
+VERSION = 1
+SUFFIXES = {'msi': '_theta_z_imp.txt',
+            'ti': '_theta_z_thick.txt'}
+PARAMS = ('kind', 'alphadeg', 'H', 'R_expected', 'sample_size', 'fmt')
+
+
+def _outpath(path, kind, outdir=None):
+    dirpath, name = os.path.split(path)
+    name = '.'.join(name.split('.')[:-1]) + SUFFIXES[kind]
+    return os.path.join(outdir if outdir else dirpath, name)
+
+
+def make_job(path, kind, H, alphadeg=0., R_expected=10., outdir=None,
+             sample_size=None, fmt='%1.8f'):
+    """Creates the description of one conversion
+
+    Parameters
+    ----------
+    path : str
+        The path of the measured data file.
+    kind : str
+        ``'msi'`` for "`x` `y` `z`" files (mid-surface imperfection) or
+        ``'ti'`` for "`x` `y` `z` `thick`" files (thickness imperfection).
+    H : float
+        The total height of the measured test specimen.
+    alphadeg : float, optional
+        The semi-vertex angle of the measured specimen.
+    R_expected : float, optional
+        The expected radius, see :func:`.xyz2thetazimp`.
+    outdir : str or None, optional
+        The directory of the output file. If ``None`` the directory of the
+        input file is used.
+    sample_size : int or None, optional
+        The number of points used in the best-fit.
+    fmt : str, optional
+        The format of the output values (see ``np.savetxt``).
+
+    Returns
+    -------
+    job : dict
+
+    """
+    if kind not in SUFFIXES:
+        raise ValueError('Invalid kind: {0}'.format(kind))
+    path = os.path.abspath(path)
+    return dict(path=path, kind=kind, H=float(H), alphadeg=float(alphadeg),
+                R_expected=float(R_expected), sample_size=sample_size,
+                fmt=fmt, outpath=os.path.abspath(_outpath(path, kind,
+                                                          outdir)))
+
+
+def jobs_from_dir(directory, H, alphadeg=0., R_expected=10., **kwargs):
+    """Creates the jobs for the ``*_msi.txt`` and ``*_ti.txt`` files of a
+    directory
+
+    The other parameters are passed to :func:`.make_job`.
+
+    """
+    jobs = []
+    for kind in ('msi', 'ti'):
+        pattern = os.path.join(directory, '*_{0}.txt'.format(kind))
+        for path in sorted(glob.glob(pattern)):
+            jobs.append(make_job(path, kind, H, alphadeg, R_expected,
+                                 **kwargs))
+    return jobs
+
+
+def jobs_from_ccs(keys=None, ccs=None, **kwargs):
+    """Creates the jobs for the imperfection files of ``ccs`` entries
+
+    The height, the semi-vertex angle and the expected radius are taken from
+    each entry. Entries whose files are not available are skipped.
+
+    Parameters
+    ----------
+    keys : list or None, optional
+        The ``ccs`` entries to convert. If ``None`` all entries are used.
+    ccs : dict or None, optional
+        The ``ccs`` dictionary. If ``None`` the one returned by
+        ``conecylDB.fetch('ccs')`` is used.
+
+    The other parameters are passed to :func:`.make_job`.
+
+    """
+    from desicos.conecylDB.conecylDB import fetch, DBHOME
+
+    if ccs is None:
+        ccs = fetch('ccs')
+    if keys is None:
+        keys = sorted(ccs.keys())
+    jobs = []
+    for key in keys:
+        cc = ccs[key]
+        for kind in ('msi', 'ti'):
+            if kind not in cc or 'database' not in cc:
+                continue
+            imp = cc[kind]
+            path = os.path.join(DBHOME, 'files', cc['database'], imp,
+                                '{0}_{1}.txt'.format(imp, kind))
+            if not os.path.isfile(path):
+                continue
+            jobs.append(make_job(path, kind, cc['H'],
+                                 cc.get('alphadeg', 0.),
+                                 cc.get('R_best_fit', cc.get('rbot', 10.)),
+                                 **kwargs))
+    return jobs
+
+
+def load_manifest(path):
+    """Loads a manifest, returning an empty one if it does not exist
+    """
+    if path and os.path.isfile(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == VERSION:
+            return manifest
+        warn('Manifest {0} has an old version and will be rewritten'.format(
+             path))
+    return dict(version=VERSION, files={})
+
+
+def save_manifest(manifest, path):
+    """Saves a manifest atomically, such that a crash never leaves a
+    partially written file
+    """
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    write_atomic(path, write)
+
+
+def is_up_to_date(job, manifest):
+    """Checks if the output of a job matches the manifest
+
+    Returns
+    -------
+    up_to_date : bool
+
+    """
+    entry = manifest['files'].get(job['outpath'])
+    if entry is None or entry.get('status') != 'ok':
+        return False
+    if any(entry['params'].get(k) != job[k] for k in PARAMS):
+        return False
+    if not os.path.isfile(job['outpath']):
+        return False
+    return (entry['input_sha1'] == file_hash(job['path'])
+            and entry['output_sha1'] == file_hash(job['outpath']))
+
+
+def convert(job):
+    """Runs one conversion job, see :func:`.make_job`
+
+    The output is written atomically. Errors are returned instead of being
+    raised, such that one bad file does not stop a batch.
+
+    Returns
+    -------
+    entry : dict
+        The manifest entry of the job.
+
+    """
+    from desicos.conecylDB.read_write import (xyz2thetazimp,
+                                              xyzthick2thetazthick)
+
+    t0 = time.time()
+    entry = dict(path=job['path'],
+                 params=dict((k, job[k]) for k in PARAMS))
+    try:
+        entry['input_sha1'] = file_hash(job['path'])
+        func = (xyz2thetazimp if job['kind'] == 'msi'
+                else xyzthick2thetazthick)
+        mps, out = func(job['path'], job['alphadeg'], job['H'],
+                        R_expected=job['R_expected'],
+                        sample_size=job['sample_size'], save=False,
+                        best_fit_output=True)
+        outpath = job['outpath']
+        write_atomic(outpath, lambda tmp: np.savetxt(tmp, mps,
+                                                     fmt=job['fmt']))
+        entry['output_sha1'] = file_hash(outpath)
+        entry['num_points'] = int(mps.shape[0])
+        if out is not None:
+            entry['best_fit'] = dict(
+                R_best_fit=float(out['R_best_fit']),
+                T=np.asarray(out['T']).tolist())
+            if 'alphadeg_best_fit' in out:
+                entry['best_fit']['alphadeg_best_fit'] = float(
+                    out['alphadeg_best_fit'])
+        entry['status'] = 'ok'
+    except Exception:
+        entry['status'] = 'error'
+        entry['error'] = traceback.format_exc()
+    entry['time'] = time.time() - t0
+    return entry
+
+
+def run(jobs, manifest_path='manifest.json', workers=1, force=False):
+    """Converts many files in parallel, skipping the ones up to date
+
+    The manifest is saved after each converted file, allowing an interrupted
+    run to be resumed by calling this function again with the same jobs.
+
+    Parameters
+    ----------
+    jobs : list
+        The jobs created with :func:`.make_job`, :func:`.jobs_from_dir` or
+        :func:`.jobs_from_ccs`.
+    manifest_path : str, optional
+        The path of the JSON manifest.
+    workers : int, optional
+        Number of processes.
+    force : bool, optional
+        If ``True`` all jobs are run, even if up to date.
+
+    Returns
+    -------
+    manifest : dict
+        The manifest, with one entry for each output file under
+        ``manifest['files']``.
+
+    """
+    manifest = load_manifest(manifest_path)
+    todo = [job for job in jobs if force or not is_up_to_date(job,
+                                                              manifest)]
+    log('Batch conversion: {0} files, {1} up to date'.format(len(jobs),
+        len(jobs) - len(todo)))
+    if not todo:
+        return manifest
+
+    def done(job, entry):
+        manifest['files'][job['outpath']] = entry
+        save_manifest(manifest, manifest_path)
+        if entry['status'] == 'ok':
+            log('{0} converted in {1:1.2f} s'.format(
+                os.path.basename(job['path']), entry['time']), level=1)
+        else:
+            warn('{0} failed:\n{1}'.format(os.path.basename(job['path']),
+                 entry['error']), level=1)
+
+    if workers > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(min(workers, len(todo)))
+        try:
+            results = pool.imap_unordered(_convert_indexed,
+                                          list(enumerate(todo)))
+            for i, entry in results:
+                done(todo[i], entry)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in todo:
+            done(job, convert(job))
+
+    failed = _failed(jobs, manifest)
+    if failed:
+        warn('{0} files failed, see {1}'.format(failed, manifest_path))
+    return manifest
+
+
+def _failed(jobs, manifest):
+    return sum(manifest['files'][job['outpath']]['status'] != 'ok'
+               for job in jobs if job['outpath'] in manifest['files'])
+
+
+def _convert_indexed(args):
+    i, job = args
+    return i, convert(job)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=
+            'Converts measured imperfection files to the theta-z format')
+    parser.add_argument('directory', nargs='?',
+            help='directory with *_msi.txt and *_ti.txt files')
+    parser.add_argument('--ccs', nargs='*', metavar='KEY',
+            help='convert the files of the ccs entries (all if no key)')
+    parser.add_argument('--H', type=float,
+            help='height of the specimens (directory mode)')
+    parser.add_argument('--alphadeg', type=float, default=0.,
+            help='semi-vertex angle of the specimens (directory mode)')
+    parser.add_argument('--R', type=float, default=10.,
+            help='expected radius of the specimens (directory mode)')
+    parser.add_argument('--outdir', default=None,
+            help='output directory, default is the input directory')
+    parser.add_argument('--sample-size', type=int, default=None,
+            help='number of points used in the best-fit')
+    parser.add_argument('--fmt', default='%1.8f',
+            help='output number format')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+            help='number of processes')
+    parser.add_argument('--manifest', default='manifest.json',
+            help='path of the JSON manifest')
+    parser.add_argument('--force', action='store_true',
+            help='convert also the files up to date')
+    args = parser.parse_args(argv)
+
+    kwargs = dict(outdir=args.outdir, sample_size=args.sample_size,
+                  fmt=args.fmt)
+    if args.ccs is not None:
+        jobs = jobs_from_ccs(args.ccs or None, **kwargs)
+    elif args.directory:
+        if args.H is None:
+            parser.error('--H is required when converting a directory')
+        jobs = jobs_from_dir(args.directory, args.H, args.alphadeg, args.R,
+                             **kwargs)
+    else:
+        parser.error('give a directory or --ccs')
+    manifest = run(jobs, args.manifest, args.workers, args.force)
+    return 1 if _failed(jobs, manifest) else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
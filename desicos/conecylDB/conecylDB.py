@@ -4,17 +4,29 @@ Conecyl Data-Base (:mod:`desicos.conecylDB.conecylDB`)
 
 .. currentmodule:: desicos.conecylDB.conecylDB
 
+The default entries of :mod:`.ccs`, :mod:`.laminaprops` and
+:mod:`.allowables` are imported only when they are first needed.
+
+The imperfection dictionaries ``imps``, ``imps_theta_z``, ``t_measured``,
+``R_best_fit`` and ``H_measured`` are lazy mappings, built on first access
+from an index of the imperfection files. The index is persisted in the
+localDB directory and is rebuilt only when the modification times of the
+``files`` tree, of ``ccs.py`` or of the local ``ccs.json`` change, see
+:func:`.update_imps`.
+
 """
 from __future__ import absolute_import
 import json
+import ntpath
 import os
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 
 from desicos.logger import *
-from .ccs import ccs as default_ccs
-from .ccs import include_in_GUI
-from .allowables import allowables as default_allowables
-from .laminaprops import laminaprops as default_laminaprops
-from desicos.constants import DESHOME
+from desicos.constants import DESHOME, TMP_DIR
+from desicos.conecylDB.sidecar import write_atomic
 
 
 DBHOME = os.path.join(DESHOME, 'conecylDB')
@@ -22,10 +34,16 @@ DBHOME = os.path.join(DESHOME, 'conecylDB')
 databases = json.load(open(os.path.join(DBHOME, 'databases.json')))
 
 localDB_path = json.load(open(os.path.join(DBHOME, 'localDB_path.json')))
+# the default path is a Windows one, that elsewhere would be created
+# relative to the working directory
+if ntpath.isabs(localDB_path) and not os.path.isabs(localDB_path):
+    localDB_path = os.path.join(os.path.expanduser(TMP_DIR),
+                                ntpath.basename(localDB_path))
 
 local_ccs_path = os.path.join(localDB_path, 'ccs.json')
 local_laminaprops_path = os.path.join(localDB_path, 'laminaprops.json')
 local_allowables_path = os.path.join(localDB_path, 'allowables.json')
+imps_index_path = os.path.join(localDB_path, 'imps_index.json')
 which_path = {'ccs': local_ccs_path,
               'laminaprops': local_laminaprops_path,
               'allowables': local_allowables_path}
@@ -80,35 +98,46 @@ def fetch(which, local_only=False):
     if local_only:
         return local
     if which=='ccs':
-        return dict(list(default_ccs.items()) + list(local.items()))
+        from .ccs import ccs as default
     elif which=='laminaprops':
-        return dict(list(default_laminaprops.items()) + list(local.items()))
+        from .laminaprops import laminaprops as default
     elif which=='allowables':
-        return dict(list(default_allowables.items()) + list(local.items()))
+        from .allowables import allowables as default
     else:
         raise ValueError('{0} is an invalid option to fetch'.format(which))
+    return dict(list(default.items()) + list(local.items()))
 
 
-def update_imps():
-    """Returns the updated imperfection definitions from the data-base
-
-    Returns
-    -------
-    out : tuple
-        A tuple containing the updated dictionaries with useful data form
-        the data-base. In the description below ``key`` corresponds to a
-        ``ccs`` entry of the database:
-
-        - ``imps``: contains the full path of an imperfection file
-          corresponding to ``key``, accessed doing ``imp[key]['msi']`` or
-          ``imp[key]['ti']``
-        - ``imps_theta_z``: similar to ``imps``
-        - ``t_measured``: contains the measured shell thickness for a
-          correponding entry access doing ``t_measured[key]``
-        - ``R_best_fit``
-        - ``H_measured``
+def _imps_signature():
+    # modification times of everything that can change the index: the
+    # directories of the files tree (a file added or removed changes the
+    # mtime of its directory), the default and the local ccs
+    sig = []
 
-    """
+    def add(path):
+        try:
+            sig.append([path, os.stat(path).st_mtime])
+        except OSError:
+            sig.append([path, None])
+
+    files = os.path.join(DBHOME, 'files')
+    add(files)
+    if os.path.isdir(files):
+        for db in sorted(os.listdir(files)):
+            dbpath = os.path.join(files, db)
+            if not os.path.isdir(dbpath):
+                continue
+            add(dbpath)
+            for imp in sorted(os.listdir(dbpath)):
+                imppath = os.path.join(dbpath, imp)
+                if os.path.isdir(imppath):
+                    add(imppath)
+    add(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ccs.py'))
+    add(local_ccs_path)
+    return sig
+
+
+def _build_imps():
     ccs = fetch('ccs')
     imps = {}
     imps_theta_z = {}
@@ -169,7 +198,128 @@ def update_imps():
 
             H_measured[imp] = cc['H']
 
-    return imps, imps_theta_z, t_measured, R_best_fit, H_measured
+    return dict(imps=imps, imps_theta_z=imps_theta_z, t_measured=t_measured,
+                R_best_fit=R_best_fit, H_measured=H_measured)
+
+
+_IMPS_NAMES = ('imps', 'imps_theta_z', 't_measured', 'R_best_fit',
+               'H_measured')
+_imps_cache = {}
+
+
+def _load_imps_index(refresh=False):
+    # the index in memory is used unless a refresh is requested, then the
+    # persisted index is used if its signature is still valid
+    if _imps_cache and not refresh:
+        return _imps_cache
+    sig = _imps_signature()
+    if _imps_cache.get('signature') == sig:
+        return _imps_cache
+    index = None
+    try:
+        with open(imps_index_path) as f:
+            index = json.load(f)
+        if index.get('signature') != sig:
+            index = None
+    except (IOError, OSError, ValueError):
+        index = None
+    if index is None:
+        index = _build_imps()
+        index['signature'] = sig
+        try:
+            def write(tmp):
+                with open(tmp, 'w') as f:
+                    json.dump(index, f)
+            write_atomic(imps_index_path, write)
+        except (IOError, OSError):
+            warn('{0} could not be written'.format(imps_index_path),
+                 level=1)
+        # JSON loads the signature with lists, keep the same type in memory
+        index = json.loads(json.dumps(index))
+    _imps_cache.clear()
+    _imps_cache.update(index)
+    return _imps_cache
+
+
+class _LazyImps(Mapping):
+    """Read-only mapping built from the imperfection index on first access
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def _data(self):
+        return _load_imps_index()[self._name]
+
+    def __getitem__(self, key):
+        return self._data()[key]
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __len__(self):
+        return len(self._data())
+
+    def __repr__(self):
+        return repr(self._data())
+
+
+class _LazyList(Sequence):
+    """Read-only list loaded by ``loader()`` on first access
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._list = None
+
+    def _data(self):
+        if self._list is None:
+            self._list = list(self._loader())
+        return self._list
+
+    def __getitem__(self, i):
+        return self._data()[i]
+
+    def __len__(self):
+        return len(self._data())
+
+    def __repr__(self):
+        return repr(self._data())
+
+
+def _include_in_GUI():
+    from .ccs import include_in_GUI
+    return include_in_GUI
+
+
+include_in_GUI = _LazyList(_include_in_GUI)
+
+
+def update_imps():
+    """Returns the updated imperfection definitions from the data-base
+
+    The persisted index of the imperfection files is used when the ``files``
+    tree and the ``ccs`` entries did not change since it was built,
+    otherwise the index is built again.
+
+    Returns
+    -------
+    out : tuple
+        A tuple containing the updated dictionaries with useful data form
+        the data-base. In the description below ``key`` corresponds to a
+        ``ccs`` entry of the database:
+
+        - ``imps``: contains the full path of an imperfection file
+          corresponding to ``key``, accessed doing ``imp[key]['msi']`` or
+          ``imp[key]['ti']``
+        - ``imps_theta_z``: similar to ``imps``
+        - ``t_measured``: contains the measured shell thickness for a
+          correponding entry access doing ``t_measured[key]``
+        - ``R_best_fit``
+        - ``H_measured``
+
+    """
+    index = _load_imps_index(refresh=True)
+    # copies, such that changing them does not change the index
+    return tuple(json.loads(json.dumps(index[name])) for name in _IMPS_NAMES)
 
 
 def save(which, name, value):
@@ -234,7 +384,11 @@ def delete(which, name):
             msg = error(msg)
         return msg
 
-imps, imps_theta_z, t_measured, R_best_fit, H_measured = update_imps()
+imps = _LazyImps('imps')
+imps_theta_z = _LazyImps('imps_theta_z')
+t_measured = _LazyImps('t_measured')
+R_best_fit = _LazyImps('R_best_fit')
+H_measured = _LazyImps('H_measured')
 
 #TODO put in a better way
 imperfection_amplitudes = {
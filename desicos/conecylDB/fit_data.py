@@ -8,6 +8,8 @@ This module includes functions used to fit measured imperfection data.
 
 """
 from random import sample
+from collections import OrderedDict
+import hashlib
 import os
 
 import numpy as np
@@ -15,6 +17,9 @@ from numpy import sin, cos, pi, deg2rad
 
 from desicos.logger import *
 from desicos.constants import FLOAT
+from desicos.conecylDB import kernels
+from desicos.conecylDB.sidecar import load_txt
+from desicos.conecylDB.stream import scan, ReservoirSample
 
 
 def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
@@ -39,16 +44,18 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
      \\
            \end{bmatrix}
 
-    Note that **five** variables are unknowns:
+    Note that **six** variables are unknowns:
 
     - the rotation angles `\alpha` and `\beta`
     - the three components of the translation `\Delta x_0`, `\Delta y_0` and
       `\Delta z_0`
+    - the radius `R`
 
-    The five unknowns are calculated iteratively in a non-linear least-sqares
-    problem (solved with ``scipy.optimize.leastsq``), where the measured data
-    is transformed to the reference coordinate system and there compared with
-    a reference cylinder in order to compute the residual error using:
+    The six unknowns are calculated in a non-linear least-sqares problem
+    (solved with ``scipy.optimize.leastsq`` using an analytical Jacobian),
+    where the measured data is transformed to the reference coordinate
+    system and there compared with a reference cylinder in order to compute
+    the residual error using:
 
     .. math::
         \begin{Bmatrix} x_{ref} \\ y_{ref} \\ z_{ref} \end{Bmatrix} =
@@ -74,9 +81,10 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
                          z_{ref} - H, & \text{if } z_{ref} > H \\
                        \end{cases}
 
-    Since the measured data may have an unknown radius `R`, the solution of
-    these equations has to be performed iteratively with one additional
-    external loop in order to update `R`.
+    The initial guess is obtained in closed form: the principal directions
+    of the data are candidates for the cylinder axis and the one for which
+    an algebraic circle fit of the projected points gives the smallest
+    error is chosen, the circle giving the initial center and radius.
 
     Parameters
     ----------
@@ -91,15 +99,15 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
     H : float
         The nominal height of the cylinder.
     R_expected : float, optional
-        The nominal radius of the cylinder, used as a first guess to find
-        the best-fit radius (``R_best_fit``). Note that if not specified more
-        iterations may be required.
+        The nominal radius of the cylinder. Kept for backward compatibility,
+        the first guess of the best-fit radius is obtained from the data.
     save : bool, optional
         Whether to save an ``"output_best_fit.txt"`` in the working directory.
     errorRtol : float, optional
-        The error tolerance for the best-fit radius to stop the iterations.
+        The relative error tolerance for the unknowns to stop the
+        iterations.
     maxNumIter : int, optional
-        The maximum number of iterations for the best-fit radius.
+        The maximum number of evaluations of the residual.
     sample_size : int, optional
         If the input file containing the measured data is too big it may
         be convenient to use only a sample of it in order to calculate the
@@ -160,7 +168,7 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
     if isinstance(path, np.ndarray):
         input_pts = path.T
     else:
-        input_pts = np.loadtxt(path, unpack=True)
+        input_pts = load_txt(path, dtype='float64').T
 
     if input_pts.shape[0] != 3:
         raise ValueError('Input does not have the format: "x, y, z"')
@@ -168,12 +176,12 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
     if sample_size:
         num = input_pts.shape[1]
         if sample_size < num:
-            input_pts = input_pts[:, sample(range(num), int(sample_size))]
+            input_pts = _sample_rows(input_pts.T, sample_size).T
 
     pts = np.vstack((input_pts, np.ones_like(input_pts[0, :])))
 
     def fT(p):
-        a, b, x0, y0, z0 = p
+        a, b, x0, y0, z0 = p[:5]
         a %= 2*np.pi
         b %= 2*np.pi
         # rotation in x, y
@@ -182,56 +190,57 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
                       [sin(b), -sin(a)*cos(b),  cos(a)*cos(b), z0]])
         return T
 
-    i = 0
-    R = R_expected
-    while i <= maxNumIter:
-        i += 1
-
-        def calc_dist(p, pts):
-            T = fT(p)
-            xn, yn, zn = T.dot(pts)
-            dz = np.zeros_like(zn)
-            factor = 0.1
-            # point below the bottom edge
-            mask = zn < 0
-            dz[mask] = -zn[mask]*factor
-
-            # point inside the cylinder
-            pass
-            #dz[(zn >= 0) & (zn <= H)] *= 0
-
-            # point above the top edge
-            mask = zn > H
-            dz[mask] = (zn[mask] - H)*factor
-
-            dr = R - np.sqrt(xn**2 + yn**2)
-            dist = np.sqrt(dr**2 + dz**2)
-            return dist
-
-        # initial guess for the optimization variables
-        # the variables are alpha, beta, x0, y0, z0
-        x, y, z = input_pts
-        p = [0.5, 0.5, 2*x.mean(), 2*y.mean(), 2*z.mean()]
-
-        # performing the leastsq analysis
-        popt, pcov = leastsq(func=calc_dist, x0=p, args=(pts,),
-                             ftol=1.e-12, xtol=1.e-12, maxfev=1000000)
-        T = fT(popt)
-        output_pts = T.dot(pts)
-        x, y, z = output_pts
-        mask = (z>=0) & (z<=H)
-        R_best_fit = np.sqrt(x[mask]**2 + y[mask]**2).mean()
-        errorR = abs(R_best_fit - R)/R_best_fit
-
-        log('Iteration: {0}, R_best_fit: {1}, errorR: {2}'.format(
-            i, R_best_fit, errorR), level=1)
-
-        if errorR < errorRtol:
-            break
-        else:
-            R = R_best_fit
-    else:
-        warn('The maximum number of iterations was achieved!')
+    # penalty factor for the points beyond the edges
+    factor = 0.1
+
+    def calc_res(p, pts):
+        xn, yn, zn = fT(p).dot(pts)
+        R = p[5]
+        dr = R - np.sqrt(xn**2 + yn**2)
+        dz = factor*(np.minimum(zn, 0) + np.maximum(zn - H, 0))
+        return np.concatenate((dr, dz))
+
+    def calc_jac(p, pts):
+        a, b = p[:2]
+        x, y, z = pts[:3]
+        xn, yn, zn = fT(p).dot(pts)
+        r = np.sqrt(xn**2 + yn**2)
+        # derivatives of the transformed coordinates with respect to alpha
+        # and beta
+        dxn_da = cos(a)*sin(b)*y + sin(a)*sin(b)*z
+        dxn_db = -sin(b)*x + sin(a)*cos(b)*y - cos(a)*cos(b)*z
+        dyn_da = -sin(a)*y + cos(a)*z
+        dzn_da = -cos(a)*cos(b)*y - sin(a)*cos(b)*z
+        dzn_db = cos(b)*x + sin(a)*sin(b)*y - cos(a)*sin(b)*z
+        num = x.shape[0]
+        jac = np.zeros((6, 2*num))
+        jac[0, :num] = -(xn*dxn_da + yn*dyn_da)/r
+        jac[1, :num] = -xn*dxn_db/r
+        jac[2, :num] = -xn/r
+        jac[3, :num] = -yn/r
+        jac[5, :num] = 1.
+        outside = factor*((zn < 0) | (zn > H))
+        jac[0, num:] = outside*dzn_da
+        jac[1, num:] = outside*dzn_db
+        jac[4, num:] = outside
+        return jac
+
+    p = _guess_cylinder(input_pts, H)
+    log('Initial guess: alpha={0}, beta={1}, x0={2}, y0={3}, z0={4}, R={5}'.
+        format(*p), level=1)
+
+    popt, pcov, info, msg, ier = leastsq(func=calc_res, x0=p, args=(pts,),
+            Dfun=calc_jac, col_deriv=True, full_output=True, ftol=1.e-12,
+            xtol=errorRtol, maxfev=maxNumIter)
+    if ier not in (1, 2, 3, 4):
+        warn('The best-fit cylinder did not converge: {0}'.format(msg))
+    i = info['nfev']
+    T = fT(popt)
+    output_pts = T.dot(pts)
+    x, y, z = output_pts
+    mask = (z>=0) & (z<=H)
+    R_best_fit = np.sqrt(x[mask]**2 + y[mask]**2).mean()
+    errorR = abs(R_best_fit - popt[5])/R_best_fit
 
     alpha, beta = popt[:2]
     alpha %= 2*np.pi
@@ -254,26 +263,315 @@ def best_fit_cylinder(path, H, R_expected=10., save=True, errorRtol=1.e-9,
 
     Tinv = np.zeros_like(T)
     Tinv[:3, :3] = T[:3, :3].T
-    Tinv[:, 3] = -T[:, 3]
+    Tinv[:, 3] = -T[:3, :3].T.dot(T[:, 3])
     return dict(R_best_fit=R_best_fit,
                 input_pts=input_pts,
                 output_pts=output_pts,
                 T=T, Tinv=Tinv)
 
 
+def _sample_rows(data, sample_size):
+    # the sample is taken block by block, without creating a list with the
+    # indices of all the points
+    reservoir, = scan(data, [ReservoirSample(sample_size)], dtype=data.dtype)
+    return reservoir.sample
+
+
+def _rotation(a, b):
+    # rotation part of the transformation matrix used by the best-fit
+    # routines, the third row is the axis of the cylinder or cone
+    return np.array([[cos(b),  sin(a)*sin(b), -cos(a)*sin(b)],
+                     [     0,         cos(a),         sin(a)],
+                     [sin(b), -sin(a)*cos(b),  cos(a)*cos(b)]])
+
+
+def _guess_axis(input_pts):
+    # the principal directions of the data are the candidates for the axis
+    # and the one giving the best algebraic circle fit is taken
+    center = input_pts.mean(axis=1)
+    centered = input_pts - center[:, None]
+    vals, vecs = np.linalg.eigh(centered.dot(centered.T))
+    best = None
+    for axis in vecs.T:
+        if axis[2] < 0:
+            axis = -axis
+        # orthonormal base of the plane normal to the axis
+        e1 = np.cross(axis, [1., 0, 0] if abs(axis[0]) < 0.9 else [0, 1., 0])
+        e1 /= np.linalg.norm(e1)
+        e2 = np.cross(axis, e1)
+        u = e1.dot(centered)
+        v = e2.dot(centered)
+        # algebraic circle fit: u**2 + v**2 = 2*uc*u + 2*vc*v + c
+        A = np.vstack((2*u, 2*v, np.ones_like(u))).T
+        (uc, vc, c), res, rank, sv = np.linalg.lstsq(A, u**2 + v**2,
+                                                     rcond=None)
+        R = np.sqrt(c + uc**2 + vc**2)
+        error = np.std(np.sqrt((u - uc)**2 + (v - vc)**2))/R
+        if best is None or error < best[0]:
+            best = (error, axis, center + uc*e1 + vc*e2, R)
+    error, axis, center, R = best
+    return axis, center, R
+
+
+def _axis_angles(axis):
+    # angles alpha and beta giving a rotation whose third row is the axis
+    b = np.arcsin(np.clip(axis[0], -1, 1))
+    a = np.arctan2(-axis[1], axis[2])
+    return a, b
+
+
+def _guess_cylinder(input_pts, H):
+    axis, center, R = _guess_axis(input_pts)
+    a, b = _axis_angles(axis)
+    T = _rotation(a, b)
+    x0, y0 = -T[:2].dot(center)
+    # the data is centered along the height
+    zn = T[2].dot(input_pts)
+    z0 = H/2. - (zn.min() + zn.max())/2.
+    return np.array([a, b, x0, y0, z0, R])
+
+
+def _guess_cone(input_pts, H):
+    axis, center, R = _guess_axis(input_pts)
+    # linear fit of the radius along the axis, which must decrease from the
+    # bottom to the top edge
+    centered = input_pts - center[:, None]
+    s = axis.dot(centered)
+    r = np.sqrt(np.maximum((centered**2).sum(axis=0) - s**2, 0))
+    slope, intercept = np.polyfit(s, r, 1)
+    if slope > 0:
+        axis = -axis
+        slope = -slope
+    a, b = _axis_angles(axis)
+    T = _rotation(a, b)
+    x0, y0 = -T[:2].dot(center)
+    # the data is centered at half height, where s is null
+    R = intercept - slope*H/2.
+    return np.array([a, b, x0, y0, R, np.arctan(-slope)])
+
+
+def _orient_cone(p, H):
+    # the residual of best_fit_cone has a mirrored solution with the axis
+    # pointing from the top to the bottom edge, a negative semi-vertex angle
+    # and the top radius as R. The axis is flipped by a+pi and b->-b, which
+    # negates the second and third rows of the rotation, such that the
+    # radius always decreases from z=0 to z=H
+    p = np.array(p, dtype=float)
+    if p[5] < 0:
+        p[0] += np.pi
+        p[1] = -p[1]
+        p[3] = -p[3]
+        p[4] = p[4] - H*np.tan(p[5])
+        p[5] = -p[5]
+    return p
+
+
 def best_fit_cone(path, H, alphadeg, R_expected=10., save=True,
-        errorRtol=1.e-9, maxNumIter=1000, sample_size=None):
+        errorRtol=1.e-9, maxNumIter=1000, sample_size=None, refine=True):
     r"""Fit a best cone for a given set of measured data
 
-    .. note:: NOT IMPLEMENTED YET
+    The coordinate transformation follows the same convention of
+    :func:`.best_fit_cylinder`, where the `z` axis of the :ref:`reference
+    coordinate system <figure_conecyl>` is the axis of the cone and the
+    radius decreases from the bottom (`z=0`) to the top edge (`z=H`).
+
+    The unknowns are the rotation angles `\alpha` and `\beta`, the
+    translations `\Delta x_0` and `\Delta y_0`, the bottom radius `R` and
+    the semi-vertex angle `\alpha_{cone}`. They are calculated in a single
+    non-linear least-squares problem (solved with ``scipy.optimize.leastsq``
+    using an analytical Jacobian), where the residual is the distance
+    of each point to the cone surface, normal to the surface:
+
+    .. math::
+        \Delta r = \left(R - z_{ref} tan(\alpha_{cone})
+                    - \sqrt{x_{ref}^2 + y_{ref}^2}\right) cos(\alpha_{cone})
+
+    plus the penalty `\Delta z` for the points beyond the edges, defined in
+    :func:`.best_fit_cylinder`. A translation `\Delta z_0` along the axis
+    cannot be distinguished from a change in the bottom radius and
+    therefore it is not an unknown, the data is always centered at half
+    height.
+
+    The initial guess is obtained in closed form, as in
+    :func:`.best_fit_cylinder`, with the semi-vertex angle obtained from a
+    linear fit of the radius along the axis.
+
+    Parameters
+    ----------
+    path : str or np.ndarray
+        The path of the file containing the data. Can be a full path using
+        ``r"C:\Temp\inputfile.txt"``, for example.
+        The input file must have 3 columns "`x` `y` `z`" expressed
+        in Cartesian coordinates.
+
+        This input can also be a ``np.ndarray`` object, with `x`, `y`, `z`
+        in each corresponding column.
+    H : float
+        The nominal height of the cone.
+    alphadeg : float
+        The nominal semi-vertex angle of the cone, in degrees. Used only to
+        check the best-fit result.
+    R_expected : float, optional
+        The nominal bottom radius of the cone. Kept for backward
+        compatibility, the first guess is obtained from the data.
+    save : bool, optional
+        Whether to save an ``"output_best_fit.txt"`` in the working directory.
+    errorRtol : float, optional
+        The relative error tolerance for the unknowns to stop the
+        iterations.
+    maxNumIter : int, optional
+        The maximum number of evaluations of the residual.
+    sample_size : int, optional
+        If the input file containing the measured data is too big it may
+        be convenient to use only a sample of it in order to calculate the
+        best fit.
+    refine : bool, optional
+        If ``sample_size`` is given, the best fit obtained with the sample
+        is used as initial guess for a second solution using all the
+        points, which usually requires very few iterations.
+
+    Returns
+    -------
+    out : dict
+        A Python dictionary with the same entries described in
+        :func:`.best_fit_cylinder`, where ``out['R_best_fit']`` is the
+        bottom radius, and the additional entry:
+
+        ``out['alphadeg_best_fit']`` : float
+            The best-fit semi-vertex angle in degrees.
 
     """
-    raise NotImplementedError('Function not implemented yet!')
+    from scipy.optimize import leastsq
+
+    if isinstance(path, np.ndarray):
+        input_pts = path.T
+    else:
+        input_pts = load_txt(path, dtype='float64').T
+
+    if input_pts.shape[0] != 3:
+        raise ValueError('Input does not have the format: "x, y, z"')
+
+    all_pts = input_pts
+    if sample_size:
+        num = input_pts.shape[1]
+        if sample_size < num:
+            input_pts = _sample_rows(input_pts.T, sample_size).T
+        else:
+            refine = False
+    else:
+        refine = False
+
+    # penalty factor for the points beyond the edges
+    factor = 0.1
+
+    def fT(p, pts):
+        a, b, x0, y0 = p[:4]
+        T = np.zeros((3, 4))
+        T[:, :3] = _rotation(a, b)
+        T[:, 3] = x0, y0, 0.
+        # the data is centered at half height
+        T[2, 3] = H/2. - T[2].dot(pts).mean()
+        return T
+
+    def calc_res(p, pts):
+        xn, yn, zn = fT(p, pts).dot(pts)
+        R, alpha = p[4:]
+        dr = (R - zn*np.tan(alpha) - np.sqrt(xn**2 + yn**2))*cos(alpha)
+        dz = factor*(np.minimum(zn, 0) + np.maximum(zn - H, 0))
+        return np.concatenate((dr, dz))
+
+    def calc_jac(p, pts):
+        a, b, x0, y0, R, alpha = p
+        x, y, z = pts[:3]
+        xn, yn, zn = fT(p, pts).dot(pts)
+        r = np.sqrt(xn**2 + yn**2)
+        # derivatives of the transformed coordinates with respect to alpha
+        # and beta, zn is centered and so are its derivatives
+        dxn_da = cos(a)*sin(b)*y + sin(a)*sin(b)*z
+        dxn_db = -sin(b)*x + sin(a)*cos(b)*y - cos(a)*cos(b)*z
+        dyn_da = -sin(a)*y + cos(a)*z
+        dzn_da = -cos(a)*cos(b)*y - sin(a)*cos(b)*z
+        dzn_db = cos(b)*x + sin(a)*sin(b)*y - cos(a)*sin(b)*z
+        dzn_da -= dzn_da.mean()
+        dzn_db -= dzn_db.mean()
+        tana = np.tan(alpha)
+        cosa = cos(alpha)
+        num = x.shape[0]
+        jac = np.zeros((6, 2*num))
+        jac[0, :num] = -(tana*dzn_da + (xn*dxn_da + yn*dyn_da)/r)*cosa
+        jac[1, :num] = -(tana*dzn_db + xn*dxn_db/r)*cosa
+        jac[2, :num] = -xn/r*cosa
+        jac[3, :num] = -yn/r*cosa
+        jac[4, :num] = cosa
+        jac[5, :num] = -zn/cosa - (R - zn*tana - r)*sin(alpha)
+        outside = factor*((zn < 0) | (zn > H))
+        jac[0, num:] = outside*dzn_da
+        jac[1, num:] = outside*dzn_db
+        return jac
+
+    p = _guess_cone(input_pts, H)
+    log('Initial guess: alpha={0}, beta={1}, x0={2}, y0={3}, R={4}, '
+        'alphadeg={5}'.format(*(list(p[:5]) + [np.rad2deg(p[5])])), level=1)
+
+    steps = [input_pts, all_pts] if refine else [input_pts]
+    i = 0
+    for input_pts in steps:
+        pts = np.vstack((input_pts, np.ones_like(input_pts[0, :])))
+        p, pcov, info, msg, ier = leastsq(func=calc_res, x0=p, args=(pts,),
+                Dfun=calc_jac, col_deriv=True, full_output=True,
+                ftol=1.e-12, xtol=errorRtol, maxfev=maxNumIter)
+        if ier not in (1, 2, 3, 4):
+            warn('The best-fit cone did not converge: {0}'.format(msg))
+        p = _orient_cone(p, H)
+        i += info['nfev']
+        log('Best fit using {0} points, numiter: {1}'.format(
+            input_pts.shape[1], info['nfev']), level=1)
+    T = fT(p, pts)
+    output_pts = T.dot(pts)
+    x, y, z = output_pts
+    R_best_fit = p[4]
+    alphadeg_best_fit = np.rad2deg(p[5])
+    if alphadeg_best_fit*alphadeg < 0:
+        raise ValueError('The best-fit semi-vertex angle {0} and the nominal '
+                         'value {1} have opposite signs'.format(
+                         alphadeg_best_fit, alphadeg))
+    if abs(alphadeg_best_fit - alphadeg) > max(1., 0.1*abs(alphadeg)):
+        warn('The best-fit semi-vertex angle {0} differs from the nominal '
+             'value {1}'.format(alphadeg_best_fit, alphadeg))
+
+    alpha, beta = p[:2]
+    alpha %= 2*np.pi
+    beta %= 2*np.pi
+    log('')
+    log('Transformation matrix:\n{0}'.format(T))
+    log('')
+    log('Z versor: {0}*i + {1}*j + {2}*k'.format(*T[-1,:-1]))
+    log('')
+    log('alpha: {0} rad; beta: {1} rad'.format(alpha, beta))
+    log('')
+    log('x0, y0, z0: {0}, {1}, {2}'.format(*T[:,-1]))
+    log('')
+    log('Best fit bottom radius: {0}'.format(R_best_fit))
+    log('Best fit semi-vertex angle: {0} deg'.format(alphadeg_best_fit))
+    log('    numiter: {0}'.format(i))
+    log('')
+
+    if save:
+        np.savetxt('output_best_fit.txt', np.vstack((x, y, z)).T)
+
+    Tinv = np.zeros_like(T)
+    Tinv[:3, :3] = T[:3, :3].T
+    Tinv[:, 3] = -T[:3, :3].T.dot(T[:, 3])
+    return dict(R_best_fit=R_best_fit,
+                alphadeg_best_fit=alphadeg_best_fit,
+                input_pts=input_pts,
+                output_pts=output_pts,
+                T=T, Tinv=Tinv)
 
 
 def calc_c0(path, m0=50, n0=50, funcnum=2, fem_meridian_bot2top=True,
         rotatedeg=None, filter_m0=None, filter_n0=None, sample_size=None,
-        maxmem=8):
+        maxmem=8, solver='lstsq', grid_shape=None):
     r"""Find the coefficients that best fit the `w_0` imperfection
 
     The measured data will be fit using one of the following functions,
@@ -355,12 +653,48 @@ def calc_c0(path, m0=50, n0=50, funcnum=2, fem_meridian_bot2top=True,
         computations.
     maxmem : int, optional
         Maximum RAM memory in GB allowed to compute the base functions.
-        The ``scipy.interpolate.lstsq`` will go beyond this limit.
+        With ``solver='lstsq'`` the measured points are randomly sampled to
+        respect this limit and the ``scipy.interpolate.lstsq`` will go
+        beyond it. The other solvers process all points in chunks that fit
+        in this limit.
+    solver : str, optional
+        The least-squares solver:
+
+        - ``'lstsq'`` (default): builds the full matrix `[g]` and calls
+          ``scipy.linalg.lstsq``
+        - ``'normal'``: accumulates `[g]^T[g]` and `[g]^T\{w_0\}` chunk by
+          chunk and solves the normal equations using a Cholesky
+          decomposition. The memory depends only on the number of
+          coefficients
+        - ``'tsqr'``: updates the triangular factor of a QR decomposition
+          chunk by chunk (tall-skinny QR). Slower than ``'normal'`` but
+          does not square the condition number of `[g]`
+        - ``'spectral'``: for points on a `\theta`, `z` grid, uses a real
+          FFT along `\theta` and a DCT (``funcnum=2``) or a DST
+          (``funcnum=1``) along `z`, with a cost of `O(N \log N)`. When the
+          grid lines along `z` are not equally spaced, or for
+          ``funcnum=3``, a least-squares fit is used along `z`, shared by
+          all the `\theta` terms. Along `z` the DCT and the DST correspond
+          to the trapezoidal rule, giving half weight to the first and the
+          last grid lines
+
+        The condition number of `[g]` (estimated when ``solver='normal'``)
+        and the root mean square of the residual are reported in the log.
+    grid_shape : tuple or None, optional
+        Used with ``solver='spectral'``. The number of grid lines
+        ``(num_z, num_theta)`` of an equally spaced grid where the input
+        points are resampled. Gridded input is resampled using
+        :func:`.interp_grid` and scattered input using a linear
+        interpolation over a Delaunay triangulation. If ``None``, the input
+        must lie on a grid (see :func:`.detect_grid`), which is resampled
+        only if not equally spaced along `\theta`.
 
     Returns
     -------
-    out : np.ndarray
-        A 1-D array with the best-fit coefficients.
+    out : tuple
+        A 1-D array with the best-fit coefficients and the sum of the
+        squared residuals. With ``solver='spectral'`` the residuals are
+        computed at the grid points.
 
     Notes
     -----
@@ -375,17 +709,7 @@ def calc_c0(path, m0=50, n0=50, funcnum=2, fem_meridian_bot2top=True,
     """
     from scipy.linalg import lstsq
 
-    if isinstance(path, np.ndarray):
-        input_pts = path
-        path = 'unmamed.txt'
-    else:
-        input_pts = np.loadtxt(path)
-
-    if input_pts.shape[1] != 3:
-        raise ValueError('Input does not have the format: "theta, z, imp"')
-    if (input_pts[:,0].min() < -2*np.pi or input_pts[:,0].max() > 2*np.pi):
-        raise ValueError(
-                'In the input: "theta, z, imp"; "theta" must be in radians!')
+    path, input_pts = _read_c0_input(path)
 
     log('Finding c0 coefficients for {0}'.format(str(os.path.basename(path))))
     log('using funcnum {0}'.format(funcnum), level=1)
@@ -410,11 +734,246 @@ def calc_c0(path, m0=50, n0=50, funcnum=2, fem_meridian_bot2top=True,
 
     maxnum = int(maxmem*1024*1024*1024*8/(64.*size*m0*n0)/memfac)
     num = input_pts.shape[0]
-    if num >= maxnum:
-        input_pts = input_pts[sample(range(num), int(maxnum))]
-        warn('Using {0} measured points due to the "maxmem" specified'.
-                format(maxnum), level=1)
+    if solver == 'lstsq':
+        if num >= maxnum:
+            input_pts = input_pts[sample(range(num), int(maxnum))]
+            warn('Using {0} measured points due to the "maxmem" specified'.
+                    format(maxnum), level=1)
+    elif solver not in ('normal', 'tsqr', 'spectral'):
+        raise ValueError('Valid values for "solver" are "normal", "tsqr", '
+                         '"lstsq" or "spectral"')
+
+    ts, zs, w0pts = _normalize_c0_input(input_pts, rotatedeg,
+                                        fem_meridian_bot2top)
+
+    num = w0pts.shape[0]
+    cond = None
+    if solver == 'spectral':
+        c0, residues, num = _spectral_c0(m0, n0, ts, zs, w0pts, funcnum,
+                                         grid_shape)
+        log('Finished the "spectral" solver', level=1)
+    elif solver == 'lstsq':
+        a = fa(m0, n0, zs, ts, funcnum)
+
+        log('Base functions calculated', level=1)
+        c0, residues, rank, s = lstsq(a, w0pts)
+        log('Finished scipy.linalg.lstsq', level=1)
+        cond = _cond(s, a.shape)
+        if np.size(residues) == 0:
+            residues = np.sum((a.dot(c0) - w0pts)**2)
+    else:
+        # the chunk must be taller than wide for the QR updates
+        chunksize = max(maxnum, size*m0*n0 + 1)
+        if solver == 'normal':
+            c0, residues, cond = _lstsq_normal(m0, n0, zs, ts, w0pts,
+                                               funcnum, chunksize)
+        else:
+            c0, residues, cond = _lstsq_tsqr(m0, n0, zs, ts, w0pts,
+                                             funcnum, chunksize)
+        log('Finished the "{0}" least-squares solver using {1} points'.
+            format(solver, w0pts.shape[0]), level=1)
+    if cond is not None:
+        log('Condition number: {0:1.3e}'.format(cond), level=1)
+    log('Residual RMS    : {0:1.6e}'.format(
+        np.sqrt(float(residues)/num)), level=1)
+
+    if filter_m0 is not None or filter_n0 is not None:
+        c0 = filter_c0(m0, n0, c0, filter_m0, filter_n0, funcnum=funcnum)
+
+    return c0, residues
+
+
+def select_c0_order(path, m0_max, n0_max, folds=5, funcnum=2,
+        fem_meridian_bot2top=True, rotatedeg=None, sample_size=None,
+        maxmem=8, seed=None):
+    r"""Select the number of terms ``m0`` and ``n0`` by cross-validation
+
+    The measured points are split in ``folds`` random groups and the normal
+    equations `[g]^T[g]` and `[g]^T\{w_0\}` of the largest approximation
+    (``m0_max``, ``n0_max``) are accumulated for each group in a single
+    pass over the data. The coefficients of a lower order approximation
+    are a subset of those of the largest one, such that all pairs
+    (``m0``, ``n0``) are evaluated from these matrices without building the
+    base functions again. Since the coefficients are ordered with ``n0``
+    varying slowest, one Cholesky decomposition for each ``m0`` (and for
+    each fold) gives all the values of ``n0`` from its leading blocks.
 
+    Each fold is left out in turn, the coefficients are fit using the
+    other folds and the squared error is measured at the left out points.
+
+    Parameters
+    ----------
+    path : str or np.ndarray
+        The path of the file containing the data, or a ``np.ndarray``
+        object, with `\theta`, `z`, `imp` in each column (see
+        :func:`.calc_c0`).
+    m0_max : int
+        Maximum number of terms along the meridian (`z`).
+    n0_max : int
+        Maximum number of terms along the circumference (`\theta`).
+    folds : int, optional
+        Number of groups used in the cross-validation.
+    funcnum : int, optional
+        The base functions used for the approximation (see
+        :func:`.calc_c0`).
+    fem_meridian_bot2top : bool, optional
+        See :func:`.calc_c0`.
+    rotatedeg : float or None, optional
+        See :func:`.calc_c0`.
+    sample_size : int or None, optional
+        Number of measured points that should be used. If ``None`` all
+        points are used.
+    maxmem : int, optional
+        Maximum RAM memory in GB allowed to compute the base functions,
+        which are processed in chunks. The normal equations of each fold
+        take additionally ``8*folds*(size*m0_max*n0_max)**2`` bytes.
+    seed : int or None, optional
+        Seed used to split the points in folds.
+
+    Returns
+    -------
+    out : dict
+        A dictionary with the keys:
+
+        - ``'m0'``, ``'n0'``: the selected order, with the smallest
+          cross-validation error
+        - ``'residues'``: array with shape ``(m0_max, n0_max)`` with the
+          root mean square of the residual when all points are used in the
+          fit, position ``[m0-1, n0-1]`` corresponds to the pair
+          (``m0``, ``n0``)
+        - ``'cv_errors'``: array with shape ``(m0_max, n0_max)`` with the
+          root mean square of the cross-validation error
+
+        Pairs leading to singular normal equations have ``np.nan`` values.
+
+    """
+    from scipy.linalg import solve_triangular
+    from scipy.linalg.lapack import get_lapack_funcs
+
+    path, input_pts = _read_c0_input(path)
+
+    log('Selecting the c0 order for {0}'.format(
+        str(os.path.basename(path))))
+    log('using funcnum {0}, m0_max {1}, n0_max {2} and {3} folds'.format(
+        funcnum, m0_max, n0_max, folds), level=1)
+
+    if sample_size:
+        num = input_pts.shape[0]
+        if sample_size < num:
+            input_pts = input_pts[sample(range(num), int(sample_size))]
+
+    if funcnum==1:
+        size = 2
+    elif funcnum==2:
+        size = 2
+    elif funcnum==3:
+        size = 4
+    else:
+        raise ValueError('Valid values for "funcnum" are 1, 2 or 3')
+    if folds < 2:
+        raise ValueError('At least 2 folds are required')
+
+    ts, zs, w0pts = _normalize_c0_input(input_pts, rotatedeg,
+                                        fem_meridian_bot2top)
+    num = w0pts.shape[0]
+    fold = np.random.RandomState(seed).permutation(num) % folds
+
+    ncoef = size*m0_max*n0_max
+    memfac = 2.2
+    chunksize = max(int(maxmem*1024*1024*1024*8/(64.*ncoef)/memfac), 1)
+    ata = np.zeros((folds, ncoef, ncoef))
+    atw = np.zeros((folds, ncoef))
+    wtw = np.zeros(folds)
+    for i in range(0, num, chunksize):
+        a = fa(m0_max, n0_max, zs[i:i+chunksize], ts[i:i+chunksize],
+               funcnum)
+        w = w0pts[i:i+chunksize]
+        f = fold[i:i+chunksize]
+        for k in range(folds):
+            ak = a[f==k]
+            ata[k] += ak.T.dot(ak)
+            atw[k] += ak.T.dot(w[f==k])
+            wtw[k] += w[f==k].dot(w[f==k])
+        del a, ak
+        log('processed {0:7d} out of {1:7d} points'.format(
+            min(i+chunksize, num), num), level=2)
+    ata_all = ata.sum(axis=0)
+    atw_all = atw.sum(axis=0)
+    wtw_all = wtw.sum()
+
+    potrf, = get_lapack_funcs(('potrf',), (ata_all,))
+
+    def leading_solves(g, b):
+        # the factor of a leading block of g is the leading block of the
+        # factor of g, the leading minor where the decomposition failed
+        # limits the orders that can be solved
+        L, info = potrf(g, lower=1, clean=1)
+        valid = info - 1 if info > 0 else g.shape[0]
+        y = solve_triangular(L[:valid, :valid], b[:valid], lower=True)
+        return L, y, valid
+
+    # the (m0, n0) approximation uses the columns of the largest one with
+    # i < m0 and j < n0, the base functions that vanish at all points are
+    # left out as in calc_c0
+    cols = np.arange(ncoef).reshape(n0_max, m0_max, size)
+    active = np.diag(ata_all) > 0
+    residues = np.zeros((m0_max, n0_max)) + np.nan
+    cv_errors = np.zeros((m0_max, n0_max)) + np.nan
+    for m0 in range(1, m0_max+1):
+        sub = cols[:, :m0, :]
+        ends = np.cumsum(active[sub].reshape(n0_max, -1).sum(axis=1))
+        sub = sub.ravel()[active[sub.ravel()]]
+        g = ata_all[np.ix_(sub, sub)]
+        L, y, valid = leading_solves(g, atw_all[sub])
+        ok = (ends <= valid) & (ends > 0)
+        y2 = np.concatenate(([0.], np.cumsum(y**2)))
+        residues[m0-1, ok] = np.sqrt(np.maximum(
+            wtw_all - y2[ends[ok]], 0.)/num)
+        err = np.zeros(n0_max)
+        for k in range(folds):
+            gk = ata[k][np.ix_(sub, sub)]
+            bk = atw[k][sub]
+            L, y, valid = leading_solves(g - gk, atw_all[sub] - bk)
+            ok &= ends <= valid
+            for n0 in np.nonzero(ok)[0]:
+                e = ends[n0]
+                c = solve_triangular(L[:e, :e], y[:e], lower=True,
+                                     trans='T')
+                err[n0] += (wtw[k] - 2*c.dot(bk[:e])
+                            + c.dot(gk[:e, :e].dot(c)))
+        cv_errors[m0-1, ok] = np.sqrt(np.maximum(err[ok], 0.)/num)
+        log('m0 = {0:3d} evaluated'.format(m0), level=2)
+
+    if np.all(np.isnan(cv_errors)):
+        raise RuntimeError('Singular normal equations for all orders')
+    m0, n0 = np.unravel_index(np.nanargmin(cv_errors), cv_errors.shape)
+    m0 += 1
+    n0 += 1
+    log('Selected m0 = {0}, n0 = {1}'.format(m0, n0), level=1)
+    log('Residual RMS    : {0:1.6e}'.format(residues[m0-1, n0-1]), level=1)
+    log('CV error RMS    : {0:1.6e}'.format(cv_errors[m0-1, n0-1]), level=1)
+
+    return dict(m0=int(m0), n0=int(n0), residues=residues,
+                cv_errors=cv_errors)
+
+
+def _read_c0_input(path):
+    if isinstance(path, np.ndarray):
+        input_pts = path
+        path = 'unmamed.txt'
+    else:
+        input_pts = load_txt(path, dtype='float64')
+
+    if input_pts.shape[1] != 3:
+        raise ValueError('Input does not have the format: "theta, z, imp"')
+    if (input_pts[:,0].min() < -2*np.pi or input_pts[:,0].max() > 2*np.pi):
+        raise ValueError(
+                'In the input: "theta, z, imp"; "theta" must be in radians!')
+
+    return path, input_pts
+
+
+def _normalize_c0_input(input_pts, rotatedeg, fem_meridian_bot2top):
     ts = input_pts[:, 0].copy()
     if rotatedeg is not None:
         ts += deg2rad(rotatedeg)
@@ -428,16 +987,194 @@ def calc_c0(path, m0=50, n0=50, funcnum=2, fem_meridian_bot2top=True,
         zs *= -1
         zs += 1
 
-    a = fa(m0, n0, zs, ts, funcnum)
+    return ts, zs, w0pts
+
+
+def _lstsq_normal(m0, n0, zs, ts, w0pts, funcnum, chunksize):
+    from scipy.linalg import cho_factor, cho_solve, lstsq, LinAlgError
+    from scipy.linalg.lapack import get_lapack_funcs
+
+    num = w0pts.shape[0]
+    ata = None
+    for i in range(0, num, chunksize):
+        a = fa(m0, n0, zs[i:i+chunksize], ts[i:i+chunksize], funcnum)
+        if ata is None:
+            ata = np.zeros((a.shape[1], a.shape[1]))
+            atw = np.zeros(a.shape[1])
+        ata += a.T.dot(a)
+        atw += a.T.dot(w0pts[i:i+chunksize])
+        del a
+        log('processed {0:7d} out of {1:7d} points'.format(
+            min(i+chunksize, num), num), level=2)
+    wtw = w0pts.dot(w0pts)
+    # base functions that vanish at all points, e.g. sin(0*theta), are
+    # left out of the system and get a zero coefficient, as in the
+    # minimum-norm solution of scipy.linalg.lstsq
+    active = np.diag(ata) > 0
+    ata_act = ata[np.ix_(active, active)]
+    c0 = np.zeros(ata.shape[0])
+    try:
+        factor = cho_factor(ata_act)
+        c0[active] = cho_solve(factor, atw[active])
+        pocon, = get_lapack_funcs(('pocon',), (ata_act,))
+        rcond, info = pocon(factor[0], np.abs(ata_act).sum(axis=0).max(),
+                            uplo='L' if factor[1] else 'U')
+        cond = np.sqrt(1./rcond) if rcond > 0 else np.inf
+    except LinAlgError:
+        warn('Singular normal equations, using scipy.linalg.lstsq instead',
+             level=1)
+        c0[active], r, rank, s = lstsq(ata_act, atw[active])
+        cond = np.sqrt(_cond(s, ata_act.shape))
+    residues = max(wtw - c0.dot(atw), 0.)
+
+    return c0, residues, cond
 
-    log('Base functions calculated', level=1)
-    c0, residues, rank, s = lstsq(a, w0pts)
-    log('Finished scipy.linalg.lstsq', level=1)
 
-    if filter_m0 is not None or filter_n0 is not None:
-        c0 = filter_c0(m0, n0, c0, filter_m0, filter_n0, funcnum=funcnum)
+def _lstsq_tsqr(m0, n0, zs, ts, w0pts, funcnum, chunksize):
+    from scipy.linalg import lstsq
 
-    return c0, residues
+    num = w0pts.shape[0]
+    r = None
+    for i in range(0, num, chunksize):
+        a = fa(m0, n0, zs[i:i+chunksize], ts[i:i+chunksize], funcnum)
+        aw = np.column_stack((a, w0pts[i:i+chunksize]))
+        del a
+        if r is not None:
+            aw = np.vstack((r, aw))
+        r = np.linalg.qr(aw, mode='r')
+        del aw
+        log('processed {0:7d} out of {1:7d} points'.format(
+            min(i+chunksize, num), num), level=2)
+    # the last column of the triangular factor carries the projection of
+    # the measured values and the norm of the residual, the base functions
+    # that vanish at all points have null columns and are left out
+    ncoef = r.shape[1] - 1
+    active = np.abs(r[:, :ncoef]).max(axis=0) > 0
+    c0 = np.zeros(ncoef)
+    c0[active], res, rank, s = lstsq(r[:, :ncoef][:, active], r[:, ncoef])
+    residues = np.sum((r[:, :ncoef].dot(c0) - r[:, ncoef])**2)
+    cond = _cond(s, (num, active.sum()))
+
+    return c0, residues, cond
+
+
+def _spectral_c0(m0, n0, ts, zs, w0pts, funcnum, grid_shape):
+    from scipy.fftpack import dct, dst
+    from scipy.linalg import lstsq
+
+    zfuncs, tfuncs, ivals, _ = _separable_basis(m0, n0, None, funcnum)
+    size = len(zfuncs)
+    thetas, z_vals, values = _spectral_grid(ts, zs, w0pts, grid_shape)
+    nz, nt = values.shape
+    if 2*(n0 - 1) >= nt:
+        raise ValueError('The grid has {0} points along theta, at least {1} '
+                         'are required for n0={2}'.format(nt, 2*n0 - 1, n0))
+
+    # along theta the base functions are orthogonal at equally spaced
+    # points and the least-squares coefficients of each grid line come from
+    # a real FFT, shifted to the angle of the first grid column
+    f = np.fft.rfft(values, axis=1)[:, :n0]*(2./nt)
+    f *= np.exp(-1j*np.arange(n0)*thetas[0])
+    f[:, 0] /= 2
+    g = np.hstack((-f.imag, f.real))
+    tcols = {sin: 0, cos: n0}
+
+    # along z the coefficients come from a DCT-I (half-cosine) or a DST-I
+    # (half-sine) for equally spaced lines, otherwise from a least-squares
+    # fit shared by all the theta terms
+    uniform = np.allclose(np.diff(z_vals), 1./(nz - 1), rtol=0, atol=1.e-5)
+    if uniform and funcnum == 2 and m0 <= nz:
+        x = dct(g, type=1, axis=0)/(nz - 1)
+        x[0] /= 2
+        x[nz-1] /= 2
+        zfuncs_unique = [cos]
+    elif uniform and funcnum == 1 and m0 <= nz - 2:
+        x = dst(g[1:nz-1], type=1, axis=0)/(nz - 1)
+        zfuncs_unique = [sin]
+    else:
+        zfuncs_unique = [fz for fz in (sin, cos) if fz in zfuncs]
+        iz = np.outer(pi*z_vals, ivals)
+        zmat = np.hstack([fz(iz) for fz in zfuncs_unique])
+        x, res, rank, s = lstsq(zmat, g)
+        x = x.reshape(len(zfuncs_unique), m0, 2*n0)
+    if x.ndim == 2:
+        x = x[:m0][None, :, :]
+    c0 = np.zeros((n0, m0, size))
+    for k, (fz, ft) in enumerate(zip(zfuncs, tfuncs)):
+        col = tcols[ft]
+        c0[:, :, k] = x[zfuncs_unique.index(fz), :, col:col+n0].T
+    c0 = c0.ravel()
+
+    residues = np.sum((fw0_grid(m0, n0, c0, z_vals, thetas, funcnum)
+                       - values)**2)
+
+    return c0, residues, values.size
+
+
+def _spectral_grid(ts, zs, w0pts, grid_shape):
+    from desicos.conecylDB.interpolate import detect_grid, interp_grid
+
+    grid = detect_grid(np.column_stack((ts, zs, w0pts)))
+    if grid is not None:
+        thetas, z_vals, values = grid
+        nt = thetas.shape[0]
+        # the grid coordinates are rounded by detect_grid
+        iz = np.searchsorted((z_vals[1:] + z_vals[:-1])/2, zs)
+        z_vals = np.bincount(iz, weights=zs)/np.bincount(iz)
+        dt = 2*pi/nt
+        if (grid_shape is None
+            and np.allclose(np.diff(thetas), dt, rtol=0, atol=1.e-5*2*pi)):
+            k = np.round((ts - thetas[0])/dt)
+            t0 = thetas[0] + np.mean(ts - thetas[0] - k*dt)
+            log('Using the {0} x {1} grid of the input'.format(*values.shape),
+                level=1)
+            return t0 + dt*np.arange(nt), z_vals, values
+        if grid_shape is None:
+            grid_shape = values.shape
+    elif grid_shape is None:
+        raise ValueError('The input points do not lie on a grid, use '
+                         '"grid_shape" to resample them')
+
+    nz, nt = grid_shape
+    theta_new = np.linspace(-pi, pi, nt, endpoint=False)
+    z_new = np.linspace(0., 1., nz)
+    tq, zq = np.meshgrid(theta_new, z_new)
+    if grid is not None:
+        values = interp_grid(thetas, z_vals, values, tq, zq)
+    else:
+        values = _scattered_to_grid(ts, zs, w0pts, tq, zq)
+    log('Input resampled to a {0} x {1} grid'.format(nz, nt), level=1)
+
+    return theta_new, z_new, values
+
+
+def _scattered_to_grid(ts, zs, w0pts, tq, zq):
+    from scipy.interpolate import griddata
+
+    # periodicity in theta by copying the points close to -pi and pi, theta
+    # is scaled to have the same range as the normalized z
+    ts = (ts + pi) % (2*pi) - pi
+    pad = 0.1*2*pi
+    left = ts > pi - pad
+    right = ts < -pi + pad
+    pts = np.column_stack((
+        np.concatenate((ts, ts[left] - 2*pi, ts[right] + 2*pi))/(2*pi),
+        np.concatenate((zs, zs[left], zs[right]))))
+    vals = np.concatenate((w0pts, w0pts[left], w0pts[right]))
+    values = griddata(pts, vals, (tq/(2*pi), zq), method='linear')
+    outside = np.isnan(values)
+    if np.any(outside):
+        values[outside] = griddata(pts, vals, (tq[outside]/(2*pi),
+                                   zq[outside]), method='nearest')
+
+    return values
+
+
+def _cond(s, shape):
+    # condition number neglecting the singular values that would be
+    # considered null by a rank-revealing solver
+    s = s[s > s[0]*np.finfo(float).eps*max(shape)]
+    return s[0]/s[-1]
 
 
 def filter_c0(m0, n0, c0, filter_m0, filter_n0, funcnum=2):
@@ -525,38 +1262,29 @@ def fa(m0, n0, zs_norm, thetas, funcnum=2):
     funcnum : int, optional
         The function used for the approximation (see function :func:`.calc_c0`)
 
+    Notes
+    -----
+    The matrix is computed by the active backend of the ``'fa'`` kernel,
+    see :mod:`desicos.conecylDB.kernels`.
+
     """
-    try:
-        import _fit_data
-        return _fit_data.fa(m0, n0, zs_norm, thetas, funcnum)
-    except:
-        warn('_fit_data.pyx could not be imported, executing in Python/NumPy'
-                + '\n\t\tThis mode is slower and needs more memory than the'
-                + '\n\t\tPython/NumPy/Cython mode',
-             level=1)
-        zs = zs_norm.ravel()
-        ts = thetas.ravel()
-        n = zs.shape[0]
-        zsmin = zs.min()
-        zsmax = zs.max()
-        if zsmin < 0 or zsmax > 1:
-            log('zs.min()={0}'.format(zsmin))
-            log('zs.max()={0}'.format(zsmax))
-            raise ValueError('The zs array must be normalized!')
-        if funcnum==1:
-            a = np.array([[sin(i*pi*zs)*sin(j*ts), sin(i*pi*zs)*cos(j*ts)]
-                           for j in range(n0) for i in range(1, m0+1)])
-            a = a.swapaxes(0,2).swapaxes(1,2).reshape(n,-1)
-        elif funcnum==2:
-            a = np.array([[cos(i*pi*zs)*sin(j*ts), cos(i*pi*zs)*cos(j*ts)]
-                           for j in range(n0) for i in range(m0)])
-            a = a.swapaxes(0,2).swapaxes(1,2).reshape(n,-1)
-        elif funcnum==3:
-            a = np.array([[sin(i*pi*zs)*sin(j*ts), sin(i*pi*zs)*cos(j*ts),
-                           cos(i*pi*zs)*sin(j*ts), cos(i*pi*zs)*cos(j*ts)]
-                           for j in range(n0) for i in range(m0)])
-            a = a.swapaxes(0,2).swapaxes(1,2).reshape(n,-1)
-    return a
+    zs = np.ascontiguousarray(zs_norm, dtype=float).ravel()
+    ts = np.ascontiguousarray(thetas, dtype=float).ravel()
+    _check_normalized(zs, 'zs')
+    if funcnum not in (1, 2, 3):
+        raise ValueError('Valid values for "funcnum" are 1, 2 or 3')
+    return kernels.get_kernel('fa')(m0, n0, zs, ts, funcnum)
+
+
+def _check_normalized(xs, name):
+    if xs.shape[0] == 0:
+        return
+    xsmin = xs.min()
+    xsmax = xs.max()
+    if xsmin < 0 or xsmax > 1:
+        log('{0}.min()={1}'.format(name, xsmin))
+        log('{0}.max()={1}'.format(name, xsmax))
+        raise ValueError('The {0} array must be normalized!'.format(name))
 
 
 def fw0(m0, n0, c0, xs_norm, ts, funcnum=2):
@@ -594,6 +1322,9 @@ def fw0(m0, n0, c0, xs_norm, ts, funcnum=2):
     - ``size=2`` if ``funcnum==1 or funcnum==2``
     - ``size=4`` if ``funcnum==3``
 
+    The imperfection field is computed by the active backend of the
+    ``'fw0'`` kernel, see :mod:`desicos.conecylDB.kernels`.
+
     """
     if xs_norm.shape != ts.shape:
         raise ValueError('xs_norm and ts must have the same shape')
@@ -603,17 +1334,331 @@ def fw0(m0, n0, c0, xs_norm, ts, funcnum=2):
         size = 2
     elif funcnum==3:
         size = 4
+    else:
+        raise ValueError('Valid values for "funcnum" are 1, 2 or 3')
     if c0.shape[0] != size*m0*n0:
         raise ValueError('Invalid c0 for the given m0 and n0!')
-    try:
-        import _fit_data
-        w0s = _fit_data.fw0(m0, n0, c0, xs_norm.ravel(), ts.ravel(), funcnum)
-    except:
-        a = fa(m0, n0, xs_norm.ravel(), ts.ravel(), funcnum)
-        w0s = a.dot(c0)
+    xs = np.ascontiguousarray(xs_norm, dtype=float).ravel()
+    _check_normalized(xs, 'xs')
+    w0s = kernels.get_kernel('fw0')(m0, n0,
+            np.ascontiguousarray(c0, dtype=float),
+            xs, np.ascontiguousarray(ts, dtype=float).ravel(), funcnum)
     return w0s.reshape(xs_norm.shape)
 
 
+def _separable_basis(m0, n0, c0, funcnum):
+    # the base functions are products of a function of z and a function of
+    # theta, the coefficients are stored as c0[j, i, k], where k is the
+    # index of the (z, theta) function pair
+    if funcnum==1:
+        zfuncs = (sin, sin)
+        tfuncs = (sin, cos)
+        ivals = np.arange(1, m0+1)
+    elif funcnum==2:
+        zfuncs = (cos, cos)
+        tfuncs = (sin, cos)
+        ivals = np.arange(m0)
+    elif funcnum==3:
+        zfuncs = (sin, sin, cos, cos)
+        tfuncs = (sin, cos, sin, cos)
+        ivals = np.arange(m0)
+    else:
+        raise ValueError('Valid values for "funcnum" are 1, 2 or 3')
+    size = len(zfuncs)
+    if c0 is None:
+        return zfuncs, tfuncs, ivals, None
+    if c0.shape[0] != size*m0*n0:
+        raise ValueError('Invalid c0 for the given m0 and n0!')
+    return zfuncs, tfuncs, ivals, c0.reshape((n0, m0, size) + c0.shape[1:])
+
+
+def fw0_grid(m0, n0, c0, z_vals, theta_vals, funcnum=2):
+    r"""Calculates the imperfection field `w_0` on a `z`, `\theta` grid
+
+    Since each base function is the product of a function of `z` and a
+    function of `\theta`, the imperfection field on a grid is computed as:
+
+    .. math::
+        [W] = \sum_k{[Z_k] [C_k]^T [\Theta_k]^T}
+
+    where `[Z_k]` and `[\Theta_k]` are tables with the 1-D base functions
+    evaluated at each grid line. The cost is `O(m_0 n_0 (N_z + N_\theta))`
+    instead of the `O(m_0 n_0 N_z N_\theta)` of :func:`.fw0`.
+
+    Parameters
+    ----------
+    m0 : int
+        The number of terms along the meridian.
+    n0 : int
+        The number of terms along the circumference.
+    c0 : np.ndarray
+        The coefficients of the imperfection pattern.
+    z_vals : np.ndarray
+        A 1-D array with the meridian coordinates of the grid, normalized to
+        be between ``0.`` and ``1.``.
+    theta_vals : np.ndarray
+        A 1-D array with the circumferential coordinates of the grid, in
+        radians.
+    funcnum : int, optional
+        The function used for the approximation (see function :func:`.calc_c0`)
+
+    Returns
+    -------
+    w0s : np.ndarray
+        A 2-D array with shape ``(z_vals.shape[0], theta_vals.shape[0])``
+        containing the calculated imperfections, compatible with
+        ``np.meshgrid(theta_vals, z_vals)``.
+
+    """
+    zfuncs, tfuncs, ivals, c0 = _separable_basis(m0, n0, c0, funcnum)
+    z_vals = np.asarray(z_vals, dtype=float).ravel()
+    theta_vals = np.asarray(theta_vals, dtype=float).ravel()
+    iz = np.outer(pi*z_vals, ivals)
+    jt = np.outer(theta_vals, np.arange(n0))
+    w0s = np.zeros((z_vals.shape[0], theta_vals.shape[0]))
+    for k, (fz, ft) in enumerate(zip(zfuncs, tfuncs)):
+        w0s += fz(iz).dot(c0[:, :, k].T).dot(ft(jt).T)
+    return w0s
+
+
+def fw0_mesh(m0, n0, c0, xs_norm, ts, funcnum=2, chunksize=100000):
+    r"""Calculates the imperfection field `w_0` for the nodes of a mesh
+
+    Structured meshes have many nodes sharing the same meridian coordinate
+    (`x`) and the same angle (`\theta`). The nodes are grouped by their
+    unique `x` rows, where the summation over the meridional terms is
+    computed only once, and the remaining summation over the
+    circumferential terms uses a table of the unique angles. The results
+    are the same as :func:`.fw0`, with a cost of
+    `O(m_0 n_0 (N_x + N_\theta) + n_0 N_{nodes})`.
+
+    Parameters
+    ----------
+    m0 : int
+        The number of terms along the meridian.
+    n0 : int
+        The number of terms along the circumference.
+    c0 : np.ndarray
+        The coefficients of the imperfection pattern.
+    xs_norm : np.ndarray
+        The meridian coordinate (`x`) normalized to be between ``0.`` and
+        ``1.``.
+    ts : np.ndarray
+        The angles in radians representing the circumferential coordinate
+        (`\theta`).
+    funcnum : int, optional
+        The function used for the approximation (see function :func:`.calc_c0`)
+    chunksize : int, optional
+        Maximum number of nodes processed at once.
+
+    Returns
+    -------
+    w0s : np.ndarray
+        An array with the same shape of ``xs_norm`` containing the calculated
+        imperfections.
+
+    """
+    if xs_norm.shape != ts.shape:
+        raise ValueError('xs_norm and ts must have the same shape')
+    tables = _separable_tables(m0, n0, xs_norm, ts, funcnum)
+    w0s = _apply_separable(m0, n0, tables, c0[:, None], funcnum, chunksize)
+    return w0s[:, 0].reshape(xs_norm.shape)
+
+
+def _separable_tables(m0, n0, xs_norm, ts, funcnum):
+    # 1-D base functions evaluated at the unique x rows and theta columns
+    zfuncs, tfuncs, ivals, c0 = _separable_basis(m0, n0, None, funcnum)
+    xs_u, xs_index = np.unique(xs_norm.ravel(), return_inverse=True)
+    ts_u, ts_index = np.unique(ts.ravel(), return_inverse=True)
+    log('Evaluating w0 using {0} x rows and {1} theta columns'.format(
+        xs_u.shape[0], ts_u.shape[0]), level=1)
+    iz = np.outer(pi*xs_u, ivals)
+    jt = np.outer(ts_u, np.arange(n0))
+    rows = tuple(fz(iz) for fz in zfuncs)
+    cols = tuple(ft(jt) for ft in tfuncs)
+    return (xs_index.ravel(), ts_index.ravel()) + rows + cols
+
+
+def _apply_separable(m0, n0, tables, C, funcnum, chunksize):
+    zfuncs, tfuncs, ivals, C = _separable_basis(m0, n0, C, funcnum)
+    size = len(zfuncs)
+    xs_index, ts_index = tables[:2]
+    rows = tables[2:2+size]
+    cols = tables[2+size:]
+    num = xs_index.shape[0]
+    ncases = C.shape[-1]
+    chunksize = max(1, chunksize//ncases)
+    w0s = np.zeros((num, ncases))
+    for k in range(size):
+        # summation over the meridional terms for each unique x row
+        rk = np.einsum('xi,jic->xjc', rows[k], C[:, :, k, :])
+        for i in range(0, num, chunksize):
+            w0s[i:i+chunksize] += np.einsum('njc,nj->nc',
+                    rk[xs_index[i:i+chunksize]],
+                    cols[k][ts_index[i:i+chunksize]])
+    return w0s
+
+
+class BasisCache(object):
+    r"""Least-recently-used cache of base functions
+
+    The base functions evaluated for a given set of nodes are kept in
+    memory such that many imperfection patterns (many ``c0`` vectors) can
+    be applied to the same mesh computing the base functions only once.
+    When the memory cap is reached the least recently used entries are
+    discarded.
+
+    Each entry is an array or a tuple of arrays, see :func:`.fw0_many`.
+
+    Parameters
+    ----------
+    maxmem : float, optional
+        Memory cap in GB.
+
+    """
+    def __init__(self, maxmem=1.):
+        self.maxmem = maxmem
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def _nbytes(value):
+        if isinstance(value, tuple):
+            return sum(v.nbytes for v in value)
+        return value.nbytes
+
+    def fits(self, nbytes):
+        """Whether an entry with ``nbytes`` fits in the cache"""
+        return nbytes <= self.maxmem*1024**3
+
+    def get(self, key):
+        """Returns the cached entry or ``None``"""
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        """Adds an entry, discarding the least recently used ones"""
+        nbytes = self._nbytes(value)
+        if not self.fits(nbytes):
+            log('The base functions do not fit in the cache', level=1)
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.nbytes -= self._nbytes(old)
+        while self._data and not self.fits(self.nbytes + nbytes):
+            k, old = self._data.popitem(last=False)
+            self.nbytes -= self._nbytes(old)
+        self._data[key] = value
+        self.nbytes += nbytes
+
+    def clear(self):
+        """Removes all the cached entries"""
+        self._data.clear()
+        self.nbytes = 0
+
+
+basis_cache = BasisCache()
+
+
+def basis_key(m0, n0, xs_norm, ts, funcnum=2):
+    """Key identifying the base functions of a set of nodes
+
+    See :class:`.BasisCache`.
+
+    """
+    h = hashlib.sha1()
+    for v in (xs_norm, ts):
+        v = np.ascontiguousarray(v, dtype=float)
+        h.update(str(v.shape).encode('ascii'))
+        h.update(v.tobytes())
+    return (h.hexdigest(), m0, n0, funcnum)
+
+
+def fw0_many(m0, n0, C, xs_norm, ts, funcnum=2, cache=None,
+             chunksize=100000):
+    r"""Calculates the imperfection field `w_0` for many coefficient sets
+
+    All the imperfection patterns are obtained at once:
+
+    .. math::
+        [W] = [A] [C]
+
+    where `[A]` carries the base functions evaluated at the given nodes
+    and each column of `[C]` is one ``c0`` vector. The base functions are
+    kept in a :class:`.BasisCache`, such that subsequent calls for the same
+    nodes, ``m0``, ``n0`` and ``funcnum`` do not compute them again.
+
+    When the nodes share few unique `x` rows, as in structured meshes, the
+    1-D tables of :func:`.fw0_mesh` are cached, which is cheaper than
+    `[A]`. Otherwise the full matrix `[A]` of :func:`.fa` is cached and
+    `[W]` is obtained with a single matrix product.
+
+    Parameters
+    ----------
+    m0 : int
+        The number of terms along the meridian.
+    n0 : int
+        The number of terms along the circumference.
+    C : np.ndarray
+        The coefficients of the imperfection patterns, a 1-D array for one
+        pattern or a 2-D array with one pattern per column.
+    xs_norm : np.ndarray
+        The meridian coordinate (`x`) normalized to be between ``0.`` and
+        ``1.``.
+    ts : np.ndarray
+        The angles in radians representing the circumferential coordinate
+        (`\theta`).
+    funcnum : int, optional
+        The function used for the approximation (see function :func:`.calc_c0`)
+    cache : :class:`.BasisCache` or None, optional
+        The cache to be used. If ``None`` the module cache ``basis_cache``
+        is used.
+    chunksize : int, optional
+        Maximum number of nodes processed at once.
+
+    Returns
+    -------
+    w0s : np.ndarray
+        An array with the shape of ``xs_norm`` containing the calculated
+        imperfections, with one additional last dimension with one entry
+        per pattern when ``C`` is a 2-D array.
+
+    """
+    if xs_norm.shape != ts.shape:
+        raise ValueError('xs_norm and ts must have the same shape')
+    C = np.asarray(C)
+    single = C.ndim == 1
+    if single:
+        C = C[:, None]
+    _separable_basis(m0, n0, C, funcnum)
+    if cache is None:
+        cache = basis_cache
+    key = basis_key(m0, n0, xs_norm, ts, funcnum)
+    basis = cache.get(key)
+    if basis is None:
+        num = xs_norm.size
+        num_x = np.unique(xs_norm).shape[0]
+        if num_x*m0 + num <= 0.5*num*m0:
+            basis = _separable_tables(m0, n0, xs_norm, ts, funcnum)
+        else:
+            basis = fa(m0, n0, xs_norm.ravel(), ts.ravel(), funcnum)
+        cache.put(key, basis)
+    else:
+        log('Using cached base functions', level=1)
+    if isinstance(basis, tuple):
+        w0s = _apply_separable(m0, n0, basis, C, funcnum, chunksize)
+    else:
+        w0s = basis.dot(C)
+    if single:
+        return w0s[:, 0].reshape(xs_norm.shape)
+    return w0s.reshape(xs_norm.shape + (C.shape[1],))
+
+
 def transf_matrix(alphadeg, betadeg, gammadeg, x0, y0, z0):
     r"""Calculates the transformation matrix
 
@@ -681,8 +1726,6 @@ def transf_matrix(alphadeg, betadeg, gammadeg, x0, y0, z0):
 if __name__=='__main__':
     import matplotlib.pyplot as plt
 
-    from _fit_data import fa
-
     path = r'C:\clones\desicos\desicos\conecylDB\files\dlr\degenhardt_2010_z25\degenhardt_2010_z25_msi_theta_z_imp.txt'
     m0 = 20
     n0 = 20
@@ -690,9 +1733,8 @@ if __name__=='__main__':
     theta = np.linspace(-pi, pi, 1000)
     z = np.linspace(0, 1., 400)
 
+    w = fw0_grid(m0, n0, c0, z, theta, funcnum=2)
     theta, z = np.meshgrid(theta, z, copy=False)
-    a = fa(m0, n0, z.ravel(), theta.ravel(), funcnum=1)
-    w = a.dot(c0).reshape(1000, 400)
 
     levels = np.linspace(w.min(), w.max(), 400)
     plt.contourf(theta, z, w.reshape(theta.shape), levels=levels)
@@ -10,40 +10,290 @@ modules.
 """
 from __future__ import absolute_import
 from collections import Iterable
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
 
 import numpy as np
 from numpy import sin, cos, tan
 
 from desicos.logger import *
-from desicos.constants import FLOAT
+from desicos.constants import get_float
 from .read_write import read_theta_z_imp
+from . import kernels
+from .sidecar import write_atomic
 
 
-def nearest_neighbors(x, y, k):
-    """inspired by
-    https://stackoverflow.com/a/15366296/832621
-    and
-    https://stackoverflow.com/a/6913178/832621
+def _smallest_k(d2, k):
+    """Column indices of the ``k`` smallest values of each row of ``d2``,
+    sorted by increasing value
     """
-    x, y = map(np.asarray, (x, y))
-    y = y.copy()
-    y_idx = np.arange(len(y))
-    nearest_neighbor = np.empty((len(x), k), dtype=np.intp)
-    distances = np.empty((len(x), k), dtype=float)
-    #TODO after numpy 1.8 we can use np.argpartition(dist, kth=k-1)
-    #TODO ABAQUS 2020 comes with scipy, then we can use cKDTree
-    for j, xj in enumerate(x) :
-        dist = ((y - xj[None, :])**2).sum(axis=1)
-        for i in range(k):
-            idx = np.argmin(dist)
-            nearest_neighbor[j, i] = idx
-            distances[j, i] = dist[idx]
-            dist[idx] = 1e6
-    distances = np.sqrt(distances)
-    return distances, nearest_neighbor
-
-
-def inv_weighted(data, mesh, ncp=5, power_parameter=2):
+    if k < d2.shape[1] and hasattr(np, 'argpartition'):
+        idx = np.argpartition(d2, k-1, axis=1)[:, :k]
+    else:
+        idx = np.argsort(d2, axis=1)[:, :k]
+    rows = np.arange(d2.shape[0])[:, None]
+    asort = np.argsort(d2[rows, idx], axis=1)
+    return idx[rows, asort]
+
+
+class NeighborSearch(object):
+    r"""Spatial index used to find the closest points of a data set
+
+    The index is built only once for a given set of points and can then be
+    queried many times, with the query points processed in vectorized
+    batches.
+
+    Two backends are available:
+
+    - ``'kdtree'``: uses ``scipy.spatial.cKDTree``
+    - ``'grid'``: a pure Python/NumPy uniform grid of cells, where the data
+      points are bucketed according to their position and only the cells
+      around each query point are scanned. The search radius grows until
+      the `k` closest points found are guaranteed to be the true closest
+      points
+
+    Parameters
+    ----------
+    pts : numpy.ndarray, shape (N, ndim)
+        The data points.
+    backend : str or None, optional
+        ``'kdtree'`` or ``'grid'``. If ``None`` the ``'kdtree'`` backend is
+        used when SciPy is available, otherwise ``'grid'``.
+    points_per_cell : int, optional
+        Average number of data points per non-empty cell targeted by the
+        ``'grid'`` backend.
+
+    """
+    def __init__(self, pts, backend=None, points_per_cell=8):
+        pts = np.ascontiguousarray(pts)
+        if pts.ndim != 2 or pts.shape[0] == 0:
+            raise ValueError('pts must be a non-empty array with shape (N, ndim)')
+        self.pts = pts
+        if backend is None:
+            try:
+                from scipy.spatial import cKDTree
+                backend = 'kdtree'
+            except ImportError:
+                backend = 'grid'
+        if backend == 'kdtree':
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(pts)
+        elif backend == 'grid':
+            self._build_grid(points_per_cell)
+        else:
+            raise ValueError('Invalid backend: {0}'.format(backend))
+        self.backend = backend
+
+    def _build_grid(self, points_per_cell):
+        pts = self.pts
+        num, ndim = pts.shape
+        lo = pts.min(axis=0)
+        span = pts.max(axis=0) - lo
+        active = span > 0
+        if not np.any(active):
+            h = 1.
+        else:
+            h = (np.prod(span[active])*points_per_cell/num)**(1./active.sum())
+        # data lying on a surface or curve fill only a few cells of the
+        # bounding box, the cell size is refined to keep the occupancy
+        for i in range(3):
+            cells = self._cells_of(pts, lo, h, span)
+            occupancy = float(num)/np.unique(cells).shape[0]
+            if occupancy <= 2*points_per_cell:
+                break
+            h *= (float(points_per_cell)/occupancy)**0.5
+        self.lo = lo
+        self.h = h
+        self.shape = np.floor(span/h).astype(np.intp) + 1
+        cells = self._cells_of(pts, lo, h, span)
+        self.order = np.argsort(cells, kind='mergesort')
+        self.sorted_cells = cells[self.order]
+
+    @staticmethod
+    def _cells_of(x, lo, h, span):
+        shape = np.floor(span/h).astype(np.intp) + 1
+        ijk = np.floor((x - lo)/h).astype(np.intp)
+        ijk = np.clip(ijk, 0, shape - 1)
+        return np.ravel_multi_index(ijk.T, shape)
+
+    def save(self, dirpath):
+        """Saves the index into ``.npy`` files inside ``dirpath``
+
+        The files can be memory-mapped by other processes using
+        :meth:`.load`, such that the data points are not copied.
+
+        """
+        np.save(os.path.join(dirpath, 'pts.npy'), self.pts)
+        if self.backend == 'grid':
+            np.save(os.path.join(dirpath, 'order.npy'), self.order)
+            np.save(os.path.join(dirpath, 'sorted_cells.npy'),
+                    self.sorted_cells)
+            np.save(os.path.join(dirpath, 'grid.npy'),
+                    np.concatenate((self.lo, [self.h])))
+
+    @classmethod
+    def load(cls, dirpath, backend, mmap_mode='r'):
+        """Loads an index saved with :meth:`.save`
+
+        The ``'kdtree'`` backend is rebuilt from the memory-mapped points.
+
+        """
+        pts = np.load(os.path.join(dirpath, 'pts.npy'), mmap_mode=mmap_mode)
+        if backend != 'grid':
+            return cls(pts, backend=backend)
+        search = cls.__new__(cls)
+        search.pts = pts
+        search.backend = backend
+        search.order = np.load(os.path.join(dirpath, 'order.npy'),
+                               mmap_mode=mmap_mode)
+        search.sorted_cells = np.load(os.path.join(dirpath,
+                                      'sorted_cells.npy'), mmap_mode=mmap_mode)
+        grid = np.load(os.path.join(dirpath, 'grid.npy'))
+        search.lo = grid[:-1]
+        search.h = grid[-1]
+        span = pts.max(axis=0) - search.lo
+        search.shape = np.floor(span/search.h).astype(np.intp) + 1
+        return search
+
+    def query(self, x, k, chunksize=100000):
+        """Find the ``k`` closest data points of each query point
+
+        Parameters
+        ----------
+        x : numpy.ndarray, shape (M, ndim)
+            The query points.
+        k : int
+            The number of closest points.
+        chunksize : int, optional
+            Maximum number of query points processed at once.
+
+        Returns
+        -------
+        dist, indices : tuple of numpy.ndarray, shape (M, k)
+            The distances to the closest points, sorted in ascending order,
+            and the corresponding indices in the data points.
+
+        """
+        x = np.asarray(x)
+        if x.ndim != 2 or x.shape[1] != self.pts.shape[1]:
+            raise ValueError('Query points must have shape (M, {0})'.format(
+                             self.pts.shape[1]))
+        if k > self.pts.shape[0]:
+            raise ValueError('k={0} is larger than the number of data points'
+                             .format(k))
+        dist = np.empty((x.shape[0], k), dtype=float)
+        indices = np.empty((x.shape[0], k), dtype=np.intp)
+        for i in range(0, x.shape[0], chunksize):
+            xc = x[i:i+chunksize]
+            if self.backend == 'kdtree':
+                d, idx = self.tree.query(xc, k=k)
+                d = d.reshape(xc.shape[0], k)
+                idx = idx.reshape(xc.shape[0], k)
+            else:
+                d, idx = self._query_grid(xc, k)
+            dist[i:i+chunksize] = d
+            indices[i:i+chunksize] = idx
+        return dist, indices
+
+    def query_bytes(self, k):
+        """Estimated temporary memory in bytes used by :meth:`.query` for
+        each query point, besides the ``(M, k)`` outputs
+
+        The ``'grid'`` backend computes, for all the query points of a cell,
+        the distances to the candidate points of the neighboring cells,
+        whose number is estimated from the average occupancy of the cells.
+
+        """
+        if self.backend != 'grid':
+            return 0
+        ndim = self.pts.shape[1]
+        num_cells = np.count_nonzero(np.diff(self.sorted_cells)) + 1
+        ncand = max(float(self.pts.shape[0])/num_cells*3**ndim, k)
+        # coordinate differences and their squares, the squared distances
+        # and the indices of argpartition
+        return int(ncand*(2*ndim + 2)*8)
+
+    def _query_grid(self, x, k):
+        pts = self.pts
+        lo, h, shape = self.lo, self.h, self.shape
+        ijk = np.clip(np.floor((x - lo)/h).astype(np.intp), 0, shape - 1)
+        cells = np.ravel_multi_index(ijk.T, shape)
+        dist = np.empty((x.shape[0], k), dtype=float)
+        indices = np.empty((x.shape[0], k), dtype=np.intp)
+        ucells, inverse = np.unique(cells, return_inverse=True)
+        group = np.argsort(inverse.ravel(), kind='mergesort')
+        bounds = np.searchsorted(inverse.ravel()[group],
+                                 np.arange(ucells.shape[0] + 1))
+        for ic in range(ucells.shape[0]):
+            qids = group[bounds[ic]:bounds[ic+1]]
+            c = ijk[qids[0]]
+            r = 1
+            while qids.shape[0] > 0:
+                cmin = np.maximum(c - r, 0)
+                cmax = np.minimum(c + r, shape - 1)
+                cand = self._candidates(cmin, cmax)
+                if cand.shape[0] < k:
+                    r += 1
+                    continue
+                xq = x[qids]
+                d2 = ((xq[:, None, :] - pts[cand][None, :, :])**2).sum(axis=2)
+                best = _smallest_k(d2, k)
+                rows = np.arange(qids.shape[0])[:, None]
+                d2best = d2[rows, best]
+                # radius around each query point that is fully covered by
+                # the scanned cells
+                inf = np.inf
+                face_lo = np.where(cmin > 0, lo + cmin*h, -inf)
+                face_hi = np.where(cmax < shape - 1, lo + (cmax + 1)*h, inf)
+                covered = np.minimum(xq - face_lo, face_hi - xq).min(axis=1)
+                ok = d2best[:, -1] <= covered**2
+                dist[qids[ok]] = np.sqrt(d2best[ok])
+                indices[qids[ok]] = cand[best[ok]]
+                qids = qids[~ok]
+                r += 1
+        return dist, indices
+
+    def _candidates(self, cmin, cmax):
+        shape = self.shape
+        axes = [np.arange(a, b + 1) for a, b in zip(cmin, cmax)]
+        # cells along the last axis are contiguous in the linear index
+        if len(axes) > 1:
+            heads = np.array(np.meshgrid(*axes[:-1], indexing='ij')).reshape(
+                    len(axes) - 1, -1)
+        else:
+            heads = np.zeros((0, 1), dtype=np.intp)
+        first = np.vstack((heads, np.full(heads.shape[1], cmin[-1])))
+        first = np.ravel_multi_index(first, shape)
+        starts = np.searchsorted(self.sorted_cells, first, side='left')
+        ends = np.searchsorted(self.sorted_cells, first + (cmax[-1] - cmin[-1]),
+                               side='right')
+        lens = ends - starts
+        total = lens.sum()
+        if total == 0:
+            return np.zeros(0, dtype=np.intp)
+        offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+        pos = np.arange(total) + offsets
+        return self.order[pos]
+
+
+def nearest_neighbors(x, y, k, backend=None):
+    """Find the ``k`` points of ``y`` closest to each point of ``x``
+
+    See :class:`.NeighborSearch` for the available backends.
+
+    Returns
+    -------
+    dist, indices : tuple of numpy.ndarray, shape (len(x), k)
+
+    """
+    return NeighborSearch(y, backend=backend).query(x, k)
+
+
+def inv_weighted(data, mesh, ncp=5, power_parameter=2, search=None,
+        backend=None, workers=1, maxmem=None, num_sub=None):
     r"""Interpolates the values taken at one group of points into
     another using an inverse-weighted algorithm
 
@@ -77,35 +327,373 @@ def inv_weighted(data, mesh, ncp=5, power_parameter=2):
         Number of closest points used in the inverse-weighted interpolation.
     power_parameter : float, optional
         Power of inverse weighted interpolation function.
+    search : :class:`.NeighborSearch` or None, optional
+        A spatial index already built for ``data[:, :-1]``, allowing the
+        same data set to be interpolated into many meshes without rebuilding
+        it.
+    backend : str or None, optional
+        The backend used to build the spatial index when ``search`` is not
+        given (see :class:`.NeighborSearch`).
+    workers : int, optional
+        Number of processes. When ``workers > 1`` the mesh nodes are split
+        in shards that are interpolated in a process pool, where the data
+        points and the spatial index are memory-mapped from temporary
+        ``.npy`` files instead of being copied to each process. The results
+        are identical to the ones obtained with ``workers=1``.
+    maxmem : float or None, optional
+        Memory budget in GB. The nodes are interpolated in chunks sized such
+        that the temporary arrays of each chunk fit in this budget, and the
+        results are written into preallocated output arrays.
+    num_sub : int or None, optional
+        Number of chunks in which the nodes are divided. If ``maxmem`` is
+        also given the smallest of the two chunk sizes is used.
 
     Returns
     -------
-    ans : numpy.ndarray
-        A 1-D array with the interpolated values. The size of this array
-        is ``mesh.shape[0]``.
+    dist, ans : tuple of numpy.ndarray
+        The distances to the ``ncp`` closest points of each node, with shape
+        ``(M, ncp)``, and a 1-D array with the interpolated values. The size
+        of this array is ``mesh.shape[0]``.
 
     """
     if mesh.shape[1] != data.shape[1]-1:
         raise ValueError('Invalid input: mesh.shape[1] != data.shape[1]')
 
     log('Interpolating... ')
-    dist, indices = nearest_neighbors(mesh, data[:, :-1], k=ncp)
-
-    # avoiding division by zero
-    dist[dist < 1.e-15] = 1.e-15
-    # fetching the imperfection
-    imp = data[:, -1][indices]
-    # weight calculation
-    total_weight = np.sum(1./(dist**power_parameter), axis=1)
-    weight = 1./(dist**power_parameter)
-    # computing the new imp
-    imp_new = np.sum(imp*weight, axis=1)/total_weight
+    if search is None:
+        search = NeighborSearch(data[:, :-1], backend=backend)
+    chunksize = calc_chunksize(mesh.shape[0], ncp, maxmem, num_sub,
+                               search)
+    if chunksize < mesh.shape[0]:
+        log('Processing the nodes in chunks of {0}'.format(chunksize),
+            level=1)
+    if workers > 1:
+        dist, imp_new = _inv_weighted_pool(search, data[:, -1], mesh, ncp,
+                                           power_parameter, workers, chunksize)
+    else:
+        dist, imp_new = _inv_weighted_kernel(search, data[:, -1], mesh, ncp,
+                                             power_parameter, chunksize)
 
     log('Interpolation completed!')
+    peak = peak_memory()
+    if peak is not None:
+        log('Peak memory usage: {0:1.1f} MB'.format(peak), level=1)
+
+    return dist, imp_new
+
+
+def calc_chunksize(num, ncp, maxmem=None, num_sub=None, search=None):
+    """Number of nodes interpolated at once
+
+    Parameters
+    ----------
+    num : int
+        The number of nodes.
+    ncp : int
+        Number of closest points used in the inverse-weighted interpolation.
+    maxmem : float or None, optional
+        Memory budget in GB for the temporary arrays of each chunk.
+    num_sub : int or None, optional
+        Number of chunks in which the nodes are divided.
+    search : :class:`.NeighborSearch` or None, optional
+        The spatial index used, whose temporary arrays are included in the
+        ``maxmem`` budget (see :meth:`.NeighborSearch.query_bytes`).
+
+    """
+    chunksize = max(num, 1)
+    if num_sub:
+        chunksize = int(np.ceil(float(num)/num_sub))
+    if maxmem:
+        # about ten temporary arrays of shape (chunksize, ncp) are used by
+        # the neighbor search and the weight calculation
+        bytes_per_node = 10*ncp*8
+        if search is not None:
+            bytes_per_node += search.query_bytes(ncp)
+        chunksize = min(chunksize, int(maxmem*1024**3/bytes_per_node))
+    return max(chunksize, 1)
+
+
+def _inv_weighted_kernel(search, values, mesh, ncp, power_parameter,
+                         chunksize):
+    num = mesh.shape[0]
+    dist = np.empty((num, ncp), dtype=float)
+    imp_new = np.empty(num, dtype=float)
+    for i in range(0, num, chunksize):
+        d, indices = search.query(mesh[i:i+chunksize], k=ncp,
+                                  chunksize=chunksize)
+        # avoiding division by zero
+        d[d < 1.e-15] = 1.e-15
+        dist[i:i+chunksize] = d
+        # fetching the imperfection
+        imp = np.asarray(values[indices], dtype=float)
+        # computing the new imp
+        imp_new[i:i+chunksize] = kernels.get_kernel('idw')(
+                dist[i:i+chunksize], imp, power_parameter)
 
     return dist, imp_new
 
 
+_shared = {}
+
+
+def _init_worker(dirpath, backend, idw_backend):
+    # the same kernel as in the parent process, which under spawn would
+    # otherwise be selected again
+    kernels.set_backend(idw_backend, 'idw')
+    _shared['search'] = NeighborSearch.load(dirpath, backend)
+    _shared['values'] = np.load(os.path.join(dirpath, 'values.npy'),
+                                mmap_mode='r')
+    _shared['mesh'] = np.load(os.path.join(dirpath, 'mesh.npy'),
+                              mmap_mode='r')
+
+
+def _inv_weighted_shard(args):
+    start, stop, ncp, power_parameter, chunksize = args
+    return _inv_weighted_kernel(_shared['search'], _shared['values'],
+            np.array(_shared['mesh'][start:stop]), ncp, power_parameter,
+            chunksize)
+
+
+def shards(num, workers, per_worker=4):
+    """Splits ``range(num)`` in contiguous ``(start, stop)`` shards
+
+    Parameters
+    ----------
+    num : int
+        The number of entries.
+    workers : int
+        The number of processes that will consume the shards.
+    per_worker : int, optional
+        The number of shards per process, used to balance the load.
+
+    """
+    num_shards = max(1, min(num, workers*per_worker))
+    bounds = np.linspace(0, num, num_shards + 1).astype(int)
+    return [(bounds[i], bounds[i+1]) for i in range(num_shards)
+            if bounds[i+1] > bounds[i]]
+
+
+def _inv_weighted_pool(search, values, mesh, ncp, power_parameter, workers,
+                       chunksize):
+    from multiprocessing import Pool
+
+    dirpath = tempfile.mkdtemp(prefix='desicos_')
+    try:
+        search.save(dirpath)
+        np.save(os.path.join(dirpath, 'values.npy'), values)
+        np.save(os.path.join(dirpath, 'mesh.npy'), mesh)
+        tasks = [(start, stop, ncp, power_parameter, chunksize)
+                 for start, stop in shards(mesh.shape[0], workers)]
+        pool = Pool(workers, initializer=_init_worker,
+                    initargs=(dirpath, search.backend,
+                              kernels.active_backend('idw')))
+        try:
+            results = pool.map(_inv_weighted_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+    dist = np.empty((mesh.shape[0], ncp), dtype=float)
+    imp_new = np.empty(mesh.shape[0], dtype=float)
+    for task, r in zip(tasks, results):
+        start, stop = task[:2]
+        dist[start:stop] = r[0]
+        imp_new[start:stop] = r[1]
+    return dist, imp_new
+
+
+def plan_key(data_pts, mesh, ncp, power_parameter, T=None):
+    """Hash identifying an interpolation plan
+
+    The key changes whenever the data point coordinates, the mesh
+    coordinates, or the interpolation parameters ``ncp``,
+    ``power_parameter`` and ``T`` change.
+
+    Returns
+    -------
+    key : str
+        A hexadecimal SHA-1 digest.
+
+    """
+    h = hashlib.sha1()
+    for a in (data_pts, mesh):
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.data)
+    h.update('{0:d} {1!r}'.format(int(ncp), float(power_parameter)).encode())
+    if T is not None:
+        h.update(np.ascontiguousarray(T, dtype=np.float64).data)
+    return h.hexdigest()
+
+
+class InterpPlan(object):
+    r"""Reusable inverse-weighted interpolation from data points into a mesh
+
+    The ``ncp`` closest data points of each mesh node and their normalized
+    inverse-distance weights (cf. :func:`.inv_weighted`) are computed only
+    once and stored as a sparse matrix `[W]` in the CSR format. Any number
+    of value columns given at the data points can then be interpolated with
+    one sparse matrix-vector product:
+
+    .. math::
+        \{w_0\}_{mesh} = [W] \{w_0\}_{data}
+
+    which makes it cheap to apply many imperfections measured on the same
+    point layout, or many scaling factors, to the same mesh.
+
+    Parameters
+    ----------
+    data_pts : numpy.ndarray, shape (N, ndim)
+        The coordinates of the data points.
+    mesh : numpy.ndarray, shape (M, ndim)
+        The coordinates where the values will be interpolated to.
+    ncp : int, optional
+        Number of closest points used in the inverse-weighted interpolation.
+    power_parameter : float, optional
+        Power of inverse weighted interpolation function.
+    T : None or np.ndarray, optional
+        A transformation matrix (cf. :func:`.transf_matrix`) applied to the
+        mesh coordinates, when ``ndim == 3``.
+    search : :class:`.NeighborSearch` or None, optional
+        A spatial index already built for ``data_pts``.
+    backend : str or None, optional
+        The backend used to build the spatial index when ``search`` is not
+        given (see :class:`.NeighborSearch`).
+
+    """
+    def __init__(self, data_pts=None, mesh=None, ncp=5, power_parameter=2,
+                 T=None, search=None, backend=None):
+        self.key = None
+        self.shape = None
+        self.indptr = None
+        self.indices = None
+        self.weights = None
+        if data_pts is None or mesh is None:
+            return
+        if mesh.shape[1] != data_pts.shape[1]:
+            raise ValueError('Invalid input: mesh.shape[1] != data_pts.shape[1]')
+        self.key = plan_key(data_pts, mesh, ncp, power_parameter, T)
+        if T is not None:
+            tmp = np.vstack((mesh.T, np.ones((1, mesh.shape[0]))))
+            mesh = np.dot(T, tmp).T
+            del tmp
+        if search is None:
+            search = NeighborSearch(data_pts, backend=backend)
+        dist, indices = search.query(mesh, k=ncp)
+        dist[dist < 1.e-15] = 1.e-15
+        weight = 1./(dist**power_parameter)
+        weight /= weight.sum(axis=1)[:, None]
+        self.shape = (mesh.shape[0], data_pts.shape[0])
+        self.indptr = np.arange(0, mesh.shape[0]*ncp + 1, ncp, dtype=np.intp)
+        self.indices = indices.ravel()
+        self.weights = weight.ravel()
+
+    def matrix(self):
+        """The weights as a ``scipy.sparse.csr_matrix``"""
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.weights, self.indices, self.indptr),
+                          shape=self.shape)
+
+    def apply(self, values):
+        """Interpolates values given at the data points into the mesh
+
+        Parameters
+        ----------
+        values : numpy.ndarray, shape (N,) or (N, ncols)
+            The values at the data points, with one column per field.
+
+        Returns
+        -------
+        ans : numpy.ndarray, shape (M,) or (M, ncols)
+            The interpolated values.
+
+        """
+        values = np.asarray(values)
+        if values.shape[0] != self.shape[1]:
+            raise ValueError('values must have {0} rows'.format(self.shape[1]))
+        try:
+            return self.matrix().dot(values)
+        except ImportError:
+            M = self.shape[0]
+            weights = self.weights.reshape(M, -1)
+            taken = values[self.indices.reshape(M, -1)]
+            if values.ndim == 1:
+                return (weights*taken).sum(axis=1)
+            return (weights[:, :, None]*taken).sum(axis=1)
+
+    def save(self, path):
+        """Saves the plan into a ``.npz`` file
+
+        The file is written with a temporary name and then renamed, such
+        that other processes never find a partially written plan.
+
+        """
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                np.savez(f, key=np.array(self.key),
+                         shape=np.array(self.shape), indptr=self.indptr,
+                         indices=self.indices, weights=self.weights)
+        write_atomic(path, write)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a plan saved with :meth:`.save`"""
+        plan = cls()
+        with np.load(path) as tmp:
+            plan.key = str(tmp['key'])
+            plan.shape = tuple(int(i) for i in tmp['shape'])
+            plan.indptr = tmp['indptr']
+            plan.indices = tmp['indices']
+            plan.weights = tmp['weights']
+        return plan
+
+
+def get_interp_plan(data_pts, mesh, ncp=5, power_parameter=2, T=None,
+        cache_dir=None, backend=None):
+    """Returns an interpolation plan, reusing a cached one when possible
+
+    Parameters
+    ----------
+    data_pts, mesh, ncp, power_parameter, T, backend
+        See :class:`.InterpPlan`.
+    cache_dir : str or None, optional
+        Directory where the plans are saved as ``<key>.npz`` files, where
+        ``key`` is given by :func:`.plan_key`. If ``None`` the plan is not
+        cached.
+
+    Returns
+    -------
+    plan : :class:`.InterpPlan`
+
+    """
+    if cache_dir is None:
+        return InterpPlan(data_pts, mesh, ncp, power_parameter, T,
+                          backend=backend)
+    key = plan_key(data_pts, mesh, ncp, power_parameter, T)
+    cache_dir = os.path.expanduser(cache_dir)
+    path = os.path.join(cache_dir, key + '.npz')
+    if os.path.isfile(path):
+        try:
+            plan = InterpPlan.load(path)
+            log('Using interpolation plan: {0}'.format(path))
+            return plan
+        except (IOError, OSError, ValueError, KeyError, EOFError,
+                zipfile.BadZipfile) as e:
+            warn('Invalid interpolation plan {0}, building it again: {1}'.
+                 format(path, e), level=1)
+    plan = InterpPlan(data_pts, mesh, ncp, power_parameter, T,
+                      backend=backend)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        plan.save(path)
+        log('Interpolation plan saved: {0}'.format(path))
+    except (IOError, OSError) as e:
+        warn('Interpolation plan could not be saved: {0}'.format(e), level=1)
+    return plan
+
+
 def interp(x, xp, fp, left=None, right=None, period=None):
     """
     One-dimensional linear interpolation
@@ -213,13 +801,139 @@ def interp(x, xp, fp, left=None, right=None, period=None):
         return np.interp(x, xp, fp)
 
 
+def detect_grid(data, rtol=1.e-6):
+    r"""Checks if a data set in the `\theta, z, imp` format lies on a grid
+
+    The data lies on a grid when every combination of the distinct `\theta`
+    and `z` values is present, as it happens with the stochastic samples or
+    with data converted from a regular measurement grid. The spacing does not
+    need to be uniform. Since `\theta` is periodic, the angles are wrapped to
+    `[-\pi, \pi)` and repeated values, such as a column at `\theta = 0`
+    and at `\theta = 2\pi`, are averaged.
+
+    Parameters
+    ----------
+    data : numpy.ndarray, shape (N, 3)
+        The data with `\theta`, `z`, `imp` in each column.
+    rtol : float, optional
+        Relative tolerance used to consider two coordinates the same.
+
+    Returns
+    -------
+    out : tuple or None
+        ``None`` if the data does not lie on a grid, otherwise a tuple
+        ``(thetas, zs, values)`` with the sorted grid coordinates and a 2-D
+        array with shape ``(zs.shape[0], thetas.shape[0])``.
+
+    """
+    thetas = (data[:, 0] + np.pi) % (2*np.pi) - np.pi
+    zs = data[:, 1]
+    zspan = zs.max() - zs.min()
+    tol_theta = rtol*2*np.pi
+    tol_z = rtol*zspan if zspan > 0 else rtol
+    qt = np.round(thetas/tol_theta).astype(np.int64)
+    # -pi and pi are the same position
+    qt[qt == np.round(np.pi/tol_theta)] = np.round(-np.pi/tol_theta)
+    qz = np.round(zs/tol_z).astype(np.int64)
+    ut, it = np.unique(qt, return_inverse=True)
+    uz, iz = np.unique(qz, return_inverse=True)
+    nt = ut.shape[0]
+    nz = uz.shape[0]
+    if nt < 2 or nz*nt > data.shape[0]:
+        return None
+    cells = iz.ravel()*nt + it.ravel()
+    counts = np.bincount(cells, minlength=nz*nt)
+    if np.any(counts == 0):
+        return None
+    values = np.bincount(cells, weights=data[:, 2], minlength=nz*nt)/counts
+    return ut*tol_theta, uz*tol_z, values.reshape(nz, nt)
+
+
+def interp_grid(thetas, zs, values, theta_new, z_new, method='linear'):
+    r"""Interpolates gridded `\theta, z` data with periodicity in `\theta`
+
+    The points outside the `z` range of the grid take the value of the
+    closest edge.
+
+    Parameters
+    ----------
+    thetas : numpy.ndarray
+        The sorted angles of the grid in radians, covering less than
+        `2\pi`.
+    zs : numpy.ndarray
+        The sorted `z` coordinates of the grid.
+    values : numpy.ndarray, shape (zs.shape[0], thetas.shape[0])
+        The values at the grid points.
+    theta_new, z_new : numpy.ndarray
+        The coordinates of the new points.
+    method : str, optional
+        ``'linear'`` for a bilinear interpolation or ``'cubic'`` for a
+        bicubic spline interpolation (requires SciPy).
+
+    Returns
+    -------
+    ans : numpy.ndarray
+        The interpolated values, with the same shape of ``theta_new``.
+
+    """
+    period = 2*np.pi
+    t0 = thetas[0]
+    tq = (theta_new - t0) % period + t0
+    zq = np.clip(z_new, zs[0], zs[-1])
+    if method == 'cubic':
+        from scipy.interpolate import RectBivariateSpline
+
+        pad = 3
+        t_ext = np.concatenate((thetas[-pad:] - period, thetas,
+                                thetas[:pad] + period))
+        v_ext = np.hstack((values[:, -pad:], values, values[:, :pad]))
+        spline = RectBivariateSpline(zs, t_ext, v_ext,
+                                     kx=min(3, zs.shape[0] - 1), ky=3)
+        return spline.ev(zq, tq)
+    elif method != 'linear':
+        raise ValueError('Invalid method: {0}'.format(method))
+    t_ext = np.concatenate((thetas, [t0 + period]))
+    v_ext = np.hstack((values, values[:, :1]))
+    i = np.clip(np.searchsorted(t_ext, tq, side='right') - 1, 0,
+                thetas.shape[0] - 1)
+    t = (tq - t_ext[i])/(t_ext[i+1] - t_ext[i])
+    if zs.shape[0] == 1:
+        return (1 - t)*v_ext[0, i] + t*v_ext[0, i+1]
+    j = np.clip(np.searchsorted(zs, zq, side='right') - 1, 0,
+                zs.shape[0] - 2)
+    u = (zq - zs[j])/(zs[j+1] - zs[j])
+    return ((1 - t)*(1 - u)*v_ext[j, i] + t*(1 - u)*v_ext[j, i+1] +
+            (1 - t)*u*v_ext[j+1, i] + t*u*v_ext[j+1, i+1])
+
+
 def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
         stretch_H=False, z_offset_bot=None, rotatedeg=0., num_sub=10, ncp=5,
-        power_parameter=2, ignore_bot_h=None, ignore_top_h=None, T=None):
+        power_parameter=2, ignore_bot_h=None, ignore_top_h=None, T=None,
+        backend=None, metric='3D', seam_band_deg=20., plan_dir=None,
+        workers=1, maxmem=None, grid=False, grid_method='linear', dtype=None):
     r"""Interpolates a data set in the `\theta, z, imp` format
 
     This function uses the inverse-weighted algorithm (:func:`.inv_weighted`).
 
+    The closest points can be searched using two metrics, selected with
+    parameter ``metric``:
+
+    - ``'3D'``: the data points are placed on the cone surface and the
+      distances are measured in the 3-D Cartesian space
+    - ``'surface'``: the cone surface is unrolled and the distances are
+      measured in the 2-D space given by the arc-length `R_{ref} \theta`
+      and the meridional coordinate `z / cos(\alpha)`, where `R_{ref}` is
+      the radius at mid-height. The data points closer than
+      ``seam_band_deg`` to `\theta = \pm \pi` are repeated on the other
+      side of the seam, such that the nodes close to the seam see the
+      measured points of both sides. For cylinders this metric gives
+      results very close to the ``'3D'`` one at a lower cost
+
+    When the data lies on a `\theta \times z` grid (see :func:`.detect_grid`)
+    the closest point search is skipped and the values are directly
+    interpolated from the grid cell containing each node
+    (see :func:`.interp_grid`), with periodicity in `\theta`.
+
     Parameters
     ----------
     data : str or numpy.ndarray, shape (N, 3)
@@ -253,8 +967,9 @@ def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
         Rotation angle in degrees telling how much the imperfection pattern
         should be rotated about the `X_3` (or `Z`) axis.
     num_sub : int, optional
-        The number of sub-sets used during the interpolation. The points
-        are divided in sub-sets to increase the algorithm's efficiency.
+        The number of sub-sets used during the interpolation. The mesh nodes
+        are divided in sub-sets that are interpolated one after the other,
+        limiting the size of the temporary arrays.
     ncp : int, optional
         Number of closest points used in the inverse-weighted interpolation.
     power_parameter : float, optional
@@ -268,6 +983,38 @@ def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
     T : None or np.ndarray, optional
         A transformation matrix (cf. :func:`.transf_matrix`) required when the
         mesh is not in the :ref:`default coordinate system <figure_conecyl>`.
+    backend : str or None, optional
+        The backend of the spatial index used to find the closest points
+        (see :class:`.NeighborSearch`).
+    metric : str, optional
+        ``'3D'`` or ``'surface'``, as explained above.
+    seam_band_deg : float, optional
+        Width in degrees of the band close to the seam `\theta = \pm \pi`
+        whose points are repeated when ``metric='surface'``.
+    plan_dir : str or None, optional
+        If given, the interpolation weights are stored in and reused from
+        this directory (see :func:`.get_interp_plan`), such that other
+        imperfections measured on the same points can be applied to the
+        same mesh without repeating the closest point search.
+    workers : int, optional
+        Number of processes used by :func:`.inv_weighted`.
+    maxmem : float or None, optional
+        Memory budget in GB used to size the sub-sets of nodes (see
+        :func:`.inv_weighted`).
+    grid : bool or None, optional
+        If ``False`` (default) the inverse-weighted interpolation is always
+        used. If ``True`` the data must lie on a grid, which is interpolated
+        with :func:`.interp_grid`, and if ``None`` the data is checked and
+        the grid interpolation is used when possible. The grid interpolation
+        is much faster but its results differ slightly from the
+        inverse-weighted ones.
+    grid_method : str, optional
+        ``'linear'`` or ``'cubic'``, see :func:`.interp_grid`.
+    dtype : str or None, optional
+        The floating point type used to store the data and mesh coordinates.
+        If ``None`` the global type given by
+        :func:`desicos.constants.get_float` is used. The interpolation
+        weights are always accumulated in double precision.
 
     Returns
     -------
@@ -275,12 +1022,15 @@ def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
         An array with M elements containing the interpolated values.
 
     """
+    dtype = get_float(dtype)
     if not isinstance(data, np.ndarray):
         d, d, data = read_theta_z_imp(path=data,
                                       H_measured=H_measured,
                                       stretch_H=stretch_H,
-                                      z_offset_bot=z_offset_bot)
+                                      z_offset_bot=z_offset_bot,
+                                      dtype=dtype)
     else:
+        data = np.asarray(data, dtype=dtype)
         if stretch_H:
             H_points = data[:, 1].max() - data[:, 1].min()
             data[:, 1] /= H_points
@@ -293,8 +1043,6 @@ def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
     if mesh.shape[1] != 3:
         raise ValueError('Mesh must have shape (M, 3)')
 
-    data3D = np.zeros((data.shape[0], 4), dtype=FLOAT)
-
     if rotatedeg:
         data[:, 0] += np.deg2rad(rotatedeg)
 
@@ -304,19 +1052,70 @@ def interp_theta_z_imp(data, mesh, alphadeg, H_measured, H_model, R_bottom,
     alpharad = np.deg2rad(alphadeg)
     tana = tan(alpharad)
 
-    def r_local(z):
-        return R_bottom - z*tana
-
-    data3D[:, 0] = r_local(z)*cos(data[:, 0])
-    data3D[:, 1] = r_local(z)*sin(data[:, 0])
-    data3D[:, 2] = z
-    data3D[:, 3] = data[:, 2]
-
     if T is not None:
         tmp = np.vstack((mesh.T, np.ones((1, mesh.shape[0]))))
         mesh = np.dot(T, tmp).T
         del tmp
-    dist, ans = inv_weighted(data3D, mesh, ncp=ncp, power_parameter=power_parameter)
+    mesh = np.asarray(mesh, dtype=dtype)
+
+    gridded = None
+    if grid is not False:
+        gridded = detect_grid(data)
+        if gridded is None and grid:
+            raise ValueError('data does not lie on a theta x z grid')
+
+    if gridded is not None:
+        thetas, zs, values = gridded
+        log('Interpolating from a {0} x {1} theta x z grid'.format(
+            thetas.shape[0], zs.shape[0]))
+        ans = interp_grid(thetas, zs, values,
+                          np.arctan2(mesh[:, 1], mesh[:, 0]), mesh[:, 2],
+                          method=grid_method)
+
+    else:
+        if metric == '3D':
+            def r_local(z):
+                return R_bottom - z*tana
+
+            data3D = np.zeros((data.shape[0], 4), dtype=dtype)
+            data3D[:, 0] = r_local(z)*cos(data[:, 0])
+            data3D[:, 1] = r_local(z)*sin(data[:, 0])
+            data3D[:, 2] = z
+            data3D[:, 3] = data[:, 2]
+            data_nd, mesh_nd = data3D, mesh
+
+        elif metric == 'surface':
+            R_ref = R_bottom - 0.5*H_model*tana
+            cosa = cos(alpharad)
+            thetas = (data[:, 0] + np.pi) % (2*np.pi) - np.pi
+            band = np.deg2rad(seam_band_deg)
+            low = thetas < (-np.pi + band)
+            high = thetas > (np.pi - band)
+            thetas = np.concatenate((thetas, thetas[low] + 2*np.pi,
+                                     thetas[high] - 2*np.pi))
+            data2D = np.zeros((thetas.shape[0], 3), dtype=dtype)
+            data2D[:, 0] = R_ref*thetas
+            data2D[:, 1] = np.concatenate((z, z[low], z[high]))/cosa
+            data2D[:, 2] = np.concatenate((data[:, 2], data[low, 2],
+                                           data[high, 2]))
+            mesh2D = np.zeros((mesh.shape[0], 2), dtype=dtype)
+            mesh2D[:, 0] = R_ref*np.arctan2(mesh[:, 1], mesh[:, 0])
+            mesh2D[:, 1] = mesh[:, 2]/cosa
+            data_nd, mesh_nd = data2D, mesh2D
+
+        else:
+            raise ValueError('Invalid metric: {0}'.format(metric))
+
+        if plan_dir is None:
+            dist, ans = inv_weighted(data_nd, mesh_nd, ncp=ncp,
+                                     power_parameter=power_parameter,
+                                     backend=backend, workers=workers,
+                                     maxmem=maxmem, num_sub=num_sub)
+        else:
+            plan = get_interp_plan(data_nd[:, :-1], mesh_nd, ncp=ncp,
+                                   power_parameter=power_parameter,
+                                   cache_dir=plan_dir, backend=backend)
+            ans = plan.apply(data_nd[:, -1])
 
     z_mesh = mesh[:, 2]
     if ignore_bot_h is not None:
@@ -0,0 +1,397 @@
+r"""
+Kernels (:mod:`desicos.conecylDB.kernels`)
+==========================================
+
+.. currentmodule:: desicos.conecylDB.kernels
+
+Registry of the numerical kernels used to fit and to interpolate the
+imperfection data, with interchangeable backends:
+
+- ``'cython'``: the compiled ``_fit_data`` extension (see
+  ``setup_fit_data.py``), running in parallel with the number of threads
+  given by :func:`.set_num_threads`
+- ``'numba'``: just-in-time compiled versions, available when Numba is
+  installed
+- ``'numpy'``: pure Python/NumPy versions, always available
+
+The kernels are:
+
+- ``'fa'``: the matrix with the base functions (see
+  :func:`desicos.conecylDB.fit_data.fa`)
+- ``'fw0'``: the imperfection field for given coefficients (see
+  :func:`desicos.conecylDB.fit_data.fw0`)
+- ``'idw'``: the inverse-distance weighted mean of the closest points (see
+  :func:`desicos.conecylDB.interpolate.inv_weighted`)
+
+By default the first available backend among ``'cython'``, ``'numba'``
+and ``'numpy'`` is used and a warning is issued when ``'fa'`` or ``'fw0'``
+fall back to ``'numpy'``, which is much slower. The backend can be fixed
+with :func:`.set_backend` or chosen by timing all the available backends on
+the current machine with :func:`.benchmark`. Use :func:`.report` to check
+which backends are available and active.
+
+"""
+from __future__ import absolute_import
+import time
+
+import numpy as np
+from numpy import sin, cos, pi
+
+from desicos.logger import *
+
+
+KERNELS = ('fa', 'fw0', 'idw')
+BACKENDS = ('cython', 'numba', 'numpy')
+
+_config = dict(num_threads=None)
+_active = {}
+_loaded = {}
+_warned = set()
+
+
+def _cpu_count():
+    try:
+        from multiprocessing import cpu_count
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def get_num_threads():
+    """Number of threads used by the compiled backends
+
+    If not set with :func:`.set_num_threads` all processors are used.
+
+    """
+    if _config['num_threads'] is None:
+        return _cpu_count()
+    return _config['num_threads']
+
+
+def set_num_threads(num_threads):
+    """Changes the number of threads used by the compiled backends
+
+    Parameters
+    ----------
+    num_threads : int or None
+        The number of threads, or ``None`` to use all processors.
+
+    """
+    if num_threads is not None and num_threads < 1:
+        raise ValueError('num_threads must be at least 1')
+    _config['num_threads'] = num_threads
+
+
+def _load_cython():
+    try:
+        from desicos.conecylDB import _fit_data
+    except ImportError:
+        import _fit_data
+
+    def fa(m0, n0, zs, ts, funcnum):
+        return _fit_data.fa(m0, n0, zs, ts, funcnum, get_num_threads())
+
+    def fw0(m0, n0, c0, xs, ts, funcnum):
+        return _fit_data.fw0(m0, n0, c0, xs, ts, funcnum, get_num_threads())
+
+    def idw(dist, imp, power_parameter):
+        return _fit_data.idw(dist, imp, float(power_parameter),
+                             get_num_threads())
+
+    return dict(fa=fa, fw0=fw0, idw=idw)
+
+
+def _load_numba():
+    import numba
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _fa(m0, n0, zs, ts, funcnum):
+        size = 4 if funcnum == 3 else 2
+        num = zs.shape[0]
+        a = np.zeros((num, size*m0*n0))
+        for l in prange(num):
+            z = zs[l]
+            t = ts[l]
+            for j in range(n0):
+                sinjt = np.sin(j*t)
+                cosjt = np.cos(j*t)
+                for i in range(m0):
+                    col = (i + j*m0)*size
+                    if funcnum == 1:
+                        sinix = np.sin((i + 1)*np.pi*z)
+                        a[l, col] = sinix*sinjt
+                        a[l, col+1] = sinix*cosjt
+                    elif funcnum == 2:
+                        cosix = np.cos(i*np.pi*z)
+                        a[l, col] = cosix*sinjt
+                        a[l, col+1] = cosix*cosjt
+                    else:
+                        sinix = np.sin(i*np.pi*z)
+                        cosix = np.cos(i*np.pi*z)
+                        a[l, col] = sinix*sinjt
+                        a[l, col+1] = sinix*cosjt
+                        a[l, col+2] = cosix*sinjt
+                        a[l, col+3] = cosix*cosjt
+        return a
+
+    @njit(parallel=True, cache=True)
+    def _fw0(m0, n0, c0, xs, ts, funcnum):
+        size = 4 if funcnum == 3 else 2
+        num = xs.shape[0]
+        w0s = np.zeros(num)
+        for l in prange(num):
+            x = xs[l]
+            t = ts[l]
+            w0 = 0.
+            for j in range(n0):
+                sinjt = np.sin(j*t)
+                cosjt = np.cos(j*t)
+                for i in range(m0):
+                    col = (i + j*m0)*size
+                    if funcnum == 1:
+                        sinix = np.sin((i + 1)*np.pi*x)
+                        w0 += (c0[col]*sinjt + c0[col+1]*cosjt)*sinix
+                    elif funcnum == 2:
+                        cosix = np.cos(i*np.pi*x)
+                        w0 += (c0[col]*sinjt + c0[col+1]*cosjt)*cosix
+                    else:
+                        sinix = np.sin(i*np.pi*x)
+                        cosix = np.cos(i*np.pi*x)
+                        w0 += (c0[col]*sinjt + c0[col+1]*cosjt)*sinix
+                        w0 += (c0[col+2]*sinjt + c0[col+3]*cosjt)*cosix
+            w0s[l] = w0
+        return w0s
+
+    @njit(parallel=True, cache=True)
+    def _idw(dist, imp, power_parameter):
+        num, ncp = dist.shape
+        imp_new = np.zeros(num)
+        for l in prange(num):
+            total_weight = 0.
+            total = 0.
+            for k in range(ncp):
+                weight = 1./dist[l, k]**power_parameter
+                total_weight += weight
+                total += imp[l, k]*weight
+            imp_new[l] = total/total_weight
+        return imp_new
+
+    def threads():
+        num_threads = min(get_num_threads(), numba.config.NUMBA_NUM_THREADS)
+        if hasattr(numba, 'set_num_threads'):
+            numba.set_num_threads(num_threads)
+
+    def fa(m0, n0, zs, ts, funcnum):
+        threads()
+        return _fa(m0, n0, zs, ts, funcnum)
+
+    def fw0(m0, n0, c0, xs, ts, funcnum):
+        threads()
+        return _fw0(m0, n0, c0, xs, ts, funcnum)
+
+    def idw(dist, imp, power_parameter):
+        threads()
+        return _idw(dist, imp, float(power_parameter))
+
+    return dict(fa=fa, fw0=fw0, idw=idw)
+
+
+def _fa_numpy(m0, n0, zs, ts, funcnum):
+    n = zs.shape[0]
+    if funcnum==1:
+        a = np.array([[sin(i*pi*zs)*sin(j*ts), sin(i*pi*zs)*cos(j*ts)]
+                       for j in range(n0) for i in range(1, m0+1)])
+    elif funcnum==2:
+        a = np.array([[cos(i*pi*zs)*sin(j*ts), cos(i*pi*zs)*cos(j*ts)]
+                       for j in range(n0) for i in range(m0)])
+    elif funcnum==3:
+        a = np.array([[sin(i*pi*zs)*sin(j*ts), sin(i*pi*zs)*cos(j*ts),
+                       cos(i*pi*zs)*sin(j*ts), cos(i*pi*zs)*cos(j*ts)]
+                       for j in range(n0) for i in range(m0)])
+    return a.swapaxes(0,2).swapaxes(1,2).reshape(n,-1)
+
+
+def _fw0_numpy(m0, n0, c0, xs, ts, funcnum, chunksize=10000):
+    # the matrix with the base functions is built in chunks to limit the
+    # memory usage
+    w0s = np.zeros(xs.shape[0])
+    for i in range(0, xs.shape[0], chunksize):
+        a = _fa_numpy(m0, n0, xs[i:i+chunksize], ts[i:i+chunksize], funcnum)
+        w0s[i:i+chunksize] = a.dot(c0)
+    return w0s
+
+
+def _idw_numpy(dist, imp, power_parameter):
+    weight = 1./(dist**power_parameter)
+    return np.sum(imp*weight, axis=1)/np.sum(weight, axis=1)
+
+
+def _load_numpy():
+    return dict(fa=_fa_numpy, fw0=_fw0_numpy, idw=_idw_numpy)
+
+
+_loaders = dict(cython=_load_cython, numba=_load_numba, numpy=_load_numpy)
+
+
+def _load(backend):
+    if backend not in _loaders:
+        raise ValueError('Invalid backend: {0}, valid values are {1}'.format(
+                         backend, ', '.join(BACKENDS)))
+    if backend not in _loaded:
+        try:
+            _loaded[backend] = _loaders[backend]()
+        except Exception as e:
+            _loaded[backend] = e
+    return _loaded[backend]
+
+
+def available_backends():
+    """List of the backends that can be loaded in the current installation
+    """
+    return [b for b in BACKENDS if not isinstance(_load(b), Exception)]
+
+
+def set_backend(backend, kernels=None):
+    """Fixes the backend of one or more kernels
+
+    Parameters
+    ----------
+    backend : str or None
+        One of ``'cython'``, ``'numba'`` or ``'numpy'``. An ``ImportError``
+        is raised if the backend cannot be loaded. If ``None`` the default
+        selection is restored.
+    kernels : str, list or None, optional
+        The kernels that will use ``backend``. If ``None`` all kernels are
+        changed.
+
+    """
+    if kernels is None:
+        kernels = KERNELS
+    elif isinstance(kernels, str):
+        kernels = [kernels]
+    for kernel in kernels:
+        if kernel not in KERNELS:
+            raise ValueError('Invalid kernel: {0}'.format(kernel))
+    if backend is not None:
+        funcs = _load(backend)
+        if isinstance(funcs, Exception):
+            raise ImportError('Backend "{0}" is not available: {1}'.format(
+                              backend, funcs))
+    for kernel in kernels:
+        if backend is None:
+            _active.pop(kernel, None)
+        else:
+            _active[kernel] = backend
+
+
+def active_backend(kernel):
+    """The backend currently used by ``kernel``
+    """
+    if kernel not in KERNELS:
+        raise ValueError('Invalid kernel: {0}'.format(kernel))
+    if kernel not in _active:
+        backend = available_backends()[0]
+        if backend == 'numpy' and kernel in ('fa', 'fw0'):
+            if not _warned:
+                warn('No compiled backend available for "fa" and "fw0", '
+                     'using the much slower Python/NumPy backend'
+                     + '\n\t\tCompile _fit_data.pyx or install Numba, see '
+                     + 'desicos.conecylDB.kernels.report()', level=1)
+            _warned.add(kernel)
+        _active[kernel] = backend
+    return _active[kernel]
+
+
+def get_kernel(kernel):
+    """Returns the function that implements ``kernel`` in the active backend
+    """
+    return _load(active_backend(kernel))[kernel]
+
+
+def report():
+    """Logs and returns the available and the active backends
+
+    Returns
+    -------
+    out : dict
+        With keys ``'available'``, a dictionary with the availability of
+        each backend (``True`` or the error found when loading it),
+        ``'active'``, a dictionary with the backend of each kernel, and
+        ``'num_threads'``.
+
+    """
+    available = {}
+    for backend in BACKENDS:
+        funcs = _load(backend)
+        available[backend] = (True if not isinstance(funcs, Exception)
+                              else str(funcs))
+    active = dict((kernel, active_backend(kernel)) for kernel in KERNELS)
+    log('Kernel backends:')
+    for backend in BACKENDS:
+        msg = ('available' if available[backend] is True
+               else 'not available ({0})'.format(available[backend]))
+        log('{0:6s}: {1}'.format(backend, msg), level=1)
+    for kernel in KERNELS:
+        log('"{0}" uses "{1}"'.format(kernel, active[kernel]), level=1)
+    log('Threads: {0}'.format(get_num_threads()), level=1)
+    return dict(available=available, active=active,
+                num_threads=get_num_threads())
+
+
+def benchmark(num=20000, m0=20, n0=30, ncp=5, repeat=3, select=True):
+    """Times the available backends of each kernel on the current machine
+
+    Each backend is called once before timing, such that the compilation
+    time of the ``'numba'`` backend is not counted.
+
+    Parameters
+    ----------
+    num : int, optional
+        Number of points used in the timing.
+    m0, n0 : int, optional
+        Number of terms used for the ``'fa'`` and ``'fw0'`` kernels.
+    ncp : int, optional
+        Number of closest points used for the ``'idw'`` kernel.
+    repeat : int, optional
+        The best of ``repeat`` runs is taken.
+    select : bool, optional
+        If ``True`` the fastest backend of each kernel becomes active.
+
+    Returns
+    -------
+    times : dict
+        The time in seconds for each kernel and backend, e.g.
+        ``times['fa']['cython']``.
+
+    """
+    rs = np.random.RandomState(0)
+    zs = rs.rand(num)
+    ts = rs.rand(num)*2*pi
+    c0 = rs.rand(2*m0*n0)
+    dist = rs.rand(num, ncp) + 0.1
+    imp = rs.rand(num, ncp)
+    args = dict(fa=(m0, n0, zs[:num//10], ts[:num//10], 2),
+                fw0=(m0, n0, c0, zs, ts, 2),
+                idw=(dist, imp, 2.))
+    times = {}
+    log('Benchmark of the kernel backends')
+    for kernel in KERNELS:
+        times[kernel] = {}
+        for backend in available_backends():
+            func = _load(backend)[kernel]
+            func(*args[kernel])
+            best = None
+            for i in range(repeat):
+                t0 = time.time()
+                func(*args[kernel])
+                elapsed = time.time() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            times[kernel][backend] = best
+            log('"{0}" with "{1}": {2:1.4f} s'.format(kernel, backend, best),
+                level=1)
+        if select:
+            fastest = min(times[kernel], key=times[kernel].get)
+            set_backend(fastest, kernel)
+            log('"{0}" will use "{1}"'.format(kernel, fastest), level=1)
+    return times
@@ -1,10 +1,13 @@
 import os
+from random import sample
 import __main__
 
 import numpy as np
 
 from desicos.logger import log, warn
-from desicos.constants import FLOAT
+from desicos.constants import get_float
+from desicos.conecylDB.interpolate import inv_weighted
+from desicos.conecylDB.sidecar import load_txt
 
 DOC_COMMON = '''
     scaling_factor     - scales the original imperfection (default = 1.)
@@ -14,8 +17,9 @@ DOC_COMMON = '''
                          node (default = 5)
     power_parameter    - power of inverse weighted interpolation function
                          (default = 2.)
-    num_sec_z          - number of cross-sections in Z to classify the measured
-                         points (default = 25)
+    num_sec_z          - not used anymore, kept for backward compatibility
+    workers            - number of processes used to interpolate the nodal
+                         translations in parallel (default = 1)
 '''
 def read_file(file_name,
                frequency             = 1,
@@ -24,7 +28,8 @@ def read_file(file_name,
                R_best_fit            = None,
                stretch_H             = False,
                z_offset_bot            = None,
-               r_TOL                 = 1.):
+               r_TOL                 = 1.,
+               dtype                 = None):
     log('Reading imperfection file: {0} ...'.format(file_name))
     # user warnings
     if stretch_H:
@@ -33,7 +38,7 @@ def read_file(file_name,
                  'consider setting z_offset_bot to None')
     # reading the imperfection file
     ignore = False
-    mps = np.loadtxt(file_name, dtype=FLOAT)
+    mps = load_txt(file_name, dtype=dtype)
     r = np.sqrt(mps[:, 0]**2 + mps[:, 1]**2)
     # measuring model dimensions
     if R_best_fit is None:
@@ -147,8 +152,11 @@ def calc_nodal_translations(imperfection_file_name,
                             r_TOL,
                             num_closest_points,
                             power_parameter,
-                            num_sec_z,
-                            sample_size):
+                            num_sec_z=25,
+                            sample_size=None,
+                            workers=1,
+                            dtype=None,
+                            backend=None):
     # reading imperfection file
     m, o, mps = read_file(file_name = imperfection_file_name,
                           H_measured = H_measured,
@@ -156,7 +164,8 @@ def calc_nodal_translations(imperfection_file_name,
                           forced_average_radius = R_best_fit,
                           stretch_H = stretch_H,
                           z_offset_bot = z_offset_bot,
-                          r_TOL = r_TOL)
+                          r_TOL = r_TOL,
+                          dtype = dtype)
 
     log('Calculating nodal translations!')
     if sample_size:
@@ -164,7 +173,6 @@ def calc_nodal_translations(imperfection_file_name,
         if sample_size < num:
             log('Using sample_size={0}'.format(sample_size), level=1)
             mps = mps[sample(range(num), int(sample_size)), :]
-    num_nodes = nodes.shape[0]
     R_top = R_model - np.tan(np.deg2rad(semi_angle)) * H_model
     semi_angle = abs(semi_angle)
     def local_radius(z):
@@ -174,92 +182,34 @@ def calc_nodal_translations(imperfection_file_name,
         R_local = R_model
     else:
         R_local = local_radius(mps[:, 2])
+    r_norm = np.sqrt(mps[:, 0]**2 + mps[:, 1]**2)
     thetarads = np.arctan2(mps[:, 1], mps[:, 0])
     if rotatedeg:
         thetarads += np.deg2rad(rotatedeg)
-    mps[:, 0] = R_local*np.cos(thetarads)
-    mps[:, 1] = R_local*np.sin(thetarads)
-    num_sec_z = int(num_sec_z)
-    mem_limit = 1024*1024*1024*8*2    # 2 GB
-    mem_entries = int(mem_limit / 64) # if float64 is used
-    sec_size = int(num_nodes/num_sec_z)
-    #TODO better memory control...
-    if sec_size**2*10 > mem_entries:
-        while True:
-            num_sec_z +=1
-            sec_size = int(num_nodes/num_sec_z)
-            if sec_size**2*10 <= mem_entries:
-                warn('New sec_size {0}'.format(sec_size))
-                break
-    ncp = num_closest_points
-    nodes = nodes[np.argsort(nodes[:, 2])]
-    mps = mps[np.argsort(mps[:, 2])]
+    mps[:, 0] = r_norm*R_local*np.cos(thetarads)
+    mps[:, 1] = r_norm*R_local*np.sin(thetarads)
+    # the closest points are found using a spatial index, the weights are
+    # based on the squared distances, hence the doubled power parameter
+    data = np.column_stack((mps[:, :3], r_norm))
+    dist, r_new = inv_weighted(data, nodes[:, :3],
+                               ncp=num_closest_points,
+                               power_parameter=2*power_parameter,
+                               backend=backend, workers=workers)
+    r_new *= local_radius(nodes[:, 2])
+    #NOTE modified after Regina, Mariano and Saullo decided to use
+    #     the imperfection amplitude constant along the whole cone
+    #     surface, which represents better the real manufacturing
+    #     conditions. In that case the amplitude will be re-scaled
+    #     using only  the bottom radius
+    # calculating the local radius for the nodes for the new assumption
+    r_local_nodes = np.sqrt(nodes[:, 0]**2 + nodes[:, 1]**2)
+    # calculating the scaling factor required for the new assumption
+    sf = R_model/r_local_nodes
+    theta = np.arctan2(nodes[:, 1], nodes[:, 0])
     nodal_t = np.zeros(nodes.shape, dtype=nodes.dtype)
-    limit = int(num_sec_z/5)
-    for i in xrange(num_sec_z+1):
-        i_inf = sec_size*i
-        i_sup = sec_size*(i+1)
-        if i % limit == 0:
-            log('processed {0:7d} out of {1:7d} entries'.format(
-                min(i_sup, num_nodes), num_nodes), level=1)
-        sub_nodes = nodes[i_inf : i_sup]
-        if not np.any(sub_nodes):
-            continue
-        inf_z = sub_nodes[:, 2].min()
-        sup_z = sub_nodes[:, 2].max()
-        tol = 0.01
-        if i == 0 or i == num_sec_z:
-            tol = 0.05
-        while True:
-            cond1 = mps[:, 2] >= inf_z - tol*H_model
-            cond2 = mps[:, 2] <= sup_z + tol*H_model
-            cond = np.all(np.array((cond1, cond2)), axis=0)
-            sub_mps = mps[cond]
-            if not np.any(sub_mps):
-                tol += 0.01
-            else:
-                break
-        dist  = np.subtract.outer(sub_nodes[:, 0], sub_mps[:, 0])**2
-        dist += np.subtract.outer(sub_nodes[:, 1], sub_mps[:, 1])**2
-        dist += np.subtract.outer(sub_nodes[:, 2], sub_mps[:, 2])**2
-        asort = np.argsort(dist, axis=1)
-        lenn = sub_nodes.shape[0]
-        lenp = sub_mps.shape[0]
-        asort_mesh = asort + np.meshgrid(np.arange(lenn)*lenp,
-                                         np.arange(lenp))[0].transpose()
-        # getting the z coordinate of the closest points
-        sub_mps_z = np.take(sub_mps[:, 2], asort[:, :ncp])
-        # getting the distance of the closest points
-        dist_ncp = np.take(dist, asort_mesh[:, :ncp])
-        # avoiding division by zero
-        dist_ncp[(dist_ncp==0)] == 1.e-12
-        # calculating the radius of the sub-group of measured points
-        radius = np.sqrt(sub_mps[:, 0]**2 + sub_mps[:, 1]**2)
-        # taking only the radius of the closest points
-        radius_ncp = np.take(radius, asort[:, :ncp])
-        # weight calculation
-        total_weight = np.sum(1./(dist_ncp**power_parameter), axis=1)
-        weight = 1./(dist_ncp**power_parameter)
-        # calculating the local radius for the closest points
-        r_local_ncp = local_radius(sub_mps_z)
-        # computing the new radius
-        r_new = np.sum(radius_ncp*weight/r_local_ncp, axis=1)/total_weight
-        r_new *= local_radius(sub_nodes[:, 2])
-        #NOTE modified after Regina, Mariano and Saullo decided to use
-        #     the imperfection amplitude constant along the whole cone
-        #     surface, which represents better the real manufacturing
-        #     conditions. In that case the amplitude will be re-scaled
-        #     using only  the bottom radius
-        # calculating the local radius for the nodes for the new assumption
-        r_local_nodes = np.sqrt(sub_nodes[:,0]**2 + sub_nodes[:, 1]**2)
-        # calculating the scaling factor required for the new assumption
-        sf = R_model/r_local_nodes
-        theta = np.arctan2(sub_nodes[:, 1], sub_nodes[:, 0])
-        nodal_t[i_inf : i_sup][:, 0] = \
-                (r_new*np.cos(theta) - sub_nodes[:, 0])*sf
-        nodal_t[i_inf : i_sup][:, 1] = \
-                (r_new*np.sin(theta) - sub_nodes[:, 1])*sf
-        nodal_t[i_inf : i_sup][:, 3] = sub_nodes[:, 3]
+    nodal_t[:, 0] = (r_new*np.cos(theta) - nodes[:, 0])*sf
+    nodal_t[:, 1] = (r_new*np.sin(theta) - nodes[:, 1])*sf
+    nodal_t[:, 3] = nodes[:, 3]
     nodal_t = nodal_t[np.argsort(nodal_t[:, 3])]
     log('Nodal translations calculated!')
 
@@ -269,7 +219,7 @@ def calc_nodal_translations(imperfection_file_name,
 def get_nodes_from_txt_file(nodes_file_name):
     '''The file name must be: x y z node_id
     '''
-    nodes = np.loadtxt(nodes_file_name, dtype=FLOAT)
+    nodes = np.loadtxt(nodes_file_name, dtype=get_float())
     nodes = nodes[np.argsort(nodes[:, 3])]
     return
 
@@ -289,7 +239,8 @@ def disturb_my_model(imperfection_file_name,
                      num_closest_points=5,
                      power_parameter=2,
                      num_sec_z=25,
-                     sample_size=None):
+                     sample_size=None,
+                     workers=1):
     # reading nodes data
     log('Reading nodes data from {0} ...'.format(nodes_file_name))
     nodes = get_nodes_from_txt_file(nodes_file_name)
@@ -309,7 +260,8 @@ def disturb_my_model(imperfection_file_name,
                                      num_closest_points = num_closest_points,
                                      power_parameter = power_parameter,
                                      num_sec_z = num_sec_z,
-                                     sample_size=sample_size)
+                                     sample_size=sample_size,
+                                     workers=workers)
     # writing output file
     log('Writing output file "{0}" ...'.format(output_file_name))
     outfile = open(output_file_name, 'w')
@@ -13,12 +13,15 @@ import numpy as np
 
 from desicos.constants import *
 from desicos.logger import *
-from desicos.conecylDB.fit_data import best_fit_cylinder
+from desicos.conecylDB.fit_data import best_fit_cylinder, best_fit_cone
+from desicos.conecylDB.sidecar import load_txt
+from desicos.conecylDB.stream import iter_blocks
 
 def read_theta_z_imp(path,
                      H_measured=None,
                      stretch_H=False,
-                     z_offset_bot=None):
+                     z_offset_bot=None,
+                     dtype=None):
     r"""Read an imperfection file in the format `\theta`, `z`, imperfection.
 
     Where the angles `\theta` are given in radians.
@@ -49,6 +52,9 @@ def read_theta_z_imp(path,
     z_offset_bot : float, optional
         The offset that should be used from the bottom of the measured points
         to the bottom of the test specimen.
+    dtype : str or None, optional
+        The floating point type of the returned arrays. If ``None`` the
+        global type given by :func:`desicos.constants.get_float` is used.
 
     Returns
     -------
@@ -68,12 +74,13 @@ def read_theta_z_imp(path,
             warn('Because of the stretch_H option,\n\t' +
                  'consider setting "z_offset_bot" to None')
     # reading the imperfection file
+    dtype = get_float(dtype)
     if isinstance(path, np.ndarray):
         log('Reading imperfection array: ...')
-        mps = path
+        mps = np.asarray(path, dtype=dtype)
     else:
         log('Reading imperfection file: {0} ...'.format(path))
-        mps = np.loadtxt(path, dtype=FLOAT)
+        mps = load_txt(path, dtype=dtype)
 
     # measuring model dimensions
     z_min = mps[:, 1].min()
@@ -116,7 +123,8 @@ def read_xyz(path,
              H_measured=None,
              stretch_H=False,
              z_offset_bot=None,
-             r_TOL=1.):
+             r_TOL=1.,
+             dtype=None):
     r"""Read an imperfection file in the format `x`, `y`, `z`.
 
     Example of input file::
@@ -153,6 +161,9 @@ def read_xyz(path,
     r_TOL : float, optional
         The tolerance used to ignore points farer than ``r_TOL*R_best_fit``,
         given in percent.
+    dtype : str or None, optional
+        The floating point type of the returned arrays. If ``None`` the
+        global type given by :func:`desicos.constants.get_float` is used.
 
     Returns
     -------
@@ -173,10 +184,11 @@ def read_xyz(path,
             warn('Because of the stretch_H option,\n\t' +
                  'consider setting "z_offset_bot" to None')
     # reading the imperfection file
+    dtype = get_float(dtype)
     if isinstance(path, np.ndarray):
-        mps = path
+        mps = np.asarray(path, dtype=dtype)
     else:
-        mps = np.loadtxt(path, dtype=FLOAT)
+        mps = load_txt(path, dtype=dtype)
     r = np.sqrt(mps[:, 0]**2 + mps[:, 1]**2)
     # measuring model dimensions
     if R_best_fit is None:
@@ -227,6 +239,35 @@ def read_xyz(path,
 
     return mps, offset_mps, norm_mps
 
+def transform_blocks(T, xyz):
+    r"""Applies a transformation matrix to `x`, `y`, `z` points by blocks
+
+    Avoids the temporary `4 \times N` array with homogeneous coordinates,
+    which for large measurements can be bigger than the data itself.
+
+    Parameters
+    ----------
+    T : np.ndarray
+        The ``3 x 4`` transformation matrix, as returned by
+        :func:`.best_fit_cylinder`.
+    xyz : np.ndarray
+        A 2-D array with `x`, `y`, `z` in each column, possibly
+        memory-mapped.
+
+    Returns
+    -------
+    x, y, z : np.ndarray
+        The transformed coordinates.
+
+    """
+    out = np.empty((3, xyz.shape[0]))
+    start = 0
+    for block in iter_blocks(xyz, dtype='float64'):
+        stop = start + block.shape[0]
+        out[:, start:stop] = T[:, :3].dot(block.T) + T[:, 3:]
+        start = stop
+    return out
+
 def xyz2thetazimp(path,
                   alphadeg_measured,
                   H_measured,
@@ -279,7 +320,9 @@ def xyz2thetazimp(path,
         If ``True`` it overwrites the values for: ``R_expected`` (for
         cylinders and cones) and ``z_offset_bot`` (for cones), which are
         automatically determined with functions :func:`.best_fit_cylinder` and
-        :func:`.best_fit_cone`.
+        :func:`.best_fit_cone`. The imperfection is then measured normal to
+        the best-fit surface. If ``False`` the imperfection is the radial
+        distance ``r - R_expected``.
     best_fit_output : bool, optional
         If the output from the best fit routines should be also returned. In
         case ``True`` the output of this function will be a tuple with
@@ -325,24 +368,32 @@ def xyz2thetazimp(path,
         above.
 
     """
+    alpharad = np.deg2rad(alphadeg_measured)
     if use_best_fit:
         log('Finding the best-fit ...')
+        xyz = load_txt(path, dtype='float64')
         if alphadeg_measured==0.:
-            out = best_fit_cylinder(path, R_expected=R_expected, H=H_measured,
+            out = best_fit_cylinder(xyz, R_expected=R_expected, H=H_measured,
                     save=False, sample_size=sample_size,
                     errorRtol=errorRtol)
-            R_best_fit = out['R_best_fit']
-            input_pts = np.loadtxt(path, unpack=True)
-            pts = np.vstack((input_pts, np.ones_like(input_pts[0, :])))
-            x, y, z = out['T'].dot(pts)
-            zmin = z.min()
-            zmax = z.max()
-            z -= zmin
-            H_points = zmax - zmin
-            if z_offset_bot:
-                z += z_offset_bot
-            else:
-                z += (H_measured - H_points)/2. # centralizes the points
+        else:
+            out = best_fit_cone(xyz, H=H_measured,
+                    alphadeg=alphadeg_measured, R_expected=R_expected,
+                    save=False, sample_size=sample_size,
+                    errorRtol=errorRtol)
+            alpharad = np.deg2rad(out['alphadeg_best_fit'])
+        R_best_fit = out['R_best_fit']
+        x, y, z = transform_blocks(out['T'], xyz)
+        zmin = z.min()
+        zmax = z.max()
+        H_points = zmax - zmin
+        if z_offset_bot:
+            z_shift = z_offset_bot - zmin
+        else:
+            z_shift = (H_measured - H_points)/2. - zmin # centralizes the points
+        z += z_shift
+        # bottom radius at the new origin of the z coordinates
+        R_best_fit += z_shift*np.tan(alpharad)
     else:
         R_best_fit = R_expected
         log('Reading the data ...')
@@ -370,7 +421,11 @@ def xyz2thetazimp(path,
 
     r = np.sqrt(x**2 + y**2)
     theta = np.arctan2(y, x)
-    imp = r - R_best_fit
+    if use_best_fit:
+        # imperfection normal to the best-fit cone surface
+        imp = (r - (R_best_fit - z*np.tan(alpharad)))*np.cos(alpharad)
+    else:
+        imp = r - R_best_fit
     log('Minimum imperfection: {0}'.format(imp.min()))
     log('Maximum imperfection: {0}'.format(imp.max()))
 
@@ -398,7 +453,8 @@ def xyzthick2thetazthick(path,
                          r_TOL=1.,
                          save=True,
                          fmt='%1.6f',
-                         rotatedeg=None):
+                         rotatedeg=None,
+                         best_fit_output=False):
     r"""Transforms an imperfection file from the format: "`x` `y` `z` `thick`"
     to the format "`\theta` `z` `thick`".
 
@@ -453,6 +509,11 @@ def xyzthick2thetazthick(path,
     rotatedeg : float or None, optional
         Rotation angle in degrees telling how much the imperfection pattern
         should be rotated about the `X_3` (or `Z`) axis.
+    best_fit_output : bool, optional
+        If the output from the best fit routines should be also returned. In
+        case ``True`` the output of this function will be a tuple with
+        ``(mps, out)``, where ``out`` is ``None`` if no best fit was done.
+        For a description of ``out`` see :func:`.best_fit_cylinder`.
 
     Returns
     -------
@@ -460,8 +521,13 @@ def xyzthick2thetazthick(path,
         A 2-D array with `\theta`, `z`, `imp` in the first, second
         and third columns, respectively.
 
+    mps, out : np.ndarray, dict
+        If ``best_fit_output==True`` it returns ``(mps, out)`` as described
+        above.
+
     """
-    inputa = np.loadtxt(path)
+    out = None
+    inputa = load_txt(path, dtype='float64')
     if inputa.shape[1] != 4:
         raise ValueError('Input file does not have the format: "x y z thick"')
 
@@ -474,9 +540,7 @@ def xyzthick2thetazthick(path,
             out = best_fit_cylinder(xyz, R_expected=R_expected, H=H_measured,
                     save=False, sample_size=sample_size)
             R_best_fit = out['R_best_fit']
-            input_pts = np.loadtxt(path, unpack=True)[:, :3]
-            pts = np.vstack((input_pts, np.ones_like(input_pts[0, :])))
-            x, y, z = out['T'].dot(pts)
+            x, y, z = transform_blocks(out['T'], xyz)
             z -= z.min()
             H_points = z.max() - z.min()
             if z_offset_bot:
@@ -502,5 +566,7 @@ def xyzthick2thetazthick(path,
         outpath = ('.'.join(os.path.basename(path).split('.')[:-1]) +
                    '_theta_z_thick.txt')
         np.savetxt(outpath, mps, fmt=fmt)
-
-    return mps
+    if best_fit_output:
+        return mps, out
+    else:
+        return mps
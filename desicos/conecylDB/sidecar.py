@@ -0,0 +1,261 @@
+r"""
+Sidecar (:mod:`desicos.conecylDB.sidecar`)
+==========================================
+
+.. currentmodule:: desicos.conecylDB.sidecar
+
+Cached reading of text data files.
+
+The first time a text file is read with :func:`.load_txt` the parsed array
+is saved in a binary ``.npy`` sidecar file, together with a small ``.json``
+file describing the source file (size, modification time and SHA-1 hash of
+the contents). The following reads memory-map the sidecar instead of
+parsing the text again, such that many processes reading the same
+measurement share the same memory pages.
+
+The sidecars are kept in a cache directory, by default ``sidecar`` under
+:data:`desicos.constants.TMP_DIR` (see :func:`.set_sidecar_dir`), and are
+named after the absolute path of the source file, such that the
+directories of the data files are never written.
+
+A sidecar is used only if the source file has the same size and
+modification time recorded when it was created. If only the modification
+time changed, as it happens when a file is copied, the contents hash is
+computed and the sidecar is kept if it matches. Otherwise the text file is
+parsed again and the sidecar rewritten.
+
+"""
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from desicos.logger import *
+from desicos.constants import TMP_DIR, get_float
+from desicos.conecylDB.stream import read_blocks, save_blocks
+
+
+VERSION = 1
+_config = dict(enabled=True, cache_dir=None)
+
+
+def set_sidecar(enabled):
+    """Enables or disables the sidecar files globally
+
+    When disabled :func:`.load_txt` always parses the text files and does
+    not write sidecars.
+
+    """
+    _config['enabled'] = bool(enabled)
+
+
+def set_sidecar_dir(cache_dir):
+    """Changes the directory where the sidecar files are kept
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        The directory. If ``None`` the default ``sidecar`` directory under
+        :data:`desicos.constants.TMP_DIR` is used.
+
+    """
+    _config['cache_dir'] = cache_dir
+
+
+def sidecar_dir():
+    """The directory where the sidecar files are kept
+    """
+    cache_dir = _config['cache_dir']
+    if cache_dir is None:
+        cache_dir = os.path.join(TMP_DIR, 'sidecar')
+    return os.path.abspath(os.path.expanduser(cache_dir))
+
+
+def sidecar_paths(path, dtype=None):
+    """The paths of the ``.npy`` and ``.json`` sidecars of a text file
+
+    Parameters
+    ----------
+    path : str
+        The path of the text file.
+    dtype : str, numpy.dtype or None, optional
+        The floating point type of the array, each type has its own sidecar.
+
+    """
+    path = os.path.abspath(path)
+    # the hash of the absolute path keeps apart files with the same name
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    name = '{0}_{1}.{2}'.format(key, os.path.basename(path),
+                                np.dtype(get_float(dtype)).name)
+    name = os.path.join(sidecar_dir(), name)
+    return name + '.npy', name + '.json'
+
+
+def file_hash(path, blocksize=2**20):
+    """SHA-1 hash of the contents of a file, read in blocks
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _source_info(path):
+    stat = os.stat(path)
+    return dict(size=stat.st_size, mtime=stat.st_mtime)
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_atomic(path, write):
+    """Writes a file atomically
+
+    The file is written by ``write(tmp)`` with a temporary name in the same
+    directory and then renamed, such that other processes never find a
+    partially written file and a crash never leaves one behind.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+    write : callable
+        Function that receives the temporary path and writes the file.
+
+    """
+    dirpath = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirpath, prefix='.tmp_')
+    os.close(fd)
+    try:
+        write(tmp)
+        if hasattr(os, 'replace'):
+            os.replace(tmp, path)
+        else:
+            if os.path.isfile(path):
+                os.remove(path)
+            os.rename(tmp, path)
+    except:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _json_writer(meta):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+    return write
+
+
+def is_valid(path, dtype=None):
+    """Checks if the sidecar of a text file can be used
+
+    Parameters
+    ----------
+    path : str
+        The path of the text file.
+    dtype : str, numpy.dtype or None, optional
+        The floating point type of the array.
+
+    Returns
+    -------
+    valid : bool
+
+    """
+    npy_path, meta_path = sidecar_paths(path, dtype)
+    meta = _read_meta(meta_path)
+    if (meta is None or meta.get('version') != VERSION
+        or not os.path.isfile(npy_path)):
+        return False
+    info = _source_info(path)
+    if meta['size'] != info['size']:
+        return False
+    if meta['mtime'] == info['mtime']:
+        return True
+    if meta['sha1'] != file_hash(path):
+        return False
+    # same contents with a new modification time
+    meta['mtime'] = info['mtime']
+    try:
+        write_atomic(meta_path, _json_writer(meta))
+    except (IOError, OSError):
+        pass
+    return True
+
+
+def load_txt(path, dtype=None, mmap_mode='c', sidecar=None):
+    """Reads a text data file using a binary sidecar cache
+
+    Parameters
+    ----------
+    path : str
+        The path of the text file, readable by ``np.loadtxt``.
+    dtype : str, numpy.dtype or None, optional
+        The floating point type of the returned array. If ``None`` the
+        global type given by :func:`desicos.constants.get_float` is used.
+    mmap_mode : str or None, optional
+        The mode used to memory-map the sidecar (see ``np.load``). The
+        default ``'c'`` (copy-on-write) shares the pages among processes
+        while allowing the returned array to be changed in memory. Use
+        ``None`` to read the sidecar into memory.
+    sidecar : bool or None, optional
+        If the sidecar should be used. If ``None`` the global setting of
+        :func:`.set_sidecar` is used.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        The same array returned by ``np.loadtxt(path, dtype=dtype)``. The
+        text is parsed in chunks by :func:`.stream.iter_blocks`, such that
+        it is never held in memory as a whole.
+
+    Notes
+    -----
+    When the sidecar cannot be written, e.g. in a read-only directory, a
+    warning is issued and the parsed array is returned.
+
+    """
+    dtype = get_float(dtype)
+    if sidecar is None:
+        sidecar = _config['enabled']
+    if not sidecar:
+        return read_blocks(path, dtype=dtype)
+
+    npy_path, meta_path = sidecar_paths(path, dtype)
+    if is_valid(path, dtype):
+        try:
+            return _load_npy(npy_path, mmap_mode)
+        except (IOError, OSError, ValueError):
+            warn('Invalid sidecar {0}, parsing the text file'.format(
+                 npy_path), level=1)
+
+    info = _source_info(path)
+    meta = dict(version=VERSION, size=info['size'], mtime=info['mtime'],
+                sha1=file_hash(path), dtype=np.dtype(dtype).name)
+    try:
+        if not os.path.isdir(sidecar_dir()):
+            os.makedirs(sidecar_dir())
+        # the text is parsed in chunks directly into the sidecar
+        write_atomic(npy_path,
+                     lambda tmp: save_blocks(path, tmp, dtype=dtype))
+        write_atomic(meta_path, _json_writer(meta))
+        log('Sidecar written: {0}'.format(npy_path), level=1)
+    except (IOError, OSError) as e:
+        warn('Sidecar could not be written: {0}'.format(e), level=1)
+        return read_blocks(path, dtype=dtype)
+    return _load_npy(npy_path, mmap_mode)
+
+
+def _load_npy(npy_path, mmap_mode):
+    # a plain ndarray view of the memory-mapped file is returned, such that
+    # the results of the calculations are not numpy.memmap objects
+    return np.asarray(np.load(npy_path, mmap_mode=mmap_mode))
@@ -0,0 +1,323 @@
+r"""
+Stream (:mod:`desicos.conecylDB.stream`)
+========================================
+
+.. currentmodule:: desicos.conecylDB.stream
+
+Constant-memory reading of large measured data files.
+
+Laser scanners produce files with tens of millions of points, for which
+``np.loadtxt`` needs many times the file size in memory. The functions of
+this module read the text in fixed-size chunks, parse each chunk with the
+fast tokenizer of ``np.fromstring`` and yield blocks of rows as NumPy
+arrays. Reducers, such as :class:`.BoundingBox`, :class:`.RadiusStats` and
+:class:`.ReservoirSample`, can be updated with each block while the file is
+read, see :func:`.scan`.
+
+The same functions accept arrays, which are then processed in blocks of
+rows, allowing the same code to consume a text file or a memory-mapped
+array (see :func:`desicos.conecylDB.sidecar.load_txt`).
+
+"""
+from __future__ import absolute_import
+import io
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from desicos.logger import *
+from desicos.constants import get_float
+
+
+BLOCKSIZE = 2**24
+
+
+def _parse(chunk, dtype, ncols):
+    try:
+        values = np.fromstring(chunk, dtype=dtype, sep=' ')
+        if ncols is None or values.shape[0] % ncols != 0:
+            raise ValueError('Irregular number of columns')
+        return values.reshape(-1, ncols)
+    except ValueError:
+        # comments, delimiters or irregular lines are handled by np.loadtxt
+        return np.loadtxt(io.BytesIO(chunk), dtype=dtype, ndmin=2)
+
+
+def iter_blocks(source, blocksize=BLOCKSIZE, dtype=None):
+    """Yields the rows of a data file or array in blocks
+
+    Parameters
+    ----------
+    source : str or numpy.ndarray
+        The path of a text file, readable by ``np.loadtxt``, or a 2-D array.
+    blocksize : int, optional
+        The size of each block in bytes. For text files this is the size of
+        the text parsed at once.
+    dtype : str, numpy.dtype or None, optional
+        The floating point type of the blocks. If ``None`` the global type
+        given by :func:`desicos.constants.get_float` is used.
+
+    Yields
+    ------
+    block : numpy.ndarray
+        A 2-D array with some rows of the data.
+
+    """
+    dtype = get_float(dtype)
+    if isinstance(source, np.ndarray):
+        rows = max(1, blocksize//max(1, source[:1].nbytes))
+        for i in range(0, source.shape[0], rows):
+            yield np.asarray(source[i:i+rows], dtype=dtype)
+        return
+
+    ncols = None
+    tail = b''
+    with open(source, 'rb') as f:
+        while True:
+            chunk = f.read(blocksize)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            # the incomplete last line is kept for the next chunk
+            end = chunk.rfind(b'\n') + 1
+            if end == 0:
+                tail = chunk
+                continue
+            tail = chunk[end:]
+            if ncols is None:
+                # number of columns from the first lines
+                head = b'\n'.join(chunk[:end].split(b'\n', 100)[:100])
+                first = np.loadtxt(io.BytesIO(head), dtype=dtype, ndmin=2)
+                ncols = first.shape[1] if first.size else None
+            block = _parse(chunk[:end], dtype, ncols)
+            if block.size:
+                yield block
+        if tail.strip():
+            block = _parse(tail, dtype, ncols)
+            if block.size:
+                yield block
+
+
+def read_blocks(source, blocksize=BLOCKSIZE, dtype=None):
+    """Reads a whole data file using :func:`.iter_blocks`
+
+    Only the returned array and one text chunk are held in memory, instead
+    of the text of the whole file.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        A 2-D array with the rows of the file.
+
+    """
+    blocks = list(iter_blocks(source, blocksize, dtype))
+    if not blocks:
+        return np.zeros((0, 0), dtype=get_float(dtype))
+    return np.concatenate(blocks)
+
+
+def save_blocks(source, npy_path, blocksize=BLOCKSIZE, dtype=None):
+    """Parses a data file into a ``.npy`` file using constant memory
+
+    The blocks are appended to a temporary file, which is copied after the
+    ``.npy`` header once the total number of rows is known.
+
+    Parameters
+    ----------
+    source : str
+        The path of the text file.
+    npy_path : str
+        The path of the ``.npy`` file that will be written.
+    blocksize : int, optional
+        The size of the text parsed at once, in bytes.
+    dtype : str, numpy.dtype or None, optional
+        The floating point type.
+
+    Returns
+    -------
+    shape : tuple
+        The shape of the saved array.
+
+    """
+    dtype = np.dtype(get_float(dtype))
+    dirpath = os.path.dirname(os.path.abspath(npy_path))
+    fd, raw_path = tempfile.mkstemp(dir=dirpath, prefix='.tmp_')
+    try:
+        num = 0
+        ncols = 0
+        with os.fdopen(fd, 'wb') as raw:
+            for block in iter_blocks(source, blocksize, dtype):
+                if ncols and block.shape[1] != ncols:
+                    raise ValueError('Irregular number of columns in {0}'.
+                                     format(source))
+                ncols = block.shape[1]
+                num += block.shape[0]
+                raw.write(np.ascontiguousarray(block).tobytes())
+        header = dict(descr=np.lib.format.dtype_to_descr(dtype),
+                      fortran_order=False, shape=(num, ncols))
+        with open(npy_path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            with open(raw_path, 'rb') as raw:
+                shutil.copyfileobj(raw, f, BLOCKSIZE)
+    finally:
+        os.remove(raw_path)
+    return (num, ncols)
+
+
+def scan(source, reducers, blocksize=BLOCKSIZE, dtype=None):
+    """Updates many reducers in a single pass over a data file or array
+
+    Parameters
+    ----------
+    source : str or numpy.ndarray
+        See :func:`.iter_blocks`.
+    reducers : list
+        Objects with an ``update(block)`` method, such as
+        :class:`.BoundingBox`, :class:`.RadiusStats` or
+        :class:`.ReservoirSample`.
+
+    Returns
+    -------
+    reducers : list
+        The same reducers given as input.
+
+    """
+    for block in iter_blocks(source, blocksize, dtype):
+        for reducer in reducers:
+            reducer.update(block)
+    return reducers
+
+
+class BoundingBox(object):
+    """Minimum and maximum values of each column
+
+    Attributes
+    ----------
+    num : int
+        Number of rows processed.
+    min, max : numpy.ndarray or None
+        The minimum and maximum values of each column.
+
+    """
+    def __init__(self):
+        self.num = 0
+        self.min = None
+        self.max = None
+
+    def update(self, block):
+        if not block.shape[0]:
+            return
+        bmin = block.min(axis=0)
+        bmax = block.max(axis=0)
+        if self.min is None:
+            self.min = bmin
+            self.max = bmax
+        else:
+            self.min = np.minimum(self.min, bmin)
+            self.max = np.maximum(self.max, bmax)
+        self.num += block.shape[0]
+
+
+class RadiusStats(object):
+    r"""Statistics of the radius `\sqrt{x^2 + y^2}` of the points
+
+    The mean and the variance of each block are combined with the previous
+    ones using the parallel algorithm of Chan et al., which is numerically
+    stable.
+
+    Parameters
+    ----------
+    cols : tuple, optional
+        The columns with the `x` and `y` coordinates.
+
+    Attributes
+    ----------
+    num : int
+        Number of points processed.
+    mean, std, min, max : float
+        The statistics of the radius.
+
+    """
+    def __init__(self, cols=(0, 1)):
+        self.cols = cols
+        self.num = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2/self.num) if self.num else 0.
+
+    def update(self, block):
+        if not block.shape[0]:
+            return
+        x = block[:, self.cols[0]].astype(float)
+        y = block[:, self.cols[1]].astype(float)
+        r = np.sqrt(x**2 + y**2)
+        n = r.shape[0]
+        mean = r.mean()
+        m2 = ((r - mean)**2).sum()
+        total = self.num + n
+        delta = mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += m2 + delta**2*self.num*n/total
+        self.num = total
+        self.min = min(self.min, r.min())
+        self.max = max(self.max, r.max())
+
+
+class ReservoirSample(object):
+    """Uniform random sample of the rows, without replacement
+
+    Each row receives a random key and the rows with the ``size`` smallest
+    keys are kept, which gives a uniform sample of all the rows processed
+    using only the memory of the sample.
+
+    Parameters
+    ----------
+    size : int
+        The size of the sample.
+    seed : int or None, optional
+        Seed of the random number generator.
+
+    Attributes
+    ----------
+    num : int
+        Number of rows processed.
+    sample : numpy.ndarray or None
+        The sampled rows, in the order they were read.
+
+    """
+    def __init__(self, size, seed=None):
+        self.size = int(size)
+        self.num = 0
+        self.rs = np.random.RandomState(seed)
+        self.keys = np.zeros(0)
+        self.order = np.zeros(0, dtype=np.int64)
+        self.sample = None
+
+    def update(self, block):
+        n = block.shape[0]
+        if not n:
+            return
+        keys = np.concatenate((self.keys, self.rs.rand(n)))
+        order = np.concatenate((self.order,
+                                self.num + np.arange(n, dtype=np.int64)))
+        if self.sample is None:
+            rows = block
+        else:
+            rows = np.concatenate((self.sample, block))
+        if keys.shape[0] > self.size:
+            keep = np.argpartition(keys, self.size - 1)[:self.size]
+            keep = keep[np.argsort(order[keep])]
+            keys = keys[keep]
+            order = order[keep]
+            rows = rows[keep]
+        self.keys = keys
+        self.order = order
+        self.sample = np.array(rows)
+        self.num += n
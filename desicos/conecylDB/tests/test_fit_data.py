@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from desicos.conecylDB import fit_data
+
+
+def _cone(R, alphadeg, H, num=40000, tilted=False, seed=0):
+    rs = np.random.RandomState(seed)
+    theta = 2*np.pi*rs.rand(num)
+    z = H*rs.rand(num)
+    r = R - z*np.tan(np.deg2rad(alphadeg)) + 0.05*rs.randn(num)
+    pts = np.vstack((r*np.cos(theta), r*np.sin(theta), z))
+    if tilted:
+        pts = fit_data._rotation(np.deg2rad(2.), np.deg2rad(1.)).dot(pts)
+        pts += np.array([5., -3., 20.])[:, None]
+    return pts
+
+
+def _round_trip(out):
+    pts = out['input_pts']
+    ones = np.ones_like(pts[0])
+    new = out['T'].dot(np.vstack((pts, ones)))
+    assert np.allclose(new, out['output_pts'])
+    back = out['Tinv'].dot(np.vstack((new, ones)))
+    return np.abs(back - pts).max()
+
+
+@pytest.mark.parametrize('tilted', [False, True])
+@pytest.mark.parametrize('sample_size', [None, 2000])
+def test_best_fit_cone(tilted, sample_size):
+    R, alphadeg, H = 400., 35., 500.
+    pts = _cone(R, alphadeg, H, tilted=tilted)
+    out = fit_data.best_fit_cone(pts.T, H=H, alphadeg=alphadeg, save=False,
+                                 sample_size=sample_size)
+    x, y, z = out['output_pts']
+    r = np.sqrt(x**2 + y**2)
+    res = r - (out['R_best_fit']
+               - z*np.tan(np.deg2rad(out['alphadeg_best_fit'])))
+    assert abs(out['R_best_fit'] - R) < 0.5
+    assert abs(out['alphadeg_best_fit'] - alphadeg) < 0.01
+    # upright: the bottom is the wider end
+    assert r[z < H/4].mean() > r[z > 3*H/4].mean()
+    assert np.abs(res).max() < 0.5
+    assert _round_trip(out) < 1.e-8
+
+
+def test_best_fit_cylinder_inverse():
+    R, H = 250., 500.
+    pts = _cone(R, 0., H, num=20000, tilted=True)
+    out = fit_data.best_fit_cylinder(pts.T, H=H, R_expected=R, save=False)
+    assert abs(out['R_best_fit'] - R) < 0.5
+    assert _round_trip(out) < 1.e-8
@@ -0,0 +1,61 @@
+r"""Compares the single and double precision imperfection pipelines
+
+Interpolates every ``rtu_2014_*`` `\theta`, `z`, `imp` file onto a cylinder
+mesh using ``dtype='float32'`` and ``dtype='float64'`` and prints the
+elapsed time and the maximum and 99.9th percentile absolute differences,
+relative to the imperfection amplitude. The largest differences come from
+near-ties in the closest point search, which may resolve differently in
+single precision.
+
+Usage::
+
+    python bench_dtype.py [num_theta] [num_z]
+
+"""
+import os
+import sys
+import glob
+import time
+
+import numpy as np
+
+from desicos.conecylDB.interpolate import interp_theta_z_imp
+
+
+def cylinder_mesh(num_theta, num_z, R, H):
+    thetas = np.linspace(-np.pi, np.pi, num_theta, endpoint=False)
+    zs = np.linspace(0, H, num_z)
+    thetas, zs = np.meshgrid(thetas, zs)
+    thetas = thetas.ravel()
+    zs = zs.ravel()
+    return np.vstack((R*np.cos(thetas), R*np.sin(thetas), zs)).T
+
+
+def main(num_theta=400, num_z=600):
+    R = 250.
+    H = 510.
+    mesh = cylinder_mesh(num_theta, num_z, R, H)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'files', 'rtu')
+    paths = sorted(glob.glob(os.path.join(root, 'rtu_2014_*',
+                                          '*_theta_z_imp.txt')))
+    print('{0:40s} {1:>9s} {2:>9s} {3:>12s} {4:>12s}'.format('file',
+          't64 (s)', 't32 (s)', 'max err/amp', 'p99.9/amp'))
+    for path in paths:
+        res = {}
+        for dtype in ('float64', 'float32'):
+            t0 = time.time()
+            ans = interp_theta_z_imp(path, mesh, alphadeg=0.,
+                    H_measured=H, H_model=H, R_bottom=R, dtype=dtype)
+            res[dtype] = (time.time() - t0, ans)
+        t64, a64 = res['float64']
+        t32, a32 = res['float32']
+        amp = np.abs(a64).max()
+        err = np.abs(a64 - a32)/amp
+        print('{0:40s} {1:9.3f} {2:9.3f} {3:12.3e} {4:12.3e}'.format(
+              os.path.basename(path)[:40], t64, t32, err.max(),
+              np.percentile(err, 99.9)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
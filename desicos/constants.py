@@ -13,3 +13,31 @@ else:
     TMP_DIR = r'~/tmp/desicos'
 
 FLOAT = 'float64'
+
+
+def get_float(dtype=None):
+    """Working floating point type used to process imperfection data
+
+    Parameters
+    ----------
+    dtype : str, numpy.dtype or None, optional
+        If given it is returned, otherwise the global ``FLOAT`` is returned,
+        which can be changed with :func:`.set_float`.
+
+    """
+    if dtype is None:
+        return FLOAT
+    return dtype
+
+
+def set_float(dtype):
+    """Changes the global working floating point type
+
+    Using ``set_float('float32')`` halves the memory used to read, transform
+    and interpolate measured imperfection data, which is accurate enough
+    since the measurement noise is many orders of magnitude higher than the
+    single precision round-off.
+
+    """
+    global FLOAT
+    FLOAT = dtype
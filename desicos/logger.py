@@ -11,3 +11,25 @@ def error(msg, level=0):
     msg = 'ERROR: ' + msg
     print('\t'*level + msg)
     return msg
+
+
+def peak_memory():
+    """Peak resident memory of the current process in MB
+
+    Returns ``None`` when it cannot be measured.
+
+    """
+    import sys
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)/1024.**2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/1024.**2
+    return peak/1024.
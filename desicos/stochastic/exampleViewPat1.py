@@ -11,6 +11,8 @@ from viewer import DesicosViewer3D
 k=0.26
 
 sg=ImperfFactory()
+# the inputs are plotted below, indata is empty if the statistics are cached
+sg.setUseCache(False)
 sg.addInputsFromCCDB(['degenhardt_2010_z22','degenhardt_2010_z23','degenhardt_2010_z25'])
 sg.compute()
 desView3D=DesicosViewer3D()
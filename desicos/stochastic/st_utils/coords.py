@@ -1,7 +1,12 @@
+import hashlib
 import numpy as np
 from scipy.interpolate import griddata
 
 TOL = 0.001
+# number of point layouts whose interpolation weights are kept in memory
+INTERP_CACHE_SIZE = 4
+_interpCache = {}
+_interpCacheKeys = []
 
 def rec2cyl( x, y, z):
     theta = np.arctan2( y, x )
@@ -20,9 +25,95 @@ def getGeomImperfection(r,z,RB,RT=None):
         RT=RB
     return r -(RB+ (RT-RB)*z)
 
-def getImperfectionArray(tht,z,IM,fx,fy):
+def getInterpolationWeights(tht,z,fx,fy):
+    """ Vertices and barycentric weights of the grid points (fx, fy) in the
+        Delaunay triangulation of the points (tht, z), as used by
+        griddata(..., method='linear')
+
+        The result is cached for each point layout and grid, such that the
+        triangulation is built only once for inputs sharing the same points
+    """
+    from scipy.spatial import Delaunay
+    sha=hashlib.sha1()
+    for a in (tht,z,fx,fy):
+        a=np.ascontiguousarray(a,dtype=float)
+        sha.update(np.array(a.shape))
+        sha.update(a)
+    key=sha.hexdigest()
+    if key in _interpCache:
+        return _interpCache[key]
+
     X,Y=np.meshgrid(fx,fy)
-    return griddata( (tht,z),IM,(X,Y),method='linear')
+    xi=np.vstack((X.ravel(),Y.ravel())).T
+    tri=Delaunay(np.vstack((tht,z)).T)
+    simplex=tri.find_simplex(xi)
+    inside=simplex >= 0
+    T=tri.transform[simplex[inside]]
+    bc=np.einsum('ijk,ik->ij',T[:,:2,:],xi[inside]-T[:,2,:])
+    weights=np.hstack((bc,1.0-bc.sum(axis=1)[:,np.newaxis]))
+    vertices=tri.simplices[simplex[inside]]
+    out=(X.shape,inside,vertices,weights)
+
+    if len(_interpCacheKeys) >= INTERP_CACHE_SIZE:
+        _interpCache.pop(_interpCacheKeys.pop(0))
+    _interpCache[key]=out
+    _interpCacheKeys.append(key)
+    return out
+
+def getImperfectionArray(tht,z,IM,fx,fy):
+    shape,inside,vertices,weights=getInterpolationWeights(tht,z,fx,fy)
+    res=np.empty(shape[0]*shape[1])
+    res.fill(np.nan)
+    res[inside]=(np.asarray(IM,dtype=float)[vertices]*weights).sum(axis=1)
+    return res.reshape(shape)
+
+
+class GridAverage(object):
+    """ Average of scattered values in the cells of the regular grid
+        (fx, fy), periodic in x with period fx[-1]-fx[0]. The values are
+        added block by block with update(), such that the points do not need
+        to be in memory at once
+    """
+    def __init__(self,fx,fy):
+        self.fx=np.asarray(fx,dtype=float)
+        self.fy=np.asarray(fy,dtype=float)
+        self.nx=len(fx)
+        self.ny=len(fy)
+        self.period=self.fx[-1]-self.fx[0]
+        self.dx=self.period/(self.nx-1)
+        self.dy=(self.fy[-1]-self.fy[0])/(self.ny-1)
+        self.sum=np.zeros(self.nx*self.ny)
+        self.count=np.zeros(self.nx*self.ny)
+
+    def update(self,x,y,val):
+        ix=np.rint(np.mod(x-self.fx[0],self.period)/self.dx).astype(np.int64)
+        # the last column is the same as the first one
+        ix[ix >= self.nx-1]=0
+        iy=np.rint((y-self.fy[0])/self.dy).astype(np.int64)
+        ok=(iy >= 0) & (iy < self.ny)
+        idx=iy[ok]*self.nx+ix[ok]
+        n=self.nx*self.ny
+        self.sum+=np.bincount(idx,weights=np.asarray(val)[ok],minlength=n)
+        self.count+=np.bincount(idx,minlength=n)
+
+    def getArray(self):
+        """ The averages, with empty cells interpolated along x in the rows
+            with data. Rows without data are nan
+        """
+        res=np.empty(self.nx*self.ny)
+        res.fill(np.nan)
+        has=self.count > 0
+        res[has]=self.sum[has]/self.count[has]
+        res=res.reshape(self.ny,self.nx)
+        res[:,-1]=res[:,0]
+        fx=self.fx[:-1]
+        for row in res:
+            empty=np.isnan(row[:-1])
+            if empty.any() and not empty.all():
+                row[:-1][empty]=np.interp(fx[empty],fx[~empty],row[:-1][~empty],
+                                          period=self.period)
+                row[-1]=row[0]
+        return res
 
 
 def getImperfectionArray3D(data,nx,ny,H,RB,RT=None):
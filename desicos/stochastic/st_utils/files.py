@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+def writeAtomic(path,write):
+    """ Writes a file atomically: write(f) writes the contents to an open
+        binary file with a temporary name in the same directory, which is
+        then renamed to path, such that a crash never leaves a partially
+        written file
+    """
+    dirpath=os.path.dirname(os.path.abspath(path))
+    fd,tmp=tempfile.mkstemp(dir=dirpath,prefix='.tmp_')
+    try:
+        with os.fdopen(fd,'wb') as f:
+            write(f)
+        if hasattr(os,'replace'):
+            os.replace(tmp,path)
+        else:
+            if os.path.isfile(path):
+                os.remove(path)
+            os.rename(tmp,path)
+    except:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
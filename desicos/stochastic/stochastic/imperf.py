@@ -36,6 +36,8 @@ class Samples(object):
         #self.fil=('hamming',(0.53836,-0.46164,0.53836,-0.46164) )#  ('trapezoid',(0.1,0.1))
         self.fil=('none',())
         self.strFacts=[StructurePattern()]
+        self.padFactor=16
+        self.maxFFTMemory=2**26
 
     def setFilter(self,name,args):
         self.fil=(name,args)
@@ -48,6 +50,12 @@ class Samples(object):
 
     def getFilter(self):
         return self.winFilter
+
+    def setPaddingFactor(self,val):
+        """ The inputs are zero-padded to val*2**nextpow2(n) points in
+            both directions before the FFT, default 16
+        """
+        self.padFactor=int(val)
     def setAmplitudeThreshold(self,val):
         self.amplThreshold=val
 
@@ -141,36 +149,41 @@ class Samples(object):
             return
         FilterWindows2D.setInputArray(self.y,self.x)
         self.winFilter=FilterWindows2D.filters[self.fil[0]]( *self.fil[1]  )
-        self.aveFunc=np.zeros(self.indata[0].shape)
-        self.eW=np.zeros(self.indata[0].shape)
-
-        for data in self.indata:
-            self.aveFunc+=data/self.nSamples
+        indata=np.asarray(self.indata,dtype=float)
+        self.aveFunc=indata.sum(axis=0)/self.nSamples
 
-        for i in range(len(self.indata)):
-            self.data.append(self.indata[i]-self.aveFunc)
-            self.eW+= (self.data[i]**2.0)/self.nSamples
+        data=indata-self.aveFunc
+        self.eW=(data**2.0).sum(axis=0)/self.nSamples
+        data*=self.winFilter
+        self.data=data
 
-        for i in range(len(self.data)):
-            self.data[i]=self.data[i]*self.winFilter
+        nFFT1 = self.padFactor*2**nextpow2(self.nx)
+        nFFT2 = self.padFactor*2**nextpow2(self.ny)
 
-        nFFT1 = 16*2**nextpow2(self.nx)
-        nFFT2 = 16*2**nextpow2(self.ny)
-
-        a1 = nFFT1/2
-        a2 = nFFT2/2
-        a2Mod = nFFT2/8/2
+        a1 = nFFT1//2
+        a2 = nFFT2//2
 
         self.a1=a1
         self.a2=a2
-        self.sh=np.zeros((a1,a2))
 
-        for data in self.data:
-            z=np.fft.fft2(data,s=[nFFT1,nFFT2])
-#            z=scipy.fftpack.fft2(data,shape=[nFFT1,nFFT2])
-            trans= (np.abs(z)**2) / (nFFT1*nFFT2)
-            self.sh+=trans[0:a1,0:a2]/self.nSamples
-            self.trans=trans
+        # fft2(data,s=[nFFT1,nFFT2])[0:a1,0:a2] computed axis by axis: the
+        # real FFT of the rows is taken before the zero-padding of the
+        # columns and only the first a1 rows and a2 columns are kept; the
+        # inputs are transformed together, in blocks limited by maxFFTMemory
+        rows=np.fft.rfft(data,n=nFFT2,axis=2)[:,:,0:a2]
+        # the columns are made contiguous for the second FFT
+        cols=np.ascontiguousarray(rows.transpose(0,2,1))
+        del rows
+        self.sh=np.zeros((a1,a2))
+        nblock=max(1,int(self.maxFFTMemory//(16*nFFT1*a2)))
+        for i in range(0,cols.shape[0],nblock):
+            z=np.fft.fft(cols[i:i+nblock],n=nFFT1,axis=2)[:,:,0:a1]
+            psd=z.real**2
+            psd+=z.imag**2
+            del z
+            self.sh+=psd.sum(axis=0).T/(nFFT1*nFFT2)/self.nSamples
+            del psd
+        del cols
 
         dfx=self.lx/(self.nx-1)
         dfy=self.ly/(self.ny-1)
@@ -191,10 +204,9 @@ class Samples(object):
         fmod=interpolate.RectBivariateSpline(self.fxCut,self.fyCut,self.shCut,kx=1,ky=1 )
         self.shMod=fmod(self.fxIn,self.fyIn)
 
-        intSh=0.0
-        for i in range(0,len(self.fxIn)-1):
-            for j in range(0,len(self.fyIn)-1):
-                intSh=intSh+self.shMod[i][j]*self.fxIn[1]*self.fyIn[1]
+        n1=len(self.fxIn)-1
+        n2=len(self.fyIn)-1
+        intSh=self.shMod[0:n1,0:n2].sum()*self.fxIn[1]*self.fyIn[1]
         if intSh >0.0:
             self.bruch=self.shMod/(4.0*intSh)
         else:
@@ -202,7 +214,52 @@ class Samples(object):
 
 
 
-    def getNewSample(self):
+    def getRandomPhases(self,rs=None):
+        """ Random phases phi1, phi2 of the harmonics, uniform in [0, 2*pi).
+            The numbers are drawn in the same order as the former loop
+            (phi1, phi2 for each harmonic), from the random state rs or from
+            the global numpy random state
+        """
+        if rs is None:
+            rs=np.random
+        n1,n2=self.shMod.shape
+        phi1=np.zeros(self.shMod.shape)
+        phi2=np.zeros(self.shMod.shape)
+        rnd=rs.rand(n1-1,n2-1,2)
+        phi1[1:,1:]=2*np.pi*rnd[:,:,0]
+        phi2[1:,1:]=2*np.pi*rnd[:,:,1]
+        return phi1,phi2
+
+    def synthesize(self,phi1,phi2):
+        """ Spectral representation of the random field for given phases
+
+            The double sum over the harmonics n1, n2 of
+            A*(cos(fx*x+fy*y+phi1)+cos(fx*x-fy*y+phi2)) is separated into the
+            amplitude sqrt(2*eW*dfx*dfy) of each point and the complex
+            amplitudes sqrt(bruch)*exp(i*phi) of each harmonic, which are
+            combined with exp(i*fx*x) and exp(i*fy*y) tables by two matrix
+            products
+        """
+        x=np.asarray(self.x,dtype=float)
+        y=np.asarray(self.y,dtype=float)
+        fxIn=self.fxIn[1:self.shMod.shape[0]]
+        fyIn=self.fyIn[1:self.shMod.shape[1]]
+        dfx=self.fxIn[1]
+        dfy=self.fyIn[1]
+        bruch=np.sqrt(self.bruch[1:,1:])
+        c1=bruch*np.exp(1j*phi1[1:,1:])
+        c2=bruch*np.exp(1j*phi2[1:,1:])
+
+        ex=np.exp(1j*np.outer(fxIn,x))      # (n1, nx)
+        ey=np.exp(1j*np.outer(y,fyIn))      # (ny, n2)
+        # cos(a+b+p)=Re(e^ia e^ib e^ip), cos(a-b+p)=Re(e^ia conj(e^ib) e^ip)
+        s=(np.dot(ey,np.dot(c1.T,ex)).real+
+           np.dot(ey.conj(),np.dot(c2.T,ex)).real)
+        return np.sqrt(2.)*np.sqrt(2.0*self.eW*dfx*dfy)*s
+
+    def _synthesizeLoop(self,phi1,phi2):
+        """ Reference implementation of synthesize(), used by the tests
+        """
         x=self.x
         y=self.y
         eW=self.eW
@@ -210,18 +267,7 @@ class Samples(object):
         fxIn=self.fxIn
         fyIn=self.fyIn
         res=np.zeros((self.ny,self.nx))
-        phi1=np.zeros(self.shMod.shape)
-        phi2=np.zeros(self.shMod.shape)
         sqrt2=np.sqrt(2.)
-#        bruch=np.loadtxt('stochastic/bruch',delimiter=',')
-
-        for i in range(1,self.shMod.shape[0]):
-            for j in range(1,self.shMod.shape[1]):
-                phi1[i][j]=2*np.pi*np.random.rand()
-                phi2[i][j]=2*np.pi*np.random.rand()
-#        phi1=np.loadtxt('stochastic/phi1',delimiter=',')
-#        phi2=np.loadtxt('stochastic/phi2',delimiter=',')
-
         dfx=fxIn[1].copy()
         dfy=fyIn[1].copy()
 
@@ -233,12 +279,23 @@ class Samples(object):
 
                         res[iy][ix]+=sqrt2*(A1*np.cos(fxIn[n1]*x[ix]+fyIn[n2]*y[iy]+phi1[n1][n2])+ \
                                         A1*np.cos(fxIn[n1]*x[ix]-fyIn[n2]*y[iy]+phi2[n1][n2]))
+        return res
+
+    def getNewSample(self,phi1=None,phi2=None,rs=None):
+        """ New stochastic sample. The random phases phi1, phi2 may be given,
+            otherwise they are taken from getRandomPhases(). All random
+            numbers are drawn from the random state rs (np.random.RandomState)
+            or from the global numpy random state
+        """
+        if phi1 is None or phi2 is None:
+            phi1,phi2=self.getRandomPhases(rs)
+        res=self.synthesize(phi1,phi2)
         res+=self.aveFunc
         self._tmp_res=res.copy()
         self._tmp_pat=np.zeros(self._tmp_res.shape)
         for strFact in self.strFacts:
             strFact.connectOutputArray(res)
-            pat=strFact.getPattern()
+            pat=strFact.getPattern(rs=rs)
 
             res+=pat
             self._tmp_pat+=pat
@@ -4,11 +4,35 @@ import numpy.ma as ma
 import copy
 import time
 import sys
+import hashlib
+import json
+import glob
 #sys.path.append( '/home/pavel/Documents/desicos/abaqus-conecyl-python_DEV')
 from  st_utils.coords import *
+from st_utils.files import writeAtomic
 from imperf import Samples
+from stochastic.filWin import FilterWindows2D
 from conecylDB import*
-
+try:
+    # with the DESICOS package the measured files are read in blocks by the
+    # 'bin' regrid method, without loading them whole
+    from desicos.conecylDB.stream import iter_blocks
+except ImportError:
+    iter_blocks=None
+
+# version of the cached statistics, increase it when Samples.compute changes
+CACHE_VERSION=2
+# number of points resampled at once by the 'bin' regrid method
+REGRID_BLOCK=2**20
+# attributes of the computed statistics saved in the cache, the full
+# spectrum sh is only needed to compute shCut
+CACHE_STATS=('x','y','nx','ny','lx','ly','RB','H','alpha',
+             'aveFunc','eW','shCut','fx','fy','fxCut','fyCut','fxIn',
+             'fyIn','shMod','bruch','a1','a2','dfx','dfy')
+# attributes used by getNewSampleXYZ(), sent to the worker processes that
+# generate new samples
+SYNTHESIS_STATS=('x','y','nx','ny','RB','H','alpha','aveFunc','eW','fxIn',
+                 'fyIn','shMod','bruch','strFacts','scalingFactor','imp_type')
 
 class SamplesCC(Samples):
     def __init__(self,conecylDBFile):
@@ -21,6 +45,28 @@ class SamplesCC(Samples):
             self.ccdb=ConeCylDB(conecylDBFile)
         else:
             self.ccdb=ConeCylDB()
+        self.regridMethod='linear'
+        self.cacheDir=None
+        self.useCache=True
+        self.ccdbInputs=[]
+        self._pending=[]
+        self._nImported=0
+
+    def setCacheDir(self,path):
+        """ Directory of the cached statistics, by default the directory
+            stochastic_cache next to the CCDB file
+        """
+        self.cacheDir=path
+
+    def setUseCache(self,val):
+        """ When the statistics are loaded from the cache the measured
+            data is not read, such that indata stays empty. Disable the
+            cache to access the resampled inputs
+        """
+        self.useCache=bool(val)
+
+    def getInputsCount(self):
+        return len(self.indata)+len(self._pending)
 
     def setCCDB(self,fname):
         self.ccdb=ConeCylDB(fname)
@@ -49,6 +95,7 @@ class SamplesCC(Samples):
         IMP=self.ccdb.getEntry(imp_name)
         if IMP is None:
             logging.warning(str(imp_name)+" is not in IMPERFECTION database!")
+            return
         try:
             self.imp_type
         except:
@@ -58,70 +105,244 @@ class SamplesCC(Samples):
             return
 
 
-        if self.imp_type == 'ms':
-            b=IMP.getGeometricImperfection()
-        if self.imp_type == 'thick':
-            b=IMP.getThicknessImperfection()
-        if b is None:
+        # the measured data is read only by compute(), if the statistics
+        # are not in the cache
+        if IMP.config.get(self._impKey()) is None:
             logging.warning(str(imp_name)+" with imperfection "+str(imp_type)+" is not in IMPERFECTION database!")
             return
-        (H,R,alpha)=IMP.getGeometry()
-        self.importFromXYZ(b,H,R,alpha)
+        self.ccdbInputs.append(imp_name)
+        self._pending.append(imp_name)
 
+    def _impKey(self):
+        if self.imp_type == 'thick':
+            return 'imp_thick'
+        return 'imp_geom'
+
+    def _importPending(self):
+        for imp_name in self._pending:
+            IMP=self.ccdb.getEntry(imp_name)
+            imp=IMP.config.get(self._impKey())
+            if (self.regridMethod == 'bin' and iter_blocks is not None
+                and isinstance(imp,(type(''),type(u'')))):
+                b=iter_blocks(IMP.abspath+'/'+imp,dtype='float64')
+            elif self.imp_type == 'ms':
+                b=IMP.getGeometricImperfection()
+            elif self.imp_type == 'thick':
+                b=IMP.getThicknessImperfection()
+            (H,R,alpha)=IMP.getGeometry()
+            self.importFromXYZ(b,H,R,alpha)
+            self._nImported+=1
+        self._pending=[]
+
+    def _inputSignature(self,imp_name):
+        # the imperfection file and the entry file, such that a cache entry
+        # is invalidated when the measured data or the geometry change
+        IMP=self.ccdb.getEntry(imp_name)
+        imp=IMP.config.get(self._impKey())
+        sig=[imp_name]
+        if isinstance(imp,(type(''),type(u''))):
+            paths=[IMP.abspath+'/'+imp,IMP.configFile]
+        else:
+            paths=[IMP.configFile]
+            sig.append(hashlib.sha1(np.ascontiguousarray(imp,dtype=float)).hexdigest())
+        for path in paths:
+            try:
+                st=os.stat(path)
+                sig.append([os.path.abspath(path),st.st_size,st.st_mtime])
+            except OSError:
+                sig.append([path,None,None])
+        return sig
+
+    def _cacheSettings(self):
+        return {'imp_type':self.imp_type,
+                'sampling':[self.samplingRadial,self.samplingAxial],
+                'regrid':self.regridMethod,
+                'filter':[self.fil[0],list(self.fil[1])],
+                'fxRange':list(self.fxRange),
+                'fyRange':list(self.fyRange),
+                'amplThreshold':self.amplThreshold,
+                'padFactor':self.padFactor}
+
+    def getCacheKey(self):
+        """ Hash of the inputs and of the settings used by compute()
+        """
+        key=self._cacheSettings()
+        key['version']=CACHE_VERSION
+        key['inputs']=[self._inputSignature(n) for n in self.ccdbInputs]
+        return hashlib.sha1(json.dumps(key,sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _getCachePrefix(self):
+        # the same for all the cache entries of the same inputs and settings,
+        # whatever the version and the state of the input files
+        key=self._cacheSettings()
+        key['inputs']=list(self.ccdbInputs)
+        return self.imp_type+'_'+hashlib.sha1(json.dumps(key,sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def _getCachePath(self):
+        # only inputs from the CCDB can be cached
+        if (not self.useCache or not self.ccdbInputs
+            or self.nSamples != self._nImported):
+            return None
+        cacheDir=self.cacheDir
+        if cacheDir is None:
+            cacheDir=os.path.join(os.path.abspath(self.ccdb.path),'stochastic_cache')
+        return os.path.join(cacheDir,self._getCachePrefix()+'_'+self.getCacheKey()+'.npz')
+
+    def _saveStatistics(self,path):
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            stats=dict((k,getattr(self,k)) for k in CACHE_STATS)
+            writeAtomic(path,lambda f: np.savez(f,version=CACHE_VERSION,**stats))
+            logging.info('statistics saved: '+path)
+        except (IOError,OSError):
+            logging.warning('Can not write the statistics to: '+path)
+            return
+        self._pruneCache(path)
+
+    def _pruneCache(self,path):
+        # the entries of the same inputs and settings computed from older
+        # input files or by an older version are removed
+        prefix=os.path.basename(path).rsplit('_',1)[0]
+        for old in glob.glob(os.path.join(os.path.dirname(path),prefix+'_*.npz')):
+            if os.path.abspath(old) == os.path.abspath(path):
+                continue
+            try:
+                os.remove(old)
+                logging.info('stale statistics removed: '+old)
+            except OSError:
+                pass
+
+    def _loadStatistics(self,path):
+        with np.load(path) as f:
+            if int(f['version']) != CACHE_VERSION:
+                raise ValueError('old cache version')
+            stats={}
+            for k in CACHE_STATS:
+                v=f[k]
+                stats[k]=v.item() if v.ndim == 0 else v
+        self.__dict__.update(stats)
+        self.setGeometry(self.RB,self.H,self.alpha)
+        FilterWindows2D.setInputArray(self.y,self.x)
+        self.winFilter=FilterWindows2D.filters[self.fil[0]]( *self.fil[1]  )
+        logging.info('statistics loaded: '+path)
+
+    def compute(self):
+        """ Computes the statistics of the inputs, or loads them from the
+            cache when the inputs and the settings did not change. After
+            loading from the cache indata is empty, see setUseCache()
+        """
+        path=self._getCachePath()
+        if path is not None and os.path.isfile(path):
+            try:
+                self._loadStatistics(path)
+                return
+            except Exception:
+                logging.warning('Invalid cache file: '+path)
+        self._importPending()
+        Samples.compute(self)
+        if path is not None and self.getInputsCount() >= 2:
+            self._saveStatistics(path)
+
+
+    def setRegridMethod(self,name):
+        """ How the measured points are resampled to the regular grid:
+            'linear' (default) interpolates in the Delaunay triangulation of
+            the points, 'bin' averages the points in the grid cells, which
+            is recommended for dense scans
+        """
+        if name not in ('linear','bin'):
+            raise ValueError('Invalid regrid method: '+str(name))
+        self.regridMethod=name
+
+    def _iterBlocks(self,b):
+        if isinstance(b,np.ndarray):
+            for i in range(0,b.shape[0],REGRID_BLOCK):
+                yield b[i:i+REGRID_BLOCK]
+        else:
+            for block in b:
+                yield np.asarray(block)
 
-    def importFromXYZ(self,b,H,RB,alpha):
-        RT=RB-H *( np.tan(alpha ) )
+    def _cylImperfection(self,b):
         x,y,z=b[:,0],b[:,1],b[:,2]
         r,tht,z=rec2cyl(x,y,z)
-        self.setGeometry(RB,H,alpha)
         rPerf=self._getRperf(z)
         if self.imp_type == 'thick':
             imp=b[:,3]
         else:
             imp=getGeomImperfection(r,z,rPerf)
+        return np.mod(tht,2.0*np.pi),z,imp
 
-        tm1=ma.masked_less(tht,0.1*np.pi).mask
-        tm2=ma.masked_greater(tht,1.9*np.pi).mask
-
-        tht=np.hstack((tht, np.pi*2.0+tht[tm1],  0.0+(-1.0)*tht[tm2]))
-        r=np.hstack((r,r[tm1],r[tm2] ))
-        z=np.hstack((z,z[tm1],z[tm2]))
-        imp=np.hstack((imp,imp[tm1],imp[tm2]))
-
+    def importFromXYZ(self,b,H,RB,alpha):
+        """ Resamples the measured points b to the grid of samplingRadial x
+            samplingAxial points and adds it to the inputs. With the 'bin'
+            regrid method b may also be an iterable of blocks of points,
+            which are processed one by one
+        """
+        RT=RB-H *( np.tan(alpha ) )
+        self.setGeometry(RB,H,alpha)
         ft=np.linspace(0,2.0*np.pi,self.samplingRadial)
         fz=np.linspace(0,H,self.samplingAxial)
-        IMPERF=getImperfectionArray(tht,z,imp,ft,fz)
-
-        mf=[]
-        for row in IMPERF[0:len(IMPERF)]:
-            mf.append( np.isnan(np.sum(row))  )
-        row1=mf.index(False)
-        mr=[]
-        for i in reversed(mf):
-            mr.append(i)
-        row2= len(mf)-1-mr.index(False)
-
-        row1+=1
-        row2-=2
-        dr1=row1
-        rows1=range(0,row1)
-        rows1sym=range(row1,row1+dr1)[::-1]
-
-        dr2=len(mf)-1-row2
-        rows2=range(len(mf)-1,row2,-1)
-        rows2sym=range(row2-dr2,row2)[::-1]
-
-        IMPERF[rows1]=IMPERF[rows1sym].copy()
-        IMPERF[rows2]=IMPERF[rows2sym].copy()
 
-        #EXTRUDE
-        #IMPERF[0:row1]=IMPERF[row1]
-        #IMPERF[row2::]=IMPERF[row2]
+        if self.regridMethod == 'bin':
+            avg=GridAverage(ft,fz)
+            for block in self._iterBlocks(b):
+                tht,z,imp=self._cylImperfection(block)
+                avg.update(tht,z,imp)
+            IMPERF=avg.getArray()
+        else:
+            if not isinstance(b,np.ndarray):
+                b=np.vstack([np.asarray(block) for block in b])
+            tht,z,imp=self._cylImperfection(b)
+
+            # points close to the seam are repeated on the other side
+            tm1=tht < 0.1*np.pi
+            tm2=tht > 1.9*np.pi
+            tht=np.hstack((tht, np.pi*2.0+tht[tm1], tht[tm2]-np.pi*2.0))
+            z=np.hstack((z,z[tm1],z[tm2]))
+            imp=np.hstack((imp,imp[tm1],imp[tm2]))
+
+            IMPERF=getImperfectionArray(tht,z,imp,ft,fz)
 
+        self._symmetrizeEdges(IMPERF)
         self.addData(IMPERF,ft,fz)
 
-    def getNewSampleXYZ(self):
-        thtZ=self.getNewSample()
+    def _symmetrizeEdges(self,IMPERF):
+        # the rows with nan values at the bottom and top edges are replaced
+        # by the rows mirrored about the first and last complete rows
+        full=np.flatnonzero(~np.isnan(IMPERF.sum(axis=1)))
+        if full.size == 0:
+            raise ValueError('No grid row is fully covered by the measured points')
+        n=IMPERF.shape[0]
+        row1=full[0]+1
+        row2=full[-1]-2
+
+        rows1=np.arange(0,row1)
+        rows1sym=np.arange(row1,2*row1)[::-1]
+
+        dr2=n-1-row2
+        rows2=np.arange(n-1,row2,-1)
+        rows2sym=np.arange(row2-dr2,row2)[::-1]
+
+        IMPERF[rows1]=IMPERF[rows1sym]
+        IMPERF[rows2]=IMPERF[rows2sym]
+
+        #EXTRUDE
+        #IMPERF[0:row1]=IMPERF[row1]
+        #IMPERF[row2::]=IMPERF[row2]
+        return IMPERF
+
+    def getGenerator(self):
+        """ Copy holding only the statistics needed by getNewSampleXYZ(),
+            much lighter than self to send to other processes
+        """
+        gen=SamplesCC.__new__(SamplesCC)
+        for k in SYNTHESIS_STATS:
+            setattr(gen,k,getattr(self,k))
+        return gen
+
+    def getNewSampleXYZ(self,rs=None):
+        thtZ=self.getNewSample(rs=rs)
         tht=np.squeeze(np.tile(self.x,(1,len(self.y) )))
         z=np.repeat(self.y,len(self.x))
         r=self._getRperf(z)
@@ -136,7 +357,7 @@ class SamplesCC(Samples):
             return np.hstack((x[np.newaxis].T , y[np.newaxis].T , z[np.newaxis].T , res[np.newaxis].T ))
 
 
-    def putNewSampleToFolder(self,path):
+    def putNewSampleToFolder(self,path,xyz=None):
         if self.outName is None :
             sname='AutogeneratedSample'+'_'+self.imp_type+'_'+time.strftime("%d_%B_%Y_%H_%M_%S_UTC",time.gmtime())
         else:
@@ -147,11 +368,13 @@ class SamplesCC(Samples):
         except:
             pass
 
-        np.savetxt(path+sname,self.getNewSampleXYZ() )
+        if xyz is None:
+            xyz=self.getNewSampleXYZ()
+        np.savetxt(path+sname,xyz)
         logging.info('saved:'+path+sname)
 
 
-    def putNewSampleToCCDB(self,R=None,H=None,alpha=None):
+    def putNewSampleToCCDB(self,R=None,H=None,alpha=None,xyz=None):
         rcc=self.RB
         hcc=self.H
         acc=self.alpha
@@ -171,12 +394,14 @@ class SamplesCC(Samples):
         self.ccdb.copy(self.cc0.name,sname)
         newCE=self.ccdb.getEntry(sname)
         newCE.setGeometry(hcc,rcc,acc)
+        if xyz is None:
+            xyz=self.getNewSampleXYZ()
 
         if self.imp_type == 'thick':
             logging.info('Adding : '+str(sname)+'_'+str(self.imp_type)+' to CCDB')
-            newCE.setThicknessImperfection(self.getNewSampleXYZ())
+            newCE.setThicknessImperfection(xyz)
             logging.info('saved:'+sname)
         else:
             logging.info('Adding : '+str(sname)+'_'+str(self.imp_type)+' to CCDB')
-            newCE.setGeometricImperfection(self.getNewSampleXYZ())
+            newCE.setGeometricImperfection(xyz)
             logging.info('saved:'+sname)
@@ -40,6 +40,18 @@ class ImperfFactory(object):
         self.sThick.setCCDB(fname)
         self.sThick.ccdb.populate()
 
+    def setCacheDir(self,path):
+        self.sMidS.setCacheDir(path)
+        self.sThick.setCacheDir(path)
+
+    def setUseCache(self,val):
+        self.sMidS.setUseCache(val)
+        self.sThick.setUseCache(val)
+
+    def setRegridMethod(self,name):
+        self.sMidS.setRegridMethod(name)
+        self.sThick.setRegridMethod(name)
+
     def setRadialSampling(self,val):
         self.sMidS.setRadialSampling(val)
         self.sThick.setRadialSampling(val)
@@ -145,11 +157,68 @@ class ImperfFactory(object):
             self._putNewToCCDB(l)
             self.outputs.append(l)
 
-    def putAutogenToCCDB(self,base,n):
-        for i in range(0,n):
-            aname=str(base+'_'+time.strftime("%d_%B_%Y_%H_%M_%S_UTC",time.gmtime()))
-            self._putNewToCCDB(aname)
-            self.outputs.append(aname)
+    def putAutogenToCCDB(self,base,n,seed=None,workers=1):
+        aname=str(base+'_'+time.strftime("%d_%B_%Y_%H_%M_%S_UTC",time.gmtime()))
+        self.generate(n,seed,workers,base=aname)
+
+    ### BATCH GENERATION BLOCK:::::::::::::::::::::::::::::::::
+    def generate(self,n,seed=None,workers=1,base='AutogeneratedSample',path=None):
+        """ Generates n samples in a pool of worker processes
+
+            Sample k uses its own random stream, given by
+            getSampleRandomState(seed,k), such that it does not depend on
+            the number of workers or on the order the samples are computed.
+            The statistics are computed once and only the ones needed for
+            the synthesis are sent to the workers (see
+            SamplesCC.getGenerator()). The samples are written by this
+            process as they complete, to the CCDB or to the folder path if
+            given, with the names base_00000, base_00001, ...
+
+            Returns the seed used, which reproduces the whole batch
+        """
+        if seed is None:
+            seed=int(np.random.randint(0,2**31-1))
+        logging.info('Generating '+str(n)+' samples with seed '+str(seed))
+        samples={}
+        if self.solveMSI:
+            self.sMidS.compute()
+            samples['ms']=self.sMidS.getGenerator()
+        if self.solveTII:
+            self.sThick.compute()
+            samples['thick']=self.sThick.getGenerator()
+        if not samples:
+            logging.warning("insufficient input count!")
+            return seed
+
+        nd=len(str(max(n-1,0)))
+        names=[base+'_'+str(k).zfill(max(nd,5)) for k in range(n)]
+        if workers > 1 and n > 1:
+            from multiprocessing import Pool
+            pool=Pool(min(workers,n),_initGenerator,(samples,seed))
+            try:
+                for k,out in pool.imap_unordered(_generateSample,range(n)):
+                    self._putGenerated(names[k],out,path)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _initGenerator(samples,seed)
+            for k in range(n):
+                k,out=_generateSample(k)
+                self._putGenerated(names[k],out,path)
+        return seed
+
+    def _putGenerated(self,name,out,path):
+        for imp_type,xyz in out.items():
+            smp=self.sMidS if imp_type == 'ms' else self.sThick
+            if path is None:
+                smp.setOutputName(str(name))
+                smp.putNewSampleToCCDB(xyz=xyz)
+            else:
+                suffix='_inner_surf.txt' if imp_type == 'ms' else '_thick.txt'
+                smp.setOutputName(str(name)+suffix)
+                smp.putNewSampleToFolder(path,xyz=xyz)
+        self.outputs.append(name)
 
     ### DESICOS-STOCHASTIC-STANDALONE BLOCK:::::::::::::::::::;
     def copyPropsFromCCDB(self,imp_name):
@@ -198,9 +267,33 @@ class ImperfFactory(object):
             self._putNewToFolder(path,l)
             self.outputs.append(l)
 
-    def putAutogenToFolder(self,path,name,n):
-        for i in range(0,n):
-            aname=str(name+'_'+time.strftime("%d_%B_%Y_%H_%M_%S_UTC",time.gmtime()))
-            self._putNewToFolder(path,aname)
-            self.outputs.append(aname)
+    def putAutogenToFolder(self,path,name,n,seed=None,workers=1):
+        aname=str(name+'_'+time.strftime("%d_%B_%Y_%H_%M_%S_UTC",time.gmtime()))
+        self.generate(n,seed,workers,base=aname,path=path)
+
+
+def getSampleRandomState(seed,k):
+    """ Independent random state of sample k of a batch generated from seed.
+        The streams are spawned with np.random.SeedSequence when available,
+        older numpy versions seed the Mersenne Twister with [seed, k]
+    """
+    try:
+        ss=np.random.SeedSequence(seed,spawn_key=(k,))
+    except AttributeError:
+        return np.random.RandomState([seed,k])
+    return np.random.RandomState(np.random.MT19937(ss))
+
+
+_generator={}
+
+def _initGenerator(samples,seed):
+    _generator['samples']=samples
+    _generator['seed']=seed
+
+def _generateSample(k):
+    rs=getSampleRandomState(_generator['seed'],k)
+    out={}
+    for imp_type in sorted(_generator['samples'].keys()):
+        out[imp_type]=_generator['samples'][imp_type].getNewSampleXYZ(rs)
+    return k,out
 
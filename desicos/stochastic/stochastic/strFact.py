@@ -43,23 +43,25 @@ class StructurePattern(object):
         self.setProps()
         self.nz, self.nt = ar.shape
 
-    def setTPattern(self,**kwargs):
+    def setTPattern(self,rs=None,**kwargs):
         if self.tName == 'TBlk':
             self.tpi= self._getPatternTBlk(self.nBlkT)
 
         if self.tName == 'TStrip':
-            self.tpi= self._getPatternTStrip(self.t0,self.t1)
+            self.tpi= self._getPatternTStrip(self.t0,self.t1,rs)
 
-    def setZPattern(self,**kwargs):
+    def setZPattern(self,rs=None,**kwargs):
         if self.zName == 'ZBlk':
             self.zpi= self._getPatternZBlk(self.nBlkZ)
 
         if self.tName == 'ZStrip':
-            self.zpi= self._getPatternZStrip(self.z0,self.z1)
+            self.zpi= self._getPatternZStrip(self.z0,self.z1,rs)
 
 
 
-    def _getPatternTStrip(self,tsStart,tsStop):
+    def _getPatternTStrip(self,tsStart,tsStop,rs=None):
+        if rs is None:
+            rs=np.random
         ntpat=800
         t0=np.mod(tsStart,2.0*np.pi)
         t1=np.mod(tsStop,2.0*np.pi)
@@ -77,7 +79,7 @@ class StructurePattern(object):
 #        tpat[1]=mm*(self.AT*np.random.random(ntpat))   #((self.AT)/2.0 + 0.5*self.AT*np.random.random(ntpat))
 
         st=self.AT*np.ones(ntpat)
-        zeroKeys=np.random.randint(0,ntpat,70)
+        zeroKeys=rs.randint(0,ntpat,70)
         st[zeroKeys]=0.3*self.AT
         tpat[1]=st*mm
 
@@ -86,7 +88,9 @@ class StructurePattern(object):
         tpi[0,2*tpat.shape[1]:]=tpat[0]+2*np.pi
         return tpi
 
-    def _getPatternZStrip(self,zsStart,zsStop):
+    def _getPatternZStrip(self,zsStart,zsStop,rs=None):
+        if rs is None:
+            rs=np.random
         H=self.H
         nzpat=600
 
@@ -100,7 +104,7 @@ class StructurePattern(object):
         m1=ma.masked_greater_equal(zpat[0],zsStart).mask
         m2=ma.masked_less_equal(tpat[0],zsStop).mask
         mm=m1*m2
-        zpat[1]=mm*(self.AZ/2.0 + 0.5*self.AZ*np.random.random(nzpat))
+        zpat[1]=mm*(self.AZ/2.0 + 0.5*self.AZ*rs.random_sample(nzpat))
 
         zpi=np.hstack((zpat,zpat,zpat))
 
@@ -142,9 +146,9 @@ class StructurePattern(object):
         zpi[0][(2*zpat.shape[1]):]=(zpat[0]+H)
         return zpi
 
-    def getPattern(self,mode='add'):
-        self.setTPattern()
-        self.setZPattern()
+    def getPattern(self,mode='add',rs=None):
+        self.setTPattern(rs)
+        self.setZPattern(rs)
 
         tpi=self.tpi
         zpi=self.zpi
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stochastic.imperf import Samples
+
+
+def _samples(nx=24, ny=18, nf=17, seed=0):
+    rs = np.random.RandomState(seed)
+    smp = Samples()
+    smp.nx = nx
+    smp.ny = ny
+    smp.x = np.linspace(0., 100., nx)
+    smp.y = np.linspace(0., 300., ny)
+    smp.eW = rs.rand(ny, nx)
+    smp.fxIn = np.linspace(0, 0.3, nf)
+    smp.fyIn = np.linspace(0, 0.2, nf)
+    smp.shMod = rs.rand(nf, nf)
+    smp.bruch = smp.shMod/smp.shMod.sum()
+    smp.aveFunc = np.zeros((ny, nx))
+    smp.strFacts = []
+    return smp
+
+
+def test_synthesize_matches_loop():
+    smp = _samples()
+    phi1, phi2 = smp.getRandomPhases(np.random.RandomState(1))
+    ref = smp._synthesizeLoop(phi1, phi2)
+    res = smp.synthesize(phi1, phi2)
+    assert res.shape == ref.shape
+    assert np.abs(res - ref).max() < 1.e-10*np.abs(ref).max()
+
+
+def test_synthesize_matches_loop_non_square():
+    smp = _samples(nx=7, ny=31, nf=9, seed=2)
+    phi1, phi2 = smp.getRandomPhases(np.random.RandomState(3))
+    ref = smp._synthesizeLoop(phi1, phi2)
+    res = smp.synthesize(phi1, phi2)
+    assert np.abs(res - ref).max() < 1.e-10*np.abs(ref).max()
+
+
+def test_random_phases_zero_first_row_and_column():
+    smp = _samples()
+    phi1, phi2 = smp.getRandomPhases(np.random.RandomState(0))
+    for phi in (phi1, phi2):
+        assert phi.shape == smp.shMod.shape
+        assert not phi[0, :].any() and not phi[:, 0].any()
+        assert phi.min() >= 0 and phi.max() < 2*np.pi
+
+
+def test_new_sample_reproducible():
+    smp = _samples()
+    a = smp.getNewSample(rs=np.random.RandomState(5))
+    b = smp.getNewSample(rs=np.random.RandomState(5))
+    c = smp.getNewSample(rs=np.random.RandomState(6))
+    assert np.array_equal(a, b)
+    assert not np.allclose(a, c)